@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, LOAD AND MEMORY AWARE ADMISSION CONTROL **
+Replaces a fixed 'parallel --jobs 16' count, which is the same for SD
+FFV1 to V210 and HD ProRes to x264 '-preset slow' and ignores anything
+else the server is doing.
+
+Actions:
+1. monitor_host() samples /proc/stat and /proc/meminfo every SAMPLE_INTERVAL
+   seconds, keeping smoothed CPU idle %, iowait % and available memory.
+2. job_cost() probes a file with ffprobe for codec, height and duration
+   (used by the scheduler for shortest job first ordering) and looks up
+   the expected cores and memory for the job type and resolution in
+   JOB_COSTS (SD below 720 lines, HD below 2160, UHD above).
+3. admit() decides whether a job may start now. Jobs started in the last
+   RAMP_SECONDS are not yet visible in the load figures, so their cost is
+   subtracted from the idle cores and available memory first. A job is
+   refused if the host is saturated (idle below MIN_IDLE %, iowait above
+   MAX_IOWAIT %, or memory would drop below MEM_RESERVE_MB) or the job's
+   cores are not idle, unless nothing is running for that workflow.
+   That first job is only held while available memory is below
+   MEM_FLOOR_MB, so a job costing more than the host can spare still runs.
+   So concurrency backs off on HD days and ramps up on SD days.
+4. Returns (True/False, reason) for the calling script to log.
+
+Limits can be changed with environment variables ADMIT_MIN_IDLE,
+ADMIT_MAX_IOWAIT, ADMIT_MEM_RESERVE_MB and ADMIT_MEM_FLOOR_MB.
+
+2026
+Python 3.7+
+'''
+
+import os
+import json
+import time
+import asyncio
+
+SAMPLE_INTERVAL = 5
+SMOOTHING = 0.5
+RAMP_SECONDS = 60
+MIN_IDLE = float(os.environ.get('ADMIT_MIN_IDLE', 10))
+MAX_IOWAIT = float(os.environ.get('ADMIT_MAX_IOWAIT', 25))
+MEM_RESERVE_MB = int(os.environ.get('ADMIT_MEM_RESERVE_MB', 4096))
+MEM_FLOOR_MB = int(os.environ.get('ADMIT_MEM_FLOOR_MB', 1024))
+
+# Expected cores and memory (MB) per job, by job type and resolution
+JOB_COSTS = {
+    'ffv1_v210': {'SD': (1.5, 800), 'HD': (4, 2500), 'UHD': (12, 8000)},
+    'ffv1_ffv1': {'SD': (3, 1000), 'HD': (8, 3000), 'UHD': (16, 9000)},
+    'ffv1_check': {'SD': (1, 300), 'HD': (2, 600), 'UHD': (4, 1500)},
+    'v210_prores': {'SD': (2, 800), 'HD': (4, 2000), 'UHD': (10, 6000)},
+    'prores_h264': {'SD': (4, 1000), 'HD': (12, 3000), 'UHD': (24, 8000)}
+}
+DEFAULT_COST = (4, 2000)
+
+
+def read_cpu_times():
+    '''
+    Return (idle, iowait, total) jiffies
+    from first line of /proc/stat
+    '''
+    with open('/proc/stat', 'r') as stat:
+        fields = [int(x) for x in stat.readline().split()[1:]]
+    # user nice system idle iowait irq softirq steal (guest counted in user)
+    total = sum(fields[:8])
+    return fields[3], fields[4], total
+
+
+def read_mem_available():
+    '''
+    Return MemAvailable in MB from /proc/meminfo
+    '''
+    with open('/proc/meminfo', 'r') as meminfo:
+        for line in meminfo:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) // 1024
+    return 0
+
+
+def new_host():
+    '''
+    Host load state shared by all workflows
+    '''
+    return {
+        'cpus': os.cpu_count() or 1,
+        'idle': None,
+        'iowait': 0.0,
+        'mem_available': read_mem_available(),
+        'started': {},
+        '_times': read_cpu_times()
+    }
+
+
+def sample_host(host):
+    '''
+    Update smoothed idle %, iowait % and available memory
+    '''
+    idle, iowait, total = read_cpu_times()
+    last_idle, last_iowait, last_total = host['_times']
+    host['_times'] = (idle, iowait, total)
+    elapsed = total - last_total
+    if elapsed <= 0:
+        return host
+    idle_pct = 100 * (idle - last_idle) / elapsed
+    iowait_pct = 100 * (iowait - last_iowait) / elapsed
+    if host['idle'] is None:
+        host['idle'] = idle_pct
+        host['iowait'] = iowait_pct
+    else:
+        host['idle'] = SMOOTHING * idle_pct + (1 - SMOOTHING) * host['idle']
+        host['iowait'] = SMOOTHING * iowait_pct + (1 - SMOOTHING) * host['iowait']
+    host['mem_available'] = read_mem_available()
+    cutoff = time.time() - RAMP_SECONDS
+    host['started'] = {k: v for k, v in host['started'].items() if v[0] > cutoff}
+    return host
+
+
+async def monitor_host(host, stopping, interval=SAMPLE_INTERVAL):
+    '''
+    Sample host load until stopping is set
+    '''
+    while not stopping.is_set():
+        sample_host(host)
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def resolution_class(height):
+    '''
+    SD, HD or UHD from frame height
+    '''
+    if height >= 2160:
+        return 'UHD'
+    if height >= 720:
+        return 'HD'
+    return 'SD'
+
+
+async def probe_video(fpath):
+    '''
+    Return (codec_name, height, duration seconds) of first
+    video stream with ffprobe, or ('', 0, None) if unreadable
+    '''
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=codec_name,height:format=duration',
+        '-of', 'json',
+        fpath
+    ]
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await proc.communicate()
+        data = json.loads(stdout.decode('utf-8'))
+        stream = data['streams'][0]
+        duration = data.get('format', {}).get('duration')
+        return stream.get('codec_name', ''), int(stream.get('height', 0)), float(duration) if duration else None
+    except (OSError, ValueError, IndexError, KeyError):
+        return '', 0, None
+
+
+async def job_cost(fpath, job_type):
+    '''
+    Return cost dictionary of job type, codec, resolution,
+    duration, cores and memory for file
+    '''
+    codec, height, duration = await probe_video(fpath)
+    res = resolution_class(height) if height else 'HD'
+    cores, mem = JOB_COSTS.get(job_type, {}).get(res, DEFAULT_COST)
+    return {'type': job_type, 'codec': codec or 'unknown', 'resolution': res,
+            'duration': duration, 'cores': cores, 'mem': mem}
+
+
+def admit(host, cost, running_here=0):
+    '''
+    Decide if job of cost may start on host now
+    Returns (True/False, reason)
+    '''
+    if host['idle'] is None:
+        sample_host(host)
+    idle = host['idle'] if host['idle'] is not None else 100.0
+    cpus = host['cpus']
+    ramping_cores = sum(x[1]['cores'] for x in host['started'].values())
+    ramping_mem = sum(x[1]['mem'] for x in host['started'].values())
+    idle_cores = cpus * idle / 100 - ramping_cores
+    mem_left = host['mem_available'] - ramping_mem - cost['mem']
+    cores = round(min(cost['cores'], cpus), 1)
+    figures = (f"idle {round(idle)}% ({round(idle_cores, 1)} cores free of {cpus}), "
+               f"iowait {round(host['iowait'])}%, {host['mem_available']}MB available, "
+               f"job {cost['codec']} {cost['resolution']} needs {cores} cores {cost['mem']}MB")
+
+    if running_here == 0:
+        # Only a hard floor for a workflow's first job, so it can't wait forever
+        if host['mem_available'] - ramping_mem < MEM_FLOOR_MB:
+            return False, f"memory floor: {figures}"
+        return True, f"first job: {figures}"
+    if mem_left < MEM_RESERVE_MB:
+        return False, f"memory: {figures}"
+    if host['iowait'] > MAX_IOWAIT:
+        return False, f"iowait: {figures}"
+    if idle < MIN_IDLE:
+        return False, f"cpu saturated: {figures}"
+    if idle_cores < cores:
+        return False, f"cpu: {figures}"
+    return True, f"admit: {figures}"
+
+
+def record_start(host, fpath, cost):
+    '''
+    Count job cost against host until
+    it shows in the sampled load
+    '''
+    host['started'][fpath] = (time.time(), cost)
+
+
+def record_end(host, fpath):
+    '''
+    Stop counting cost of a job that
+    exits before it shows in sampled load
+    '''
+    host['started'].pop(fpath, None)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, BATCH MODE FOR TRANSCODE SCRIPTS **
+GNU parallel started a new Python for every file, so each file paid
+for interpreter start-up, module imports, a new log handler, the
+control JSON and environment paths before any transcoding began.
+Scripts now take many paths and work through them in one long-lived
+process.
+
+Actions:
+1. read_paths() builds the file list from a script's arguments. Each
+   argument may be a file path, a directory (files with the script's
+   extensions, one level deep unless recursive), a text file list (one
+   path per line, eg a start script dump_text.txt) or '-' to read paths
+   from stdin. Repeated paths are removed, keeping order.
+2. control_flag() reads a downtime_control.json key, re-reading the file
+   only when it changes, so a long batch notices a downtime request
+   without reading the JSON for every file.
+3. run_batch() runs a script's per file function over the list with a
+   thread pool. The work is FFmpeg and other subprocesses, so threads
+   share one logger, calibration profile, lease and I/O governor state
+   rather than paying for a process each. No new file starts once
+   keep_going() returns False, and an exception for one file is logged
+   without ending the batch.
+
+Use in a script:
+    paths = batch_mode.read_paths(sys.argv[1:], ('.mov',))
+    batch_mode.run_batch(paths, process_file, JOBS, logger, keep_going=check_control)
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import threading
+import concurrent.futures
+
+_control = {}
+_control_lock = threading.Lock()
+
+
+def list_folder(path, extensions, recursive=False):
+    '''
+    Return sorted files in path ending with
+    one of extensions, walking subfolders if recursive
+    '''
+    found = []
+    for root, dirs, files in os.walk(path):
+        found.extend(os.path.join(root, x) for x in files if x.endswith(extensions) and not x.startswith('.'))
+        if not recursive:
+            break
+        dirs[:] = [x for x in dirs if not x.startswith('.')]
+    return sorted(found)
+
+
+def read_list(data):
+    '''
+    Return paths from lines of a file list
+    or stdin, skipping blank lines
+    '''
+    return [x.rstrip('\n') for x in data if x.strip()]
+
+
+def read_paths(args, extensions, recursive=False):
+    '''
+    Return file paths from script arguments, expanding
+    '-' (stdin), directories and .txt file lists
+    '''
+    paths = []
+    for arg in args:
+        if arg == '-':
+            paths.extend(read_list(sys.stdin))
+        elif os.path.isdir(arg):
+            paths.extend(list_folder(arg, extensions, recursive))
+        elif arg.endswith('.txt') and not arg.endswith(extensions) and os.path.isfile(arg):
+            with open(arg, 'r') as data:
+                paths.extend(read_list(data))
+        else:
+            paths.append(arg)
+    return list(dict.fromkeys(paths))
+
+
+def control_flag(control_json, key):
+    '''
+    Return bool of key in control json, only re-reading
+    when it changes. Keeps last value if caught mid-write
+    '''
+    with _control_lock:
+        stat = os.stat(control_json)
+        change = (stat.st_mtime_ns, stat.st_size)
+        cached = _control.get(control_json)
+        if not cached or cached[0] != change:
+            try:
+                with open(control_json) as control:
+                    cached = (change, json.load(control))
+            except ValueError:
+                if not cached:
+                    raise
+            _control[control_json] = cached
+        return bool(cached[1][key])
+
+
+def run_batch(paths, process, workers, log, keep_going=None):
+    '''
+    Run process(path) for each path with up to workers
+    at once. Returns counts of files run, failed and
+    left unstarted after keep_going() returned False
+    '''
+    counts = {'run': 0, 'failed': 0, 'left': 0}
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    def run(fpath):
+        with lock:
+            if not stop.is_set() and keep_going and not keep_going():
+                log.info("Downtime control requests no new transcodes, remaining files left for next run")
+                stop.set()
+        if stop.is_set():
+            return False
+        process(fpath)
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(run, fpath): fpath for fpath in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                started = future.result()
+            except Exception:
+                log.exception("Batch file failed, continuing with next file: %s", futures[future])
+                counts['failed'] += 1
+                continue
+            counts['run' if started else 'left'] += 1
+    return counts
@@ -38,8 +38,8 @@ if [ -s "${dump_to}batch_transcode_f47_bluefish_fix_folders_text.txt" ]
     echo " == Start transcode of BlueFish MKV to MKV in $transcode_path1 == " >> "${log_path}"
     echo " == Shell script creating dump_text.txt output for parallel launch of Python scripts == " >> "${log_path}"
 
-    echo " == Launching GNU parallel to run muliple Python3 scripts for encoding == " >> "${log_path}"
-    grep '/mnt/' "${dump_to}batch_transcode_f47_bluefish_fix_folders_text.txt" | parallel --jobs 3 "sudo python3 ${python_script} {}"
+    echo " == Launching one Python3 script to encode all files in batch mode == " >> "${log_path}"
+    grep '/mnt/' "${dump_to}batch_transcode_f47_bluefish_fix_folders_text.txt" | sudo python3 ${python_script} -
 
     echo " ========================= SHELL SCRIPT END ========================== $(date +'%Y-%m-%d - %T')" >> "${log_path}"
   else
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 '''
-*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1] AND DRIVE PARALLEL ***
+*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1:] ***
 
 Script that takes FFv1 Matroska files and encodes to v210 mov:
-1. Shell script searches in paths for files that end in '.mkv' and passes on one at a time to Python
-2. Receives single path as sys.argv[1], checks metadata of file acquiring field order, colour data etc
+1. Shell script searches in paths for files that end in '.mkv' and passes the list to Python
+2. Receives paths as sys.argv[1:], checks metadata of file acquiring field order, colour data etc
 3. Populates FFmpeg subprocess command based on format decisiong from retrieved data
 4. Transcodes new file into QNAP_04 path named as {filename}.mov
 5. Runs framemd5 checks against the FFV1 matroska and V210 mov file, checks if they're identical
@@ -18,7 +18,17 @@ Script that takes FFv1 Matroska files and encodes to v210 mov:
      i. File is not mediaconch checked but moved to failures/ and failure log updated
      ii. V210 mov is deleted and FFV1 matroska is left in place for another transcoding attempt
      iii. MKV is moved to framemd5_fail folder
-6. Output MD5 checksum for V210 to new log when FrameMD5 files match
+6. Output MD5 checksum for V210 to checksum manifest store when FrameMD5 files match
+7. Collections listed in deliverables.json also get ProRes 422 HQ and/or an H.264 proxy
+   written by the same FFmpeg from the one FFV1 decode (deliverables.py). Once the V210
+   framemd5s match, each is checked against its own MediaConch policy and moved to its
+   finished folder, or to failures/ and deleted
+
+Steps 2-7 run as stages of stage_pipeline.py with separate pools for encodes
+(cpu), framemd5 passes (decode) and NAS reads/moves (io). The MKV framemd5
+runs alongside the encode, and one file encodes while others are hashed or moved.
+Moves and deletions are queued with finalise_queue.py and carried out
+in order by its background worker, so files no longer wait on the NAS.
 
 Python 3.7+
 2021
@@ -27,14 +37,26 @@ Python 3.7+
 # Global imports
 import os
 import sys
-import json
 import time
-import shutil
 import logging
+import sqlite3
 import subprocess
 
 # Local import
 from checksum_maker import make_checksum
+import checksum_manifest
+import stage_pipeline
+import batch_mode
+import io_governor
+import process_supervisor
+import file_lease
+import throughput_windows
+import finalise_queue
+import space_preflight
+import segment_encode
+import frame_repair
+import deliverables
+from transcode_calibration import get_profile
 
 # Global paths from server environmental variables
 MOV_POLICY = os.environ.get('MOV_POLICY_H22')
@@ -44,6 +66,9 @@ STORAGE = os.environ.get('H22LOAN4')
 H22_PTH = os.environ.get('H22_PATH_Q10')
 CHECKSUM_LOG = os.path.join(STORAGE, 'checksum_manifest.log')
 CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+JOURNAL = 'h22_ffv1_v210'
+PROFILE = get_profile('h22_ffv1_v210')
+POOL_SIZES = {'cpu': PROFILE.get('jobs', 10), 'decode': 4, 'io': 4}
 
 # Setup logging
 logger = logging.getLogger('batch_transcode_h22_ffv1_v210')
@@ -57,12 +82,10 @@ logger.setLevel(logging.INFO)
 def check_control():
     '''
     Check control json for downtime requests
+    Returns False if no new transcodes should start
+    (re-read only when changed, for long batches)
     '''
-    with open(CONTROL_JSON) as control:
-        j = json.load(control)
-        if not j['rna_transcode']:
-            logger.info('Script run prevented by downtime_control.json. Script exiting.')
-            sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    return batch_mode.control_flag(CONTROL_JSON, 'rna_transcode')
 
 
 def get_colour(fullpath):
@@ -76,7 +99,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    colour_prim = subprocess.check_output(mediainfo_cmd1)
+    colour_prim = process_supervisor.check_output(mediainfo_cmd1)
     colour_prim = str(colour_prim)
 
     mediainfo_cmd3 = [
@@ -86,7 +109,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    col_matrix = subprocess.check_output(mediainfo_cmd3)
+    col_matrix = process_supervisor.check_output(mediainfo_cmd3)
     col_matrix = str(col_matrix)
 
     if 'BT.709' in colour_prim:
@@ -121,7 +144,7 @@ def get_interl(fullpath):
         fullpath
     ]
 
-    interl_setting = subprocess.check_output(mediainfo_cmd)
+    interl_setting = process_supervisor.check_output(mediainfo_cmd)
     interl_setting = str(interl_setting)
 
     if 'TFF' in interl_setting:
@@ -181,12 +204,15 @@ def create_ffmpeg_command(fullpath, data=None):
     if data is None:
         data = []
 
+    # Decode and encode threads from transcode_calibration.py profile where calibrated
+    threads = ["-threads", str(PROFILE['threads'])] if PROFILE.get('threads') else []
+
     # Build subprocess call from data list
     ffmpeg_program_call = [
         "ffmpeg"
     ]
 
-    input_video_file = [
+    input_video_file = threads + [
         "-i", fullpath,
         "-nostdin"
     ]
@@ -199,7 +225,7 @@ def create_ffmpeg_command(fullpath, data=None):
 
     video_settings = [
         "-c:v", f"{data[0]}"
-    ]
+    ] + threads
 
     colour_build = [
         "-color_primaries", f"{data[4]}",
@@ -238,8 +264,11 @@ def conformance_check(filepath):
     ]
 
     try:
-        success = subprocess.check_output(mediaconch_cmd)
+        success = process_supervisor.check_output(mediaconch_cmd)
         success = str(success)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         success = ""
         logger.warning("Mediaconch policy retrieval failure for %s", filepath)
@@ -258,46 +287,41 @@ def conformance_check(filepath):
         logger.warning("FAIL! The policy has failed for %s:\n%s", filepath, success)
 
 
-def make_framemd5(fullpath):
+def framemd5_paths(fullpath):
     '''
-    Creates MKV and MOV framemd5 and returns path locations for generated files
-    Uses lutyuv trim due to non-compliant yuv data capture at source (fault of capture cards)
-    This losslessly passed to matroska, but in transcoding back to V210 mov yuv regions
-    0-4 and 1019-1023 become lossy failing framemd5 comparison. lutyuv command courtesy Dave Rice.
+    Returns path locations for MKV and MOV framemd5 files
     '''
-    new_filepath = change_path(fullpath, 'transcode')
     path_split = os.path.split(fullpath)
     filename = os.path.splitext(path_split[1])
     output_mkv = os.path.join(path_split[0], f"{filename[0]}.mkv.framemd5")
     output_mov = os.path.join(path_split[0], f"{filename[0]}.mov.framemd5")
+    return (output_mkv, output_mov)
 
-    framemd5_mkv = [
-        "ffmpeg", "-nostdin", "-y",
-        "-i", fullpath,
-        "-vf", "lutyuv=y=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):u=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):v=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val))",
-        "-f", "framemd5",
-        output_mkv
-    ]
-
-    try:
-        subprocess.call(framemd5_mkv)
-    except Exception:
-        logger.exception("Framemd5 command failure: %s", fullpath)
 
-    framemd5_mov = [
+def make_framemd5(input_path, output_md5):
+    '''
+    Creates framemd5 for MKV or MOV, run separately for each so the
+    MKV framemd5 can be made while the MOV is still encoding
+    Uses lutyuv trim due to non-compliant yuv data capture at source (fault of capture cards)
+    This losslessly passed to matroska, but in transcoding back to V210 mov yuv regions
+    0-4 and 1019-1023 become lossy failing framemd5 comparison. lutyuv command courtesy Dave Rice.
+    '''
+    framemd5_cmd = [
         "ffmpeg", "-nostdin", "-y",
-        "-i", new_filepath,
+        "-i", input_path,
         "-vf", "lutyuv=y=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):u=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):v=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val))",
         "-f", "framemd5",
-        output_mov
+        output_md5
     ]
 
     try:
-        subprocess.call(framemd5_mov)
+        with io_governor.mount_streams(input_path, output_md5):
+            process_supervisor.call(framemd5_cmd, label=input_path)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
-        logger.exception("Framemd5 command failure: %s", new_filepath)
-
-    return (output_mkv, output_mov)
+        logger.exception("Framemd5 command failure: %s", input_path)
 
 
 def diff_check(md5_mkv, md5_mov):
@@ -313,7 +337,10 @@ def diff_check(md5_mkv, md5_mov):
     ]
 
     try:
-        success = subprocess.check_output(diff_cmd)
+        success = process_supervisor.check_output(diff_cmd)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception as e:
         success = ""
         logger.warning("Diff check failed for %s and %s\n%s", md5_mkv, md5_mov, e)
@@ -342,197 +369,411 @@ def fail_log(fullpath, message):
         log_data.close()
 
 
-def checksum_log(fpath, checksum):
+def checksum_log(fpath, checksum, logger_list):
     '''
-    Creates fail log if not in existence
-    Appends new message to log
+    Writes path and checksum to indexed manifest store
+    Returns other paths found with matching checksum
+    If the store can't be written, appends to CHECKSUM_LOG
+    in its text format (load with checksum_manifest.py import)
     '''
-    if not os.path.isfile(CHECKSUM_LOG):
-        with open(CHECKSUM_LOG, 'x') as log_data:
-            log_data.close()
-
-    with open(CHECKSUM_LOG, 'a+') as log_data:
-        log_data.write(f"{fpath}, {checksum}\n")
-        log_data.close()
+    try:
+        return checksum_manifest.add_checksum(fpath, checksum)
+    except (sqlite3.Error, OSError) as err:
+        logger_list.append(f"WARNING: Unable to write checksum to manifest store, appending to {CHECKSUM_LOG}\n{err}")
+    try:
+        with open(CHECKSUM_LOG, 'a') as log_data:
+            log_data.write(f"{fpath}, {checksum}\n")
+    except OSError as err:
+        logger_list.append(f"WARNING: Unable to append checksum {checksum} to {CHECKSUM_LOG}\n{err}")
+    return []
 
 
-def main():
+def probe_stage(ctx):
     '''
-    Receives sys.argv[1] path to FFV1 mkv from shell start script via GNU parallel
-    Extracts metadata of file, passes to FFmpeg subprocess command, transcodes V210
-    Makes framemd5 comparison, and passes V210 mov through mediaconch policy
-    If all pass, cleans up files moving to success/ folder and deletes FFV1 mkv.
+    Checks file is for transcoding, extracts MKV metadata
+    and builds FFmpeg subprocess call
     '''
-    logger_list = []
-    if len(sys.argv) < 2:
-        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
-        sys.exit()
-    else:
-        logger.info("================== START Python3 ffv1 to v210 transcode START ==================")
-        check_control()
-        fullpath = sys.argv[1]
-        file = os.path.split(fullpath)[1]
-        if file.startswith("N_") and '/mkv/' not in fullpath:
-            # Build and execute FFmpeg subprocess call
-            logger_list.append(f"******** {fullpath} being processed ********")
-            ffmpeg_data = []
-            # Extract MKV metadata to list and pass to subprocess blocks
-            setfield = get_interl(fullpath)
-            colour_data = get_colour(fullpath)
-            color_primaries = colour_data[0]
-            color_trc = 'bt709'
-            colormatrix = colour_data[1]
-            codec = 'v210'
-            codec_desc = 'Uncompressed 10-bit 4:2:2'
-            ffmpeg_data = [codec, codec_desc, colormatrix, color_trc, color_primaries, setfield]
-
-            ffmpeg_call = create_ffmpeg_command(fullpath, ffmpeg_data)
-            ffmpeg_call_neat = (" ".join(ffmpeg_call), "\n")
-            logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
+    fullpath = ctx['item']
+    file = os.path.split(fullpath)[1]
+    if not file.startswith("N_") or '/mkv/' in fullpath:
+        logger.info("SKIPPING: %s is an '/mkv/' path ** NOT FOR TRANSCODING **", fullpath)
+        return False
+    if not check_control():
+        logger.info("SKIPPING: %s, downtime_control.json requests no new transcodes", fullpath)
+        return False
+    if finalise_queue.pending(fullpath, change_path(fullpath, 'transcode')):
+        logger.info("SKIPPING: %s has moves or deletion still in the finalisation queue", fullpath)
+        return False
+    ctx['lease'] = file_lease.acquire(fullpath)
+    if ctx['lease'] is None:
+        logger.info("SKIPPING: %s is leased by another run or host. %s", fullpath, file_lease.describe(fullpath))
+        return False
+    file_lease.keep_alive(ctx['lease'])
+
+    logger_list = ctx['logger_list'] = [f"******** {fullpath} being processed ********"]
+    # Extract MKV metadata to list and pass to subprocess blocks
+    setfield = get_interl(fullpath)
+    colour_data = get_colour(fullpath)
+    color_primaries = colour_data[0]
+    color_trc = 'bt709'
+    colormatrix = colour_data[1]
+    codec = 'v210'
+    codec_desc = 'Uncompressed 10-bit 4:2:2'
+    ffmpeg_data = [codec, codec_desc, colormatrix, color_trc, color_primaries, setfield]
+
+    ctx['ffmpeg_call'] = create_ffmpeg_command(fullpath, ffmpeg_data)
+    ffmpeg_call_neat = (" ".join(ctx['ffmpeg_call']), "\n")
+    logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
+    new_file = change_path(fullpath, 'transcode')
+    ctx['deliverables'] = {x: deliverables.deliverable_path(new_file, x) for x in deliverables.requested(fullpath)}
+    if ctx['deliverables']:
+        logger_list.append(f"Further deliverables written from the same decode: {', '.join(ctx['deliverables'])}")
+    return True
 
+
+def encode_stage(ctx):
+    '''
+    Transcodes FFV1 mkv to V210 mov, and any further
+    deliverables from the same decode, once space
+    for the predicted outputs is reserved
+    '''
+    file = os.path.split(ctx['item'])[1]
+    output = ctx['ffmpeg_call'][-1]
+    for path in [output] + list(ctx['deliverables'].values()):
+        if os.path.exists(path):
+            # Journal shows no completed encode, so output is left from an interrupted run
+            ctx['logger_list'].append(f"Removing incomplete output from earlier run: {path}")
+            os.remove(path)
+    with space_preflight.reserved(ctx['item'], output, 'ffv1_v210', ctx['ffmpeg_call']) as space:
+        if space['reservation'] is None:
+            ctx['logger_list'].append(f"WARNING: HOLD {file}, not enough space for V210 output: {space['figures']}. Leaving for next run")
+            return False
+        ctx['logger_list'].append(f"Space reserved for V210 output: {space['figures']}")
+        with deliverables.reserved(ctx['item'], ctx['deliverables']) as extra:
+            if extra['held']:
+                ctx['logger_list'].append(f"WARNING: HOLD {file}, not enough space for deliverables: {'; '.join(extra['figures'])}. Leaving for next run")
+                return False
+            if ctx['deliverables']:
+                ctx['logger_list'].append(f"Space reserved for deliverables: {'; '.join(extra['figures'])}")
             tic = time.perf_counter()
             try:
-                subprocess.call(ffmpeg_call)
-            except Exception:
-                logger_list.append(f"WARNING: FFmpeg command failed: {ffmpeg_call}")
-            toc = time.perf_counter()
-            encode_time = (toc - tic) // 60
-            seconds_time = (toc - tic)
-            logger_list.append(f"*** Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
-
-            # Check framemd5's match for MKV and MOV
-            tic2 = time.perf_counter()
-            framemd5 = make_framemd5(fullpath)
-            toc2 = time.perf_counter()
-            md5_time = (toc2 - tic2) // 60
-            md5_seconds = (toc2 - tic2)
-            logger_list.append(f"*** MD5 creation time for FFV1 and MOV: {md5_time} minutes or {md5_seconds} seconds")
-            md5_mkv = framemd5[0]
-            md5_mov = framemd5[1]
-            result = diff_check(md5_mkv, md5_mov)
-            if 'MATCH' in result:
-                logger_list.append(f"Framemd5 check passed for {md5_mkv} and {md5_mov}")
-                logger_list.append("Copying to top level framemd5 folder (deleting local version)")
-                md5_mov_fname = os.path.split(md5_mov)[1]
-                md5_mkv_fname = os.path.split(md5_mkv)[1]
-                shutil.move(md5_mov, os.path.join(FRAMEMD5_PATH, md5_mov_fname))
-                shutil.move(md5_mkv, os.path.join(FRAMEMD5_PATH, md5_mkv_fname))
-                # New block to create Checksum log for all V210 files in STORAGE path
-                logger_list.append("Creating whole file checksum for new MOV file.")
-                new_mov_path = change_path(fullpath, 'transcode')
-                checksum = make_checksum(new_mov_path)
-                if checksum:
-                    checksum_log(new_mov_path, checksum)
-                    logger_list.append(f"Writing file checksum {checksum} to log")
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
-                    else:
-                        logger.info("%s", line)
-                clean_up(fullpath)
-
-            else:
-                fail_path = change_path(fullpath, 'failed')
-                new_file = change_path(fullpath, 'transcode')
-                mkv_fail_path = change_path(fullpath, 'mkv_fail')
-                logger_list.append(f"--- {mkv_fail_path} ---")
-                fail_log(fullpath, f"{fail_path} being deleted due to Framemd5 mis-match. Failed framemd5 manifests moving to 'framemd5/' appended 'failed_' for review")
-                logger_list.append("FRAMEMD5 FILES DO NOT MATCH. Moving Matroska to framemd5_fail/ folder for review")
-
-                md5_mkv_split = os.path.split(md5_mkv)
-                rename_md5_mkv = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv_split[1]}')
-                md5_mov_split = os.path.split(md5_mov)
-                rename_md5_mov = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mov_split[1]}')
-
-                # Move framemd5 files from qnap02 to qnap04 (new block)
-                logger_list.append(f"MOVING: {md5_mov} TO {rename_md5_mov}")
-                shutil.copy(md5_mov, rename_md5_mov)
-                shutil.copy(md5_mkv, rename_md5_mkv)
-                if os.path.exists(rename_md5_mov):
-                    os.remove(md5_mov)
-                    logger_list.append(f"Framemd5 moved to framemd5 folder: {rename_md5_mov}")
+                if ctx['deliverables']:
+                    call = deliverables.multi_output_call(space['call'], ctx['deliverables'])
+                    ctx['logger_list'].append(f"FFmpeg call for all deliverables: {' '.join(call)}")
+                    with io_governor.mount_streams(ctx['item'], output, *ctx['deliverables'].values()):
+                        if process_supervisor.call(call, label=ctx['item']) == 0:
+                            space['complete'] = extra['complete'] = True
                 else:
-                    logger_list.append("WARNING: Unable to copy framemd5 files to failures/ folder")
-                if os.path.exists(rename_md5_mkv):
-                    os.remove(md5_mkv)
-                    logger_list.append(f"Framemd5 moved to framemd5 folder: {rename_md5_mkv}")
-                else:
-                    logger_list.append("WARNING: Unable to copy framemd5 files to failures/ folder")
-
-                try:
-                    shutil.move(fullpath, mkv_fail_path)
-                    logger_list.append("Moving MKV to framemd5_fail/ folder for review")
-                except Exception as err:
-                    logger_list.append(f"WARNING: Failed to move MKV to framemd5_fail/ folder: {mkv_fail_path}\n{err}")
-                try:
-                    shutil.move(new_file, fail_path)
-                    logger_list.append(f"Moving {new_file} to failures/ folder: {fail_path} before deletion")
-                except Exception:
-                    logger_list.append(f"WARNING: Unable to move {new_file} to failures/ folder: {fail_path}")
-                try:
-                    logger_list.append(f"Deleting {fail_path} file")
-                    os.remove(fail_path)
-                except Exception:
-                    logger_list.append(f"WARNING: Unable to delete {fail_path}")
-
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
+                    segmented = segment_encode.encode(space['call'], space['prediction']['bytes'], label=ctx['item'])
+                    if segmented:
+                        ctx['logger_list'].append("Encoded as parallel segments, each verified against source frames before joining")
+                        space['complete'] = True
                     else:
-                        logger.info("%s", line)
-        else:
-            logger.info("SKIPPING: %s is an '/mkv/' path ** NOT FOR TRANSCODING **", fullpath)
+                        if segmented is False:
+                            ctx['logger_list'].append("WARNING: Segment encoding failed, encoding as a single process")
+                        with io_governor.mount_streams(ctx['item'], output):
+                            if process_supervisor.call(space['call'], label=ctx['item']) == 0:
+                                space['complete'] = True
+            except subprocess.TimeoutExpired:
+                # Stalled and stopped by process_supervisor, leave file for next run
+                raise
+            except Exception:
+                ctx['logger_list'].append(f"WARNING: FFmpeg command failed: {space['call']}")
+            toc = time.perf_counter()
+    encode_time = (toc - tic) // 60
+    seconds_time = (toc - tic)
+    ctx['logger_list'].append(f"*** Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
+    if not space['complete']:
+        ctx['logger_list'].append(f"WARNING: FFmpeg encode failed for {file}, removing outputs and leaving for next run")
+        for path in [output] + list(ctx['deliverables'].values()):
+            if os.path.exists(path):
+                os.remove(path)
+        return False
+    return True
+
+
+def framemd5_mkv_stage(ctx):
+    '''
+    Creates MKV framemd5, alongside the encode
+    '''
+    md5_mkv = framemd5_paths(ctx['item'])[0]
+    tic = time.perf_counter()
+    make_framemd5(ctx['item'], md5_mkv)
+    toc = time.perf_counter()
+    ctx['logger_list'].append(f"*** MD5 creation time for FFV1: {(toc - tic) // 60} minutes or {toc - tic} seconds")
+    return True
+
+
+def framemd5_mov_stage(ctx):
+    '''
+    Creates MOV framemd5 once encode completes
+    '''
+    md5_mov = framemd5_paths(ctx['item'])[1]
+    tic = time.perf_counter()
+    make_framemd5(change_path(ctx['item'], 'transcode'), md5_mov)
+    toc = time.perf_counter()
+    ctx['logger_list'].append(f"*** MD5 creation time for MOV: {(toc - tic) // 60} minutes or {toc - tic} seconds")
+    return True
 
-    logger.info("================== END ffv1 to v210 transcode END ==================")
+
+def finalise(ctx, operations):
+    '''
+    Hand moves and deletes to the background finalisation
+    queue, which runs them in order after this stage returns,
+    if this run still holds the file's lease
+    '''
+    if not file_lease.still_held(ctx['lease']):
+        ctx['logger_list'].append(f"WARNING: Lease on {ctx['item']} lost, files left in place for its new holder")
+        return False
+    try:
+        batch = finalise_queue.enqueue(operations, origin=JOURNAL)
+    except Exception as err:
+        ctx['logger_list'].append(f"WARNING: Unable to queue finalisation for {ctx['item']}, files left in place\n{err}")
+        return False
+    for operation in operations:
+        ctx['logger_list'].append(f"Queued finalisation batch {batch}: {' '.join(x for x in operation[:3] if x)}")
+    return True
 
 
-def clean_up(fullpath):
+def diff_stage(ctx):
+    '''
+    Checks framemd5's match for MKV and MOV. If not, tries
+    re-encoding just the mismatching frames, and if that
+    fails moves MKV to framemd5_fail/ and deletes V210 mov
+    and returns False so no further stages run
+    '''
+    fullpath = ctx['item']
+    logger_list = ctx['logger_list']
+    md5_mkv, md5_mov = framemd5_paths(fullpath)
+    result = diff_check(md5_mkv, md5_mov)
+    if 'MATCH' not in result:
+        repaired, note = frame_repair.repair(ctx['ffmpeg_call'], md5_mkv, md5_mov, label=fullpath)
+        if repaired:
+            logger_list.append(f"Framemd5 mismatch repaired: {note}")
+            ctx['repaired'] = True
+            result = diff_check(md5_mkv, md5_mov)
+        else:
+            logger_list.append(f"WARNING: Framemd5 mismatch could not be repaired: {note}")
+    if 'MATCH' in result:
+        logger_list.append(f"Framemd5 check passed for {md5_mkv} and {md5_mov}")
+        logger_list.append("Moving to top level framemd5 folder (deleting local version)")
+        finalise(ctx, [('move', md5_mov, FRAMEMD5_PATH), ('move', md5_mkv, FRAMEMD5_PATH)])
+        return True
+
+    fail_path = change_path(fullpath, 'failed')
+    new_file = change_path(fullpath, 'transcode')
+    mkv_fail_path = change_path(fullpath, 'mkv_fail')
+    logger_list.append(f"--- {mkv_fail_path} ---")
+    fail_log(fullpath, f"{fail_path} being deleted due to Framemd5 mis-match. Failed framemd5 manifests moving to 'framemd5/' appended 'failed_' for review")
+    logger_list.append("FRAMEMD5 FILES DO NOT MATCH. Moving Matroska to framemd5_fail/ folder for review")
+
+    md5_mkv_split = os.path.split(md5_mkv)
+    rename_md5_mkv = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv_split[1]}')
+    md5_mov_split = os.path.split(md5_mov)
+    rename_md5_mov = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mov_split[1]}')
+
+    # Move framemd5 files from qnap02 to qnap04, MKV for review and MOV
+    # to failures/ before deletion, as separate batches so one failing
+    # doesn't hold back the others
+    finalise(ctx, [('move', md5_mov, rename_md5_mov), ('move', md5_mkv, rename_md5_mkv)])
+    finalise(ctx, [('move', fullpath, mkv_fail_path)])
+    finalise(ctx, [('move', new_file, fail_path), ('remove', fail_path)])
+    if ctx['deliverables']:
+        logger_list.append("Deleting further deliverables made from the same decode")
+        finalise(ctx, [('remove', x) for x in ctx['deliverables'].values()])
+    return False
+
+
+def deliver_stage(ctx):
     '''
-    Runs conformance check with MediaConch, and pass or fail
-    removes the relevant file and appends logs
+    Checks each further deliverable against its own MediaConch
+    policy once the V210 framemd5 match has verified the decode
+    they share. Passes are moved to their finished folders
     '''
+    fullpath = ctx['item']
+    logger_list = ctx['logger_list']
     new_file = change_path(fullpath, 'transcode')
-    logger.info("Clean up begins for %s", new_file)
-    if os.path.isfile(new_file):
-        if new_file.endswith(".mov"):
-            logger.info("Conformance check: comparing %s with policy", new_file)
-            result = conformance_check(new_file)
-            if "PASS!" in result:
-                logger.info("%s passed the policy checker and it's Matroska can be deleted", new_file)
-                try:
-                    new_file_path = change_path(fullpath, 'move')
-                    shutil.move(new_file, new_file_path)
-                except Exception:
-                    logger.warning("Unable to move %s to success folder: %s", new_file, new_file_path)
-                try:
-                    # Delete FFV1 mkv after successful transcode to V210 mov
-                    logger.info("*** DELETION OF MKV FOLLOWING SUCCESSFUL TRANSCODE: %s", fullpath)
-                    os.remove(fullpath)
-                except Exception:
-                    logger.warning("Deletion failure: %s", fullpath)
-            else:
-                logger.warning("FAIL: %s failed the policy checker. Leaving Matroska for second encoding attempt", new_file)
-                fail_log(fullpath, result)
-                fail_path = change_path(fullpath, 'failed')
-                try:
-                    # Delete MOV from failures/ path
-                    shutil.move(new_file, fail_path)
-                    logger.info("Moving %s to failures/ folder: %s", new_file, fail_path)
-                except Exception:
-                    logger.warning("Unable to move %s to failures/ folder: %s", new_file, fail_path)
-                try:
-                    logger.info("Deleting %s file as failed mediaconch policy", fail_path)
-                    os.remove(fail_path)
-                except Exception:
-                    logger.warning("Unable to delete %s", fail_path)
+    for name, output in ctx['deliverables'].items():
+        if ctx.get('repaired'):
+            # Frames repaired in the V210 were also damaged in this deliverable
+            logger_list.append(f"WARNING: Deleting {name} deliverable {output}, made before V210 frames were repaired")
+            fail_log(fullpath, f"{name} deliverable deleted as V210 needed frame repair, make again from V210")
+            finalise(ctx, [('remove', output)])
+            continue
+        if not os.path.isfile(output):
+            logger_list.append(f"WARNING: {name} deliverable not made: {output}")
+            continue
+        logger_list.append(f"Conformance check: comparing {name} deliverable {output} with policy")
+        result = deliverables.conformance_check(name, output)
+        if "PASS!" in result:
+            logger_list.append(f"{output} passed the {name} policy, queueing move to {deliverables.PROFILES[name]['pass']}/")
+            finalise(ctx, [('move', output, deliverables.deliverable_path(new_file, name, 'pass'))])
         else:
-            logger.info("Skipping %s, as this file is not ended .mov", new_file)
+            logger_list.append(f"WARNING: FAIL: {name} deliverable {output} failed the policy checker")
+            fail_log(fullpath, f"{name} deliverable failed policy:\n{result}")
+            fail_path = deliverables.deliverable_path(new_file, name, 'fail')
+            finalise(ctx, [('move', output, fail_path), ('remove', fail_path)])
+    return True
+
+
+def checksum_stage(ctx):
+    '''
+    Creates whole file checksum for all V210 files in STORAGE path
+    '''
+    logger_list = ctx['logger_list']
+    logger_list.append("Creating whole file checksum for new MOV file.")
+    new_mov_path = change_path(ctx['item'], 'transcode')
+    with io_governor.mount_streams(new_mov_path):
+        checksum = make_checksum(new_mov_path)
+    if checksum:
+        logger_list.append(f"Writing file checksum {checksum} to manifest store")
+        duplicates = checksum_log(new_mov_path, checksum, logger_list)
+        if duplicates:
+            logger_list.append(f"WARNING: Checksum {checksum} already recorded for: {', '.join(duplicates)}")
+        ctx['checksum'] = checksum
+    return True
+
+
+def conformance_stage(ctx):
+    '''
+    Runs conformance check with MediaConch, result
+    is acted on by clean_up once checksum completes
+    '''
+    new_file = change_path(ctx['item'], 'transcode')
+    if not os.path.isfile(new_file):
+        ctx['logger_list'].append(f"WARNING: NOT A FILE: {new_file} what is this?")
+        return False
+    if not new_file.endswith(".mov"):
+        ctx['logger_list'].append(f"Skipping {new_file}, as this file is not ended .mov")
+        return False
+    ctx['logger_list'].append(f"Conformance check: comparing {new_file} with policy")
+    ctx['conformance'] = conformance_check(new_file)
+    return True
+
+
+def clean_up(ctx):
+    '''
+    Acts on conformance check pass or fail, moving
+    or removing the relevant file and appending logs
+    '''
+    fullpath = ctx['item']
+    logger_list = ctx['logger_list']
+    new_file = change_path(fullpath, 'transcode')
+    result = ctx['conformance']
+    logger_list.append(f"Clean up begins for {new_file}")
+    if "PASS!" in result:
+        logger_list.append(f"{new_file} passed the policy checker and it's Matroska can be deleted")
+        new_file_path = change_path(fullpath, 'move')
+        # FFV1 mkv is only deleted once the verified move to success/ has completed
+        logger_list.append(f"*** DELETION OF MKV FOLLOWING SUCCESSFUL TRANSCODE QUEUED: {fullpath}")
+        return finalise(ctx, [('move', new_file, new_file_path, ctx.get('checksum')), ('remove', fullpath)])
     else:
-        logger.warning("NOT A FILE: %s what is this?", new_file)
+        logger_list.append(f"WARNING: FAIL: {new_file} failed the policy checker. Leaving Matroska for second encoding attempt")
+        fail_log(fullpath, result)
+        fail_path = change_path(fullpath, 'failed')
+        # Delete MOV from failures/ path
+        return finalise(ctx, [('move', new_file, fail_path), ('remove', fail_path)])
+    return True
+
+
+def output_logs(ctx):
+    '''
+    Collate and output all logs for a file at once, as
+    stages of several files run at the same time
+    '''
+    for line in ctx.get('logger_list', []):
+        if 'WARNING' in str(line):
+            logger.warning("%s", line)
+        else:
+            logger.info("%s", line)
+    if ctx['resumed']:
+        logger.info("Resumed %s from job journal, skipping completed stages: %s", ctx['item'], ', '.join(ctx['resumed']))
+    if ctx['error']:
+        logger.warning("Stage failure for %s, file left for next run:\n%s", ctx['item'], ctx['error'])
+    if ctx['held']:
+        logger.info("Throughput window does not allow stage %s now, %s left for next run", ctx['held'], ctx['item'])
+    if ctx.get('lease'):
+        file_lease.release(ctx['lease'])
+
+
+def window_allowed(stage):
+    '''
+    Check current throughput window allows stage
+    '''
+    return throughput_windows.stage_allowed(JOURNAL, stage)
+
+
+def output_artefact(ctx):
+    '''
+    V210 mov made by encode, for job journal
+    '''
+    return [change_path(ctx['item'], 'transcode')]
+
+
+def encode_artefacts(ctx):
+    '''
+    V210 mov and further deliverables made by encode, for job journal
+    '''
+    return output_artefact(ctx) + list(ctx['deliverables'].values())
+
+
+def mkv_framemd5_artefact(ctx):
+    '''
+    MKV framemd5, for job journal
+    '''
+    return [framemd5_paths(ctx['item'])[0]]
+
+
+def mov_framemd5_artefact(ctx):
+    '''
+    MOV framemd5, for job journal
+    '''
+    return [framemd5_paths(ctx['item'])[1]]
+
+
+# Per file stages, each waits for the stages named in 'after'
+# 'journal' names the stage in job_journal.py, so a restarted run resumes after it
+STAGES = [
+    {'name': 'probe', 'func': probe_stage, 'pool': 'io', 'after': [], 'journal': 'probed', 'always': True},
+    {'name': 'encode', 'func': encode_stage, 'pool': 'cpu', 'after': ['probe'],
+     'journal': 'encoded', 'artefacts': encode_artefacts},
+    {'name': 'framemd5_mkv', 'func': framemd5_mkv_stage, 'pool': 'decode', 'after': ['probe'],
+     'journal': 'source-hashed', 'artefacts': mkv_framemd5_artefact},
+    {'name': 'framemd5_mov', 'func': framemd5_mov_stage, 'pool': 'decode', 'after': ['encode'],
+     'journal': 'output-hashed', 'artefacts': mov_framemd5_artefact},
+    {'name': 'diff', 'func': diff_stage, 'pool': 'io', 'after': ['framemd5_mkv', 'framemd5_mov'],
+     'journal': 'verified', 'artefacts': output_artefact, 'keep': ['repaired']},
+    {'name': 'deliver', 'func': deliver_stage, 'pool': 'io', 'after': ['diff'], 'journal': 'delivered'},
+    {'name': 'checksum', 'func': checksum_stage, 'pool': 'io', 'after': ['diff'],
+     'journal': 'checksummed', 'artefacts': output_artefact, 'keep': ['checksum']},
+    {'name': 'conformance', 'func': conformance_stage, 'pool': 'io', 'after': ['diff'],
+     'journal': 'conformed', 'artefacts': output_artefact, 'keep': ['conformance']},
+    {'name': 'clean_up', 'func': clean_up, 'pool': 'io', 'after': ['checksum', 'conformance', 'deliver'], 'journal': 'moved'}
+]
+
+
+def main():
+    '''
+    Receives paths to FFV1 mkv from shell start script (sys.argv[1:]), as
+    files, folders, text file lists or '-' for a list on stdin
+    Extracts metadata of each file, passes to FFmpeg subprocess command, transcodes V210
+    Makes framemd5 comparison, and passes V210 mov through mediaconch policy
+    If all pass, cleans up files moving to success/ folder and deletes FFV1 mkv.
+    Steps run as stage_pipeline stages so one file encodes while others are hashed or moved.
+    '''
+    if len(sys.argv) < 2:
+        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
+        sys.exit()
+
+    logger.info("================== START Python3 ffv1 to v210 transcode START ==================")
+    if not check_control():
+        logger.info('Script run prevented by downtime_control.json. Script exiting.')
+        sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    file_list = batch_mode.read_paths(sys.argv[1:], ('.mkv',))
+    logger.info("Batch of %s files received", len(file_list))
+    stage_pipeline.run_pipeline(file_list, STAGES, POOL_SIZES, on_complete=output_logs, journal=JOURNAL, allowed=window_allowed)
+    logger.info("================== END ffv1 to v210 transcode END ==================")
 
 
 if __name__ == "__main__":
     main()
-
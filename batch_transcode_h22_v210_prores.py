@@ -1,12 +1,13 @@
 #!/usr/bin/env LANG=en_UK.UTF-8 /usr/local/bin/python3
 
 '''
-*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1] AND DRIVE PARALLEL ***
+*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1:] ***
 Script that takes V210 Matroska files and encodes to ProRes mov:
 
 1. Shell script searches in paths for files that end in '.mov' not modified in the last ten minutes and at a depth of 1 folder,
-   then passes any found one at a time to batch_transcode_h22_v210_prores.py
-2. Python script receives single path as sys.argv[1] and populates fullpath variable
+   then passes the list on stdin to batch_transcode_h22_v210_prores.py
+2. Python script receives paths, folders or file lists in sys.argv[1:] ('-' for stdin) and runs
+   steps 3-5 for each file in one process, JOBS at a time (batch_mode.py)
 3. Populates FFmpeg subprocess command based on supplied fullpath, new generated output_fullpath and fixed FFmpeg command.*
 4. Transcodes new file into 'prores_transcode/' folder named as {filename}.mov
 5. Runs mediaconch checks against the ProRes file
@@ -30,16 +31,25 @@ Python 3.7+
 import os
 import sys
 import time
-import json
-import shutil
 import logging
 import subprocess
 
+# Local import
+import batch_mode
+import io_governor
+import process_supervisor
+import file_lease
+import finalise_queue
+import space_preflight
+from transcode_calibration import get_profile
+
 # Global paths from server environmental variables
 PATH_POLICY = os.environ['H22_POLICIES']
 PRORES_POLICY = os.path.join(PATH_POLICY, 'prores_transcode_check.xml')
 LOG = os.environ['SCRIPT_LOG']
 CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+PROFILE = get_profile('v210_prores')
+JOBS = PROFILE.get('jobs', 15)
 
 # Setup logging
 logger = logging.getLogger('batch_transcode_h22_v210_prores.log')
@@ -49,18 +59,13 @@ hdlr.setFormatter(formatter)
 logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
 
-logger.info("================== START Python3 v210 to ProRes transcode START ==================")
-
 
 def check_control():
     '''
     Check control json for downtime requests
+    Returns False if no new transcodes should start
     '''
-    with open(CONTROL_JSON) as control:
-        j = json.load(control)
-        if not j['rna_transcode']:
-            logger.info('Script run prevented by downtime_control.json. Script exiting.')
-            sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    return batch_mode.control_flag(CONTROL_JSON, 'rna_transcode')
 
 
 def change_path(fullpath, use):
@@ -87,12 +92,15 @@ def create_ffmpeg_command(fullpath):
     '''
     output_fullpath = change_path(fullpath, 'transcode')
 
+    # Decode and encode threads from transcode_calibration.py profile where calibrated
+    threads = ["-threads", str(PROFILE['threads'])] if PROFILE.get('threads') else []
+
     # Build subprocess call from data list
     ffmpeg_program_call = [
         "ffmpeg"
     ]
 
-    input_video_file = [
+    input_video_file = threads + [
         "-i", fullpath,
         "-nostdin"
     ]
@@ -104,7 +112,7 @@ def create_ffmpeg_command(fullpath):
     video_settings = [
         "-c:v", "prores_ks",
         "-profile:v", "3"
-    ]
+    ] + threads
 
     colour_build = [
         "-pix_fmt", "yuv422p10le",
@@ -140,8 +148,11 @@ def conformance_check(filepath):
     ]
 
     try:
-        success = subprocess.check_output(mediaconch_cmd)
+        success = process_supervisor.check_output(mediaconch_cmd)
         success = str(success)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         success = ""
         logger.exception("Mediaconch policy retrieval failure for %s", filepath)
@@ -183,23 +194,28 @@ def fail_log(fullpath, message):
             log_data.close()
 
 
-def main():
+def process_file(fullpath):
     '''
-    Receives sys.argv[1] path to MOV from shell start script via GNU parallel
-    Passes to FFmpeg subprocess command, transcodes ProRes mov then checks
+    Transcodes one V210 mov to ProRes, then checks the
     finished encoding against custom prores mediaconch policy
     If pass, cleans up files moving to finished_prores/ folder and deletes V210 mov (temp offline).
     '''
-    if len(sys.argv) < 2:
-        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
-        sys.exit()
-
-    check_control()
-    fullpath = sys.argv[1]
     path_split = os.path.split(fullpath)
     file = path_split[1]
     output_fullpath = change_path(fullpath, 'transcode')
-    if file.startswith("N_") and '/prores/' in fullpath:
+    if not file.startswith("N_") or '/prores/' not in fullpath:
+        logger.info("SKIPPING: %s is not a '/prores/' path ** NOT FOR TRANSCODING **", fullpath)
+        return
+    with file_lease.held(fullpath) as lease:
+        if lease is None:
+            logger.info("SKIPPING: %s is leased by another run or host. %s", fullpath, file_lease.describe(fullpath))
+            return
+        if finalise_queue.pending(fullpath, output_fullpath):
+            logger.info("SKIPPING: %s has moves or deletion still in the finalisation queue", fullpath)
+            return
+        if os.path.isfile(change_path(fullpath, 'pass')):
+            logger.info("SKIPPING: %s ProRes already made from its FFV1 as a further deliverable", fullpath)
+            return
         logger_data = []
 
         # Execute FFmpeg subprocess call
@@ -208,14 +224,27 @@ def main():
         ffmpeg_call_neat = (" ".join(ffmpeg_call), "\n")
         logger_data.append(f"FFmpeg call: {ffmpeg_call_neat}")
 
-        # tic/toc record encoding time
-        tic = time.perf_counter()
-        try:
-            subprocess.call(ffmpeg_call)
-            logger_data.append("Subprocess call for FFmpeg command successful")
-        except Exception as err:
-            logger_data.append(f"WARNING: FFmpeg command failed: {ffmpeg_call_neat}\n{err}")
-        toc = time.perf_counter()
+        with space_preflight.reserved(fullpath, ffmpeg_call[-1], 'v210_prores', ffmpeg_call) as space:
+            if space['reservation'] is None:
+                logger.warning("HOLD: %s, not enough space for ProRes output: %s. Leaving for next run", fullpath, space['figures'])
+                return
+            logger_data.append(f"Space reserved for ProRes output: {space['figures']}")
+            # tic/toc record encoding time
+            tic = time.perf_counter()
+            try:
+                with io_governor.mount_streams(fullpath, ffmpeg_call[-1]):
+                    if process_supervisor.call(space['call'], label=fullpath) == 0:
+                        space['complete'] = True
+                logger_data.append("Subprocess call for FFmpeg command successful")
+            except subprocess.TimeoutExpired:
+                # Stalled and stopped by process_supervisor, remove partial
+                # ProRes and leave V210 for next run
+                logger.warning("FFmpeg stalled and was stopped for %s, partial ProRes removed", fullpath)
+                queue_finalise([('remove', ffmpeg_call[-1])], lease)
+                raise
+            except Exception as err:
+                logger_data.append(f"WARNING: FFmpeg command failed: {ffmpeg_call_neat}\n{err}")
+            toc = time.perf_counter()
         encoding_time = (toc - tic) // 60
         seconds_time = (toc - tic)
         logger_data.append(f"*** Encoding time for {file}: {encoding_time} minutes or as seconds: {seconds_time}")
@@ -226,15 +255,49 @@ def main():
                 logger.warning("%s", line)
             else:
                 logger.info("%s", line)
-        clean_up(fullpath, output_fullpath)
+        clean_up(fullpath, output_fullpath, lease)
 
-    else:
-        logger.info("SKIPPING: %s is not a '/prores/' path ** NOT FOR TRANSCODING **", fullpath)
 
+def main():
+    '''
+    Receives paths to V210 mov from shell start script (sys.argv[1:]), as
+    files, folders, text file lists or '-' for a list on stdin, and runs
+    process_file() for each in one process with JOBS encoding at once
+    '''
+    if len(sys.argv) < 2:
+        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
+        sys.exit()
+
+    logger.info("================== START Python3 v210 to ProRes transcode START ==================")
+    if not check_control():
+        logger.info('Script run prevented by downtime_control.json. Script exiting.')
+        sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    file_list = batch_mode.read_paths(sys.argv[1:], ('.mov',))
+    logger.info("Batch of %s files received, running %s at once", len(file_list), JOBS)
+    counts = batch_mode.run_batch(file_list, process_file, JOBS, logger, keep_going=check_control)
+    logger.info("Batch complete: %s files run, %s failed, %s left for next run", counts['run'], counts['failed'], counts['left'])
     logger.info("================== END v210 to ProRes transcode END ==================")
 
 
-def clean_up(fullpath, new_fullpath):
+def queue_finalise(operations, lease):
+    '''
+    Hand moves and deletes to the background
+    finalisation queue, which runs them in order,
+    if this run still holds the file's lease
+    '''
+    if not file_lease.still_held(lease):
+        logger.warning("Lease on %s lost, files left in place for its new holder: %s", lease['file'], operations)
+        return
+    try:
+        batch = finalise_queue.enqueue(operations, origin='v210_prores')
+    except Exception:
+        logger.exception("Unable to queue finalisation, files left in place: %s", operations)
+        return
+    for operation in operations:
+        logger.info("Queued finalisation batch %s: %s", batch, ' '.join(x for x in operation[:3] if x))
+
+
+def clean_up(fullpath, new_fullpath, lease):
     '''
     Run mediaconch check against new prores
     Clean up V210 MOV or ProRes file depending on pass/fail
@@ -247,33 +310,16 @@ def clean_up(fullpath, new_fullpath):
             result = conformance_check(new_fullpath)
             if "PASS!" in result:
                 logger.info("%s passed the policy checker and it's V210 can be deleted", new_file[1])
-                try:
-                    new_file_path = change_path(fullpath, 'pass')
-                    shutil.move(new_fullpath, new_file_path)
-                    logger.info("Moving passed prores %s to completed folder: %s", new_file[1], new_file_path)
-                except Exception:
-                    logger.exception("Unable to move %s to success folder: %s", new_file[1], new_file_path)
-                try:
-                    # Delete V210 MOV after successful encode to ProRes mov
-                    logger.info("*** Deletion of V210 following successful transcode: %s", fullpath)
-                    os.remove(fullpath)
-                except Exception:
-                    logger.exception("Deletion failure: %s", fullpath)
+                new_file_path = change_path(fullpath, 'pass')
+                # Delete V210 MOV only once the verified move of the ProRes has completed
+                logger.info("*** Deletion of V210 following successful transcode queued: %s", fullpath)
+                queue_finalise([('move', new_fullpath, new_file_path), ('remove', fullpath)], lease)
             else:
                 logger.warning("FAIL: %s failed the policy checker. Leaving V210 mov for second encoding attempt", new_file[1])
                 fail_log(new_fullpath, result)
                 fail_path = change_path(fullpath, 'fail')
-                try:
-                    # Delete MOV from failures/ path
-                    logger.info("Moving %s to failures/ folder: %s", new_file[1], fail_path)
-                    shutil.move(new_fullpath, fail_path)
-                except Exception:
-                    logger.exception("Unable to move %s to failures/ folder: %s", new_file[1], fail_path)
-                try:
-                    logger.info("Deleting %s file as failed mediaconch policy")
-                    os.remove(fail_path)
-                except Exception:
-                    logger.exception("Unable to delete %s", fail_path)
+                # Delete MOV from failures/ path
+                queue_finalise([('move', new_fullpath, fail_path), ('remove', fail_path)], lease)
         else:
             logger.info("Skipping %s, as this file is not ended .mov", new_file[1])
     else:
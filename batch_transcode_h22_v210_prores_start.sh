@@ -42,8 +42,8 @@ if [ -s "${dump_to}batch_transcode_h22_v210_prores_dump_text.txt" ]
     echo " == Start trancode: $transcode_path1, $transcode_path2 and $transcode_path3 == " >> "${log_path}batch_transcode_h22_v210_prores.log"
     echo " == Shell script creating dump_text.txt output for parallel launch of Python scripts == " >> "${log_path}batch_transcode_h22_v210_prores.log"
 
-    echo " == Launching GNU parallel to run multiple Python3 scripts for encoding == " >> "${log_path}batch_transcode_h22_v210_prores.log"
-    grep '/mnt/' "${dump_to}batch_transcode_h22_v210_prores_dump_text.txt" | sort -u | parallel --jobs 15 "python3 $script_path {}"
+    echo " == Launching one Python3 script to encode all files in batch mode == " >> "${log_path}batch_transcode_h22_v210_prores.log"
+    grep '/mnt/' "${dump_to}batch_transcode_h22_v210_prores_dump_text.txt" | sort -u | python3 $script_path -
 
     echo " ========================= SHELL SCRIPT END ========================== $date_FULL" >> "${log_path}batch_transcode_h22_v210_prores.log"
   else
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 '''
-*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1] AND DRIVE PARALLEL ***
+*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1:] ***
 
 Script that takes FFv1 Matroska files and encodes to v210 mov:
-1. Shell script searches in paths for files that end in '.mkv' and passes on one at a time to Python
-2. Receives single path as sys.argv[1], checks metadata of file acquiring field order, colour data etc
+1. Shell script searches in paths for files that end in '.mkv' and passes the list to Python
+2. Receives paths as sys.argv[1:], checks metadata of file acquiring field order, colour data etc
 3. Populates FFmpeg subprocess command based on format decisiong from retrieved data
 4. Transcodes new file into transcode/ path named as {filename}.mov
 5. Runs framemd5 checks against the FFV1 matroska and V210 mov file, checks if they're identical
@@ -19,24 +19,41 @@ Script that takes FFv1 Matroska files and encodes to v210 mov:
      ii. V210 mov is deleted and FFV1 matroska is left in place for another transcoding attempt
      iii. MKV is moved to framemd5_fail folder
 
+Steps 2-5 run as stages of stage_pipeline.py, so the MKV framemd5 runs
+alongside the encode and one file encodes while others are checked or moved.
+Moves and deletions are queued with finalise_queue.py and carried out
+in order by its background worker, so files no longer wait on the NAS.
+
 Python 3.7+
 2021
 '''
 
 import os
 import sys
-import json
 import time
-import shutil
 import logging
 import subprocess
 
+# Local import
+import stage_pipeline
+import batch_mode
+import io_governor
+import process_supervisor
+import file_lease
+import throughput_windows
+import finalise_queue
+import space_preflight
+from transcode_calibration import get_profile
+
 # Global paths from server environmental variables
 MOV_POLICY_PAL = os.environ.get('MOV_POLICY_H22')
 MOV_POLICY_NTSC = os.environ.get('MOV_NTSC_GEN')
 STORAGE = os.environ.get('QNAP08_AUTOMATION')
 LOG = os.environ.get('SCRIPT_LOG')
 CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+JOURNAL = 'ofcom_ffv1_v210'
+PROFILE = get_profile('ofcom_ffv1_v210')
+POOL_SIZES = {'cpu': PROFILE.get('jobs', 3), 'decode': 2, 'io': 2}
 
 # Setup logging
 logger = logging.getLogger('batch_transcode_ofcom_ffv1_v210')
@@ -50,12 +67,10 @@ logger.setLevel(logging.INFO)
 def check_control():
     '''
     Check control json for downtime requests
+    Returns False if no new transcodes should start
+    (re-read only when changed, for long batches)
     '''
-    with open(CONTROL_JSON) as control:
-        j = json.load(control)
-        if not j['ofcom_transcode']:
-            logger.info('Script run prevented by downtime_control.json. Script exiting.')
-            sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    return batch_mode.control_flag(CONTROL_JSON, 'ofcom_transcode')
 
 
 def get_colour(fullpath):
@@ -69,7 +84,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    colour_prim = subprocess.check_output(mediainfo_cmd1)
+    colour_prim = process_supervisor.check_output(mediainfo_cmd1)
     colour_prim = str(colour_prim)
 
     mediainfo_cmd3 = [
@@ -79,7 +94,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    col_matrix = subprocess.check_output(mediainfo_cmd3)
+    col_matrix = process_supervisor.check_output(mediainfo_cmd3)
     col_matrix = str(col_matrix)
 
     if 'BT.709' in colour_prim:
@@ -114,7 +129,7 @@ def get_interl(fullpath):
         fullpath
     ]
 
-    interl_setting = subprocess.check_output(mediainfo_cmd)
+    interl_setting = process_supervisor.check_output(mediainfo_cmd)
     interl_setting = str(interl_setting)
 
     if 'TFF' in interl_setting:
@@ -161,12 +176,15 @@ def create_ffmpeg_command(fullpath, data=None):
     if data is None:
         data = []
 
+    # Decode and encode threads from transcode_calibration.py profile where calibrated
+    threads = ["-threads", str(PROFILE['threads'])] if PROFILE.get('threads') else []
+
     # Build subprocess call from data list
     ffmpeg_program_call = [
         "ffmpeg"
     ]
 
-    input_video_file = [
+    input_video_file = threads + [
         "-i", fullpath,
         "-nostdin"
     ]
@@ -179,7 +197,7 @@ def create_ffmpeg_command(fullpath, data=None):
 
     video_settings = [
         "-c:v", f"{data[0]}"
-    ]
+    ] + threads
 
     colour_build = [
         "-color_primaries", f"{data[4]}",
@@ -218,8 +236,11 @@ def conformance_check(filepath, mov_policy):
     ]
 
     try:
-        success = subprocess.check_output(mediaconch_cmd)
+        success = process_supervisor.check_output(mediaconch_cmd)
         success = str(success)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         success = ""
         logger.warning("Mediaconch policy retrieval failure for %s", filepath)
@@ -238,44 +259,31 @@ def conformance_check(filepath, mov_policy):
         logger.warning("FAIL! The policy has failed for %s:\n%s", filepath, success)
 
 
-def make_framemd5(fullpath):
+def make_framemd5(input_path):
     '''
-    Creates MKV and MOV framemd5 and returns results in variables
+    Creates framemd5 for MKV or MOV and returns result, run separately
+    for each so the MKV framemd5 can be made while the MOV is still encoding
     Uses lutyuv trim due to non-compliant yuv data capture at source (fault of capture cards)
     This losslessly passed to matroska, but in transcoding back to V210 mov yuv regions
     0-4 and 1019-1023 become lossy failing framemd5 comparison. lutyuv command courtesy Dave Rice.
     '''
-    new_filepath = change_path(fullpath, 'transcode')
-
-    framemd5_mkv = [
+    framemd5_cmd = [
         "ffmpeg", "-nostdin", "-y",
-        "-i", fullpath, "-an",
+        "-i", input_path, "-an",
         "-vf", "lutyuv=y=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):u=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):v=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val))",
         "-f", "framemd5",
         "-"
     ]
 
     try:
-        md5_mkv = subprocess.check_output(framemd5_mkv)
+        with io_governor.mount_streams(input_path):
+            return process_supervisor.check_output(framemd5_cmd, label=input_path)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
-        logger.exception("Framemd5 command failure: %s", fullpath)
-        md5_mkv = None
-
-    framemd5_mov = [
-        "ffmpeg", "-nostdin", "-y",
-        "-i", new_filepath, "-an",
-        "-vf", "lutyuv=y=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):u=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):v=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val))",
-        "-f", "framemd5",
-        "-"
-    ]
-
-    try:
-        md5_mov = subprocess.check_output(framemd5_mov)
-    except Exception:
-        logger.exception("Framemd5 command failure: %s", new_filepath)
-        md5_mov = None
-
-    return md5_mkv, md5_mov
+        logger.exception("Framemd5 command failure: %s", input_path)
+        return None
 
 
 def framemd5_cut(framemd5):
@@ -312,7 +320,10 @@ def diff_check(md5_mkv, md5_mov):
     ]
 
     try:
-        success = subprocess.check_output(diff_cmd)
+        success = process_supervisor.check_output(diff_cmd)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception as e:
         success = ""
         logger.warning("Diff check failed for %s and %s\n%s", md5_mkv, md5_mov, e)
@@ -335,7 +346,7 @@ def get_framerate(fullpath):
         fullpath
     ]
 
-    framerate = subprocess.check_output(mediainfo_cmd)
+    framerate = process_supervisor.check_output(mediainfo_cmd)
     framerate = framerate.decode('utf-8')
     if '.' in framerate:
         return framerate.split('.')[0]
@@ -361,164 +372,276 @@ def fail_log(fullpath, message):
         log_data.close()
 
 
-def main():
+def probe_stage(ctx):
     '''
-    Receives sys.argv[1] path to FFV1 mkv from shell start script via GNU parallel
-    Extracts metadata of file, passes to FFmpeg subprocess command, transcodes V210
-    Makes framemd5 comparison, and passes V210 mov through mediaconch policy
-    If all pass, cleans up files moving to success/ folder and deletes FFV1 mkv.
+    Checks file exists, extracts MKV metadata
+    and builds FFmpeg subprocess call
     '''
-    logger_list = []
-    if len(sys.argv) < 2:
-        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
-        sys.exit()
-    else:
-        logger.info("================== START Python3 ffv1 to v210 transcode START ==================")
-        check_control()
-        fullpath = sys.argv[1]
-        file = os.path.split(fullpath)[1]
-        if os.path.isfile(fullpath):
-            # Build and execute FFmpeg subprocess call
-            logger_list.append(f"******** {fullpath} being processed ********")
-            ffmpeg_data = []
-            # Extract MKV metadata to list and pass to subprocess blocks
-            setfield = get_interl(fullpath)
-            colour_data = get_colour(fullpath)
-            framerate = get_framerate(fullpath)
-            color_primaries = colour_data[0]
-            color_trc = 'bt709'
-            colormatrix = colour_data[1]
-            codec = 'v210'
-            codec_desc = 'Uncompressed 10-bit 4:2:2'
-            ffmpeg_data = [codec, codec_desc, colormatrix, color_trc, color_primaries, setfield, framerate]
-
-            ffmpeg_call = create_ffmpeg_command(fullpath, ffmpeg_data)
-            ffmpeg_call_neat = (" ".join(ffmpeg_call), "\n")
-            logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
-
-            tic = time.perf_counter()
-            try:
-                subprocess.call(ffmpeg_call)
-            except Exception:
-                logger_list.append(f"WARNING: FFmpeg command failed: {ffmpeg_call}")
-            toc = time.perf_counter()
-            encode_time = (toc - tic) // 60
-            seconds_time = (toc - tic)
-            logger_list.append(f"* Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
-
-            # Ensure that permissions allow framemd5 work
-            os.chmod(change_path(fullpath, 'transcode'), 0o777)
-
-            # Check framemd5's match for MKV and MOV
-            tic2 = time.perf_counter()
-            md5_mov, md5_mkv = make_framemd5(fullpath)
-            toc2 = time.perf_counter()
-            md5_time = (toc2 - tic2) // 60
-            md5_seconds = (toc2 - tic2)
-            logger_list.append(f"* MD5 creation time for FFV1 and MOV: {md5_time} minutes or {md5_seconds} seconds")
-
-            md5_mkv_trim = framemd5_cut(md5_mkv)
-            md5_mov_trim = framemd5_cut(md5_mov)
-            if md5_mkv_trim == md5_mov_trim:
-                logger_list.append(f"*** Framemd5 check passed for MKV and MOV")
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
-                    else:
-                        logger.info("%s", line)
-                clean_up(fullpath)
-
-            else:
-                fail_path = change_path(fullpath, 'failed')
-                new_file = change_path(fullpath, 'transcode')
-                mkv_fail_path = change_path(fullpath, 'mkv_fail')
-                logger_list.append(f"--- {mkv_fail_path} ---")
-                fail_log(fullpath, f"{fail_path} being deleted due to Framemd5 mis-match.")
-                logger_list.append("*** FRAMEMD5 FILES DO NOT MATCH. Moving Matroska to framemd5_fail/ folder for review")
-                try:
-                    shutil.move(fullpath, mkv_fail_path)
-                    logger_list.append("Moving MKV to framemd5_fail/ folder for review")
-                except Exception as err:
-                    logger_list.append(f"WARNING: Failed to move MKV to framemd5_fail/ folder: {mkv_fail_path}\n{err}")
-                try:
-                    shutil.move(new_file, fail_path)
-                    logger_list.append(f"Moving {new_file} to failures/ folder: {fail_path} before deletion")
-                except Exception:
-                    logger_list.append(f"WARNING: Unable to move {new_file} to failures/ folder: {fail_path}")
-                try:
-                    logger_list.append(f"Deleting {fail_path} file")
-                    #os.remove(fail_path)
-                except Exception:
-                    logger_list.append(f"WARNING: Unable to delete {fail_path}")
-
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
-                    else:
-                        logger.info("%s", line)
-        else:
-            logger.info("SKIPPING: %s is not a file.", fullpath)
+    fullpath = ctx['item']
+    if not os.path.isfile(fullpath):
+        logger.info("SKIPPING: %s is not a file.", fullpath)
+        return False
+    if not check_control():
+        logger.info("SKIPPING: %s, downtime_control.json requests no new transcodes", fullpath)
+        return False
+    if finalise_queue.pending(fullpath, change_path(fullpath, 'transcode')):
+        logger.info("SKIPPING: %s has moves or deletion still in the finalisation queue", fullpath)
+        return False
+    ctx['lease'] = file_lease.acquire(fullpath)
+    if ctx['lease'] is None:
+        logger.info("SKIPPING: %s is leased by another run or host. %s", fullpath, file_lease.describe(fullpath))
+        return False
+    file_lease.keep_alive(ctx['lease'])
+
+    logger_list = ctx['logger_list'] = [f"******** {fullpath} being processed ********"]
+    # Extract MKV metadata to list and pass to subprocess blocks
+    setfield = get_interl(fullpath)
+    colour_data = get_colour(fullpath)
+    framerate = get_framerate(fullpath)
+    color_primaries = colour_data[0]
+    color_trc = 'bt709'
+    colormatrix = colour_data[1]
+    codec = 'v210'
+    codec_desc = 'Uncompressed 10-bit 4:2:2'
+    ffmpeg_data = [codec, codec_desc, colormatrix, color_trc, color_primaries, setfield, framerate]
+
+    ctx['ffmpeg_call'] = create_ffmpeg_command(fullpath, ffmpeg_data)
+    ffmpeg_call_neat = (" ".join(ctx['ffmpeg_call']), "\n")
+    logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
+    return True
+
+
+def encode_stage(ctx):
+    '''
+    Transcodes FFV1 mkv to V210 mov once space
+    for the predicted output is reserved
+    '''
+    file = os.path.split(ctx['item'])[1]
+    output = ctx['ffmpeg_call'][-1]
+    if os.path.exists(output):
+        # Journal shows no completed encode, so output is left from an interrupted run
+        ctx['logger_list'].append(f"Removing incomplete output from earlier run: {output}")
+        os.remove(output)
+    with space_preflight.reserved(ctx['item'], output, 'ffv1_v210', ctx['ffmpeg_call']) as space:
+        if space['reservation'] is None:
+            ctx['logger_list'].append(f"WARNING: HOLD {file}, not enough space for V210 output: {space['figures']}. Leaving for next run")
+            return False
+        ctx['logger_list'].append(f"Space reserved for V210 output: {space['figures']}")
+        tic = time.perf_counter()
+        try:
+            with io_governor.mount_streams(ctx['item'], output):
+                if process_supervisor.call(space['call'], label=ctx['item']) == 0:
+                    space['complete'] = True
+        except subprocess.TimeoutExpired:
+            # Stalled and stopped by process_supervisor, leave file for next run
+            raise
+        except Exception:
+            ctx['logger_list'].append(f"WARNING: FFmpeg command failed: {space['call']}")
+        toc = time.perf_counter()
+    encode_time = (toc - tic) // 60
+    seconds_time = (toc - tic)
+    ctx['logger_list'].append(f"* Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
+    if not space['complete']:
+        ctx['logger_list'].append(f"WARNING: FFmpeg encode failed for {file}, removing output and leaving for next run")
+        if os.path.exists(output):
+            os.remove(output)
+        return False
+
+    # Ensure that permissions allow framemd5 work
+    os.chmod(change_path(ctx['item'], 'transcode'), 0o777)
+    return True
+
+
+def framemd5_mkv_stage(ctx):
+    '''
+    Creates MKV framemd5, alongside the encode
+    '''
+    tic = time.perf_counter()
+    ctx['md5_mkv'] = make_framemd5(ctx['item'])
+    toc = time.perf_counter()
+    ctx['logger_list'].append(f"* MD5 creation time for FFV1: {(toc - tic) // 60} minutes or {toc - tic} seconds")
+    return True
 
-    logger.info("================== END ffv1 to v210 transcode END ==================")
+
+def framemd5_mov_stage(ctx):
+    '''
+    Creates MOV framemd5 once encode completes
+    '''
+    tic = time.perf_counter()
+    ctx['md5_mov'] = make_framemd5(change_path(ctx['item'], 'transcode'))
+    toc = time.perf_counter()
+    ctx['logger_list'].append(f"* MD5 creation time for MOV: {(toc - tic) // 60} minutes or {toc - tic} seconds")
+    return True
+
+
+def finalise(ctx, operations):
+    '''
+    Hand moves and deletes to the background finalisation
+    queue, which runs them in order after this stage returns,
+    if this run still holds the file's lease
+    '''
+    if not file_lease.still_held(ctx['lease']):
+        ctx['logger_list'].append(f"WARNING: Lease on {ctx['item']} lost, files left in place for its new holder")
+        return False
+    try:
+        batch = finalise_queue.enqueue(operations, origin=JOURNAL)
+    except Exception as err:
+        ctx['logger_list'].append(f"WARNING: Unable to queue finalisation for {ctx['item']}, files left in place\n{err}")
+        return False
+    for operation in operations:
+        ctx['logger_list'].append(f"Queued finalisation batch {batch}: {' '.join(x for x in operation[:3] if x)}")
+    return True
 
 
-def clean_up(fullpath):
+def diff_stage(ctx):
     '''
-    Runs conformance check with MediaConch, and pass or fail
-    removes the relevant file and appends logs
+    Checks framemd5's match for MKV and MOV. If not,
+    moves MKV to framemd5_fail/ and moves V210 mov to
+    failures/, returning False so no further stages run
     '''
-    clean = False
+    fullpath = ctx['item']
+    logger_list = ctx['logger_list']
+    md5_mkv_trim = framemd5_cut(ctx.pop('md5_mkv'))
+    md5_mov_trim = framemd5_cut(ctx.pop('md5_mov'))
+    if md5_mkv_trim == md5_mov_trim:
+        logger_list.append(f"*** Framemd5 check passed for MKV and MOV")
+        return True
+
+    fail_path = change_path(fullpath, 'failed')
     new_file = change_path(fullpath, 'transcode')
-    logger.info("Clean up begins for %s", new_file)
-    if os.path.isfile(new_file):
-        if new_file.endswith(".mov"):
-            logger.info("Conformance check: comparing %s with PAL/NTSC policies", new_file)
-            result = conformance_check(new_file, MOV_POLICY_PAL)
-            if "PASS!" in result:
-                logger.info("%s passed the PAL policy checker and it's Matroska can be deleted", new_file)
-                clean = True
-            result2 = conformance_check(new_file, MOV_POLICY_NTSC)
-            if "PASS!" in result2:
-                logger.info("%s passed the NTSC policy checker and it's Matroska can be deleted", new_file)
-                clean = True
-
-            if clean is False:
-                logger.warning("FAIL: %s failed the policy checker. Leaving Matroska for second encoding attempt", new_file)
-                fail_log(fullpath, "MOV file failed Mediaconch policy:")
-                fail_log(fullpath, result)
-                fail_path = change_path(fullpath, 'failed')
-                try:
-                    # Delete MOV from failures/ path
-                    shutil.move(new_file, fail_path)
-                    logger.info("Moving %s to failures/ folder: %s", new_file, fail_path)
-                except Exception:
-                    logger.warning("Unable to move %s to failures/ folder: %s", new_file, fail_path)
-                try:
-                    logger.info("Deleting %s file as failed mediaconch policy", fail_path)
-                    #os.remove(fail_path)
-                except Exception:
-                    logger.warning("Unable to delete %s", fail_path)
-
-            if clean is True:
-                try:
-                    new_file_path = change_path(fullpath, 'move')
-                    shutil.move(new_file, new_file_path)
-                except Exception:
-                    logger.warning("Unable to move %s to success folder: %s", new_file, new_file_path)
-                try:
-                    # Delete FFV1 mkv after successful transcode to V210 mov
-                    logger.info("*** DELETION OF MKV FOLLOWING SUCCESSFUL TRANSCODE: %s", fullpath)
-                    os.remove(fullpath)
-                except Exception:
-                    logger.warning("Deletion failure: %s", fullpath)
+    mkv_fail_path = change_path(fullpath, 'mkv_fail')
+    logger_list.append(f"--- {mkv_fail_path} ---")
+    fail_log(fullpath, f"{fail_path} being deleted due to Framemd5 mis-match.")
+    logger_list.append("*** FRAMEMD5 FILES DO NOT MATCH. Moving Matroska to framemd5_fail/ folder for review")
+    finalise(ctx, [('move', fullpath, mkv_fail_path)])
+    # MOV kept in failures/ for review, not deleted
+    finalise(ctx, [('move', new_file, fail_path)])
+    return False
+
+
+def conformance_stage(ctx):
+    '''
+    Runs conformance check with MediaConch against PAL
+    and NTSC policies, result is acted on by clean_up
+    '''
+    new_file = change_path(ctx['item'], 'transcode')
+    logger_list = ctx['logger_list']
+    if not os.path.isfile(new_file):
+        logger_list.append(f"WARNING: NOT A FILE: {new_file} what is this?")
+        return False
+    if not new_file.endswith(".mov"):
+        logger_list.append(f"Skipping {new_file}, as this file is not ended .mov")
+        return False
+
+    ctx['clean'] = False
+    logger_list.append(f"Conformance check: comparing {new_file} with PAL/NTSC policies")
+    ctx['conformance'] = conformance_check(new_file, MOV_POLICY_PAL)
+    if "PASS!" in ctx['conformance']:
+        logger_list.append(f"{new_file} passed the PAL policy checker and it's Matroska can be deleted")
+        ctx['clean'] = True
+    result2 = conformance_check(new_file, MOV_POLICY_NTSC)
+    if "PASS!" in result2:
+        logger_list.append(f"{new_file} passed the NTSC policy checker and it's Matroska can be deleted")
+        ctx['clean'] = True
+    return True
+
+
+def clean_up(ctx):
+    '''
+    Acts on conformance check pass or fail, moving
+    or removing the relevant file and appending logs
+    '''
+    fullpath = ctx['item']
+    logger_list = ctx['logger_list']
+    new_file = change_path(fullpath, 'transcode')
+    logger_list.append(f"Clean up begins for {new_file}")
+
+    if ctx['clean'] is False:
+        logger_list.append(f"WARNING: FAIL: {new_file} failed the policy checker. Leaving Matroska for second encoding attempt")
+        fail_log(fullpath, "MOV file failed Mediaconch policy:")
+        fail_log(fullpath, ctx['conformance'])
+        fail_path = change_path(fullpath, 'failed')
+        # MOV kept in failures/ for review, not deleted
+        return finalise(ctx, [('move', new_file, fail_path)])
+
+    new_file_path = change_path(fullpath, 'move')
+    # FFV1 mkv is only deleted once the verified move to success/ has completed
+    logger_list.append(f"*** DELETION OF MKV FOLLOWING SUCCESSFUL TRANSCODE QUEUED: {fullpath}")
+    return finalise(ctx, [('move', new_file, new_file_path), ('remove', fullpath)])
+
+
+def output_logs(ctx):
+    '''
+    Collate and output all logs for a file at once, as
+    stages of several files run at the same time
+    '''
+    for line in ctx.get('logger_list', []):
+        if 'WARNING' in str(line):
+            logger.warning("%s", line)
         else:
-            logger.info("Skipping %s, as this file is not ended .mov", new_file)
-    else:
-        logger.warning("NOT A FILE: %s what is this?", new_file)
+            logger.info("%s", line)
+    if ctx['resumed']:
+        logger.info("Resumed %s from job journal, skipping completed stages: %s", ctx['item'], ', '.join(ctx['resumed']))
+    if ctx['error']:
+        logger.warning("Stage failure for %s, file left for next run:\n%s", ctx['item'], ctx['error'])
+    if ctx['held']:
+        logger.info("Throughput window does not allow stage %s now, %s left for next run", ctx['held'], ctx['item'])
+    if ctx.get('lease'):
+        file_lease.release(ctx['lease'])
+
+
+def window_allowed(stage):
+    '''
+    Check current throughput window allows stage
+    '''
+    return throughput_windows.stage_allowed(JOURNAL, stage)
+
+
+def output_artefact(ctx):
+    '''
+    V210 mov made by encode, for job journal
+    '''
+    return [change_path(ctx['item'], 'transcode')]
+
+
+# Per file stages, each waits for the stages named in 'after'
+# 'journal' names the stage in job_journal.py, so a restarted run resumes after it
+# Framemd5s are held in memory, so are remade unless the diff is already done
+STAGES = [
+    {'name': 'probe', 'func': probe_stage, 'pool': 'io', 'after': [], 'journal': 'probed', 'always': True},
+    {'name': 'encode', 'func': encode_stage, 'pool': 'cpu', 'after': ['probe'],
+     'journal': 'encoded', 'artefacts': output_artefact},
+    {'name': 'framemd5_mkv', 'func': framemd5_mkv_stage, 'pool': 'decode', 'after': ['probe']},
+    {'name': 'framemd5_mov', 'func': framemd5_mov_stage, 'pool': 'decode', 'after': ['encode']},
+    {'name': 'diff', 'func': diff_stage, 'pool': 'cpu', 'after': ['framemd5_mkv', 'framemd5_mov'],
+     'journal': 'verified', 'artefacts': output_artefact},
+    {'name': 'conformance', 'func': conformance_stage, 'pool': 'io', 'after': ['diff'],
+     'journal': 'conformed', 'artefacts': output_artefact, 'keep': ['conformance', 'clean']},
+    {'name': 'clean_up', 'func': clean_up, 'pool': 'io', 'after': ['conformance'], 'journal': 'moved'}
+]
 
 
+def main():
+    '''
+    Receives paths to FFV1 mkv from shell start script (sys.argv[1:]), as
+    files, folders, text file lists or '-' for a list on stdin
+    Extracts metadata of each file, passes to FFmpeg subprocess command, transcodes V210
+    Makes framemd5 comparison, and passes V210 mov through mediaconch policy
+    If all pass, cleans up files moving to success/ folder and deletes FFV1 mkv.
+    Steps run as stage_pipeline stages so one file encodes while others are hashed or moved.
+    '''
+    if len(sys.argv) < 2:
+        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
+        sys.exit()
+
+    logger.info("================== START Python3 ffv1 to v210 transcode START ==================")
+    if not check_control():
+        logger.info('Script run prevented by downtime_control.json. Script exiting.')
+        sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    file_list = batch_mode.read_paths(sys.argv[1:], ('.mkv',))
+    logger.info("Batch of %s files received", len(file_list))
+    stage_pipeline.run_pipeline(file_list, STAGES, POOL_SIZES, on_complete=output_logs, journal=JOURNAL, allowed=window_allowed)
+    logger.info("================== END ffv1 to v210 transcode END ==================")
 
 
 if __name__ == "__main__":
@@ -37,8 +37,8 @@ if [ -s "${dump_to}batch_transcode_ofcom_ffv1_v210_dump_text.txt" ]
     echo " == Start batch_transcode_h22_ffv1_v210 in $transcode_path1 and $transcode_path2 == " >> "${log_path}"
     echo " == Shell script creating dump_text.txt output for parallel launch of Python scripts == " >> "${log_path}"
 
-    echo " == Launching GNU parallel to run muliple Python3 scripts for encoding == " >> "${log_path}"
-    grep '/mnt/' "${dump_to}batch_transcode_ofcom_ffv1_v210_dump_text.txt" | sort -u | parallel --jobs 3 "${PY3_ENV} $python_script {}"
+    echo " == Launching one Python3 script to run stage pipeline for all files == " >> "${log_path}"
+    grep '/mnt/' "${dump_to}batch_transcode_ofcom_ffv1_v210_dump_text.txt" | sort -u | ${PY3_ENV} $python_script -
 
     echo " ========================= SHELL SCRIPT END ========================== $date_FULL" >> "${log_path}"
   else
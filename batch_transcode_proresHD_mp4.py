@@ -1,10 +1,11 @@
 #!/usr/bin/env LANG=en_UK.UTF-8 /usr/local/bin/python3
 
 '''
-**** SCRIPT TO RUN WITH START.SH SCRIPT, TO POPULATE SYS.ARGV[1] ****
+**** SCRIPT TO RUN WITH START.SH SCRIPT, TO POPULATE SYS.ARGV[1:] ****
 ProRes mov mediaconch policy check, and transcode to h.264 mp4:
-1. Shell script populates list with .mov files passes one at
-   a time to this Python script from GNU parallel
+1. Shell script populates list with .mov files and passes the list
+   on stdin to this Python script, which works through them in one
+   process, JOBS at a time (batch_mode.py)
 2. Checks each file against MediaConch prores policy
    If it passes:
      i. Initiates FFmpeg subprocess command
@@ -15,30 +16,37 @@ ProRes mov mediaconch policy check, and transcode to h.264 mp4:
 3. Successful mp4 compared to basic mediaconch policy (is file whole)
    If it passes:
      i. Moves mp4 to mp4_completed/ folder
-     ii. Copies ProRes from Grack_h22 to Grack_f47, md5sum checks
-         and if successful deletes original in Grack_h22. If not retries once.
+     ii. Copies ProRes from Grack_h22 to Grack_f47 in a single read, verifying
+         each chunk of the copy as it is written and recopying only chunks that
+         differ. If successful deletes original in Grack_h22.
    If it fails:
      i. Deletes mp4 and leaves ProRes for repeat attempt
 
-NOTE:  Needs temporary step that skip rsync and moves to local 'copy'
-       folder. I/O waits prevent script completion/progress
-
 2021
 '''
 
 import os
 import subprocess
-import shutil
 import logging
 import sys
 import datetime
 
+# Local import
+from file_mover import verified_move, verified_copy
+import io_governor
+import process_supervisor
+import file_lease
+import batch_mode
+from transcode_calibration import get_profile
+
 # Global variables
 DESTINATION = os.environ['FILM_H22_DEST']
 MOV_POLICY = os.environ['POLICY_FILM_H22']
 MP4_POLICY = os.environ['POLICY_MP4']
 LOG = os.environ['SCRIPT_LOG']
-TODAY = datetime.date.today()
+CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+PROFILE = get_profile('prores_mp4')
+JOBS = PROFILE.get('jobs', 2)
 
 # Setup logging
 logger = logging.getLogger('batch_transcode_proresHD_mp4')
@@ -48,17 +56,12 @@ hdlr.setFormatter(formatter)
 logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
 
-logger.info("================== START ProRes mov to mp4 transcode START ==================")
-
 def check_control():
     '''
     Check control json for downtime requests
+    Returns False if no new transcodes should start
     '''
-    with open(CONTROL_JSON) as control:
-        j = json.load(control)
-        if not j['ofcom_transcode']:
-            logger.info('Script run prevented by downtime_control.json. Script exiting.')
-            sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    return batch_mode.control_flag(CONTROL_JSON, 'ofcom_transcode')
 
 
 def set_output_path(file_path, use):
@@ -130,11 +133,14 @@ def create_ffmpeg_command(file_path):
 
     output_fullpath = set_output_path(file_path, 'transcode')
 
+    # Decode and encode threads from transcode_calibration.py profile where calibrated
+    threads = ["-threads", str(PROFILE['threads'])] if PROFILE.get('threads') else []
+
     ffmpeg_program_call = [
         "ffmpeg"
     ]
 
-    input_video_file = [
+    input_video_file = threads + [
         "-i", file_path,
         "-nostdin"
     ]
@@ -147,7 +153,7 @@ def create_ffmpeg_command(file_path):
         "-c:v", "libx264",
         "-preset",  "slow",
         "-pix_fmt", "yuv420p"
-    ]
+    ] + threads
 
     crf_settings = [
         "-crf", "28"
@@ -174,7 +180,7 @@ def conformance_check(file_path, policy):
         file_path
     ]
 
-    result = subprocess.check_output(mediaconch_cmd)
+    result = process_supervisor.check_output(mediaconch_cmd)
     result = str(result)
 
     if 'N/A!' in result or 'pass!' not in result:
@@ -190,55 +196,88 @@ def fail_log(fail_log_path, file_path, message):
     message = str(message)
     if "failures/" in fail_log_path:
         with open(fail_log_path, 'a+') as log_data:
-            log_data.write("================= {} ================ {}\n".format(file_path, TODAY))
+            log_data.write("================= {} ================ {}\n".format(file_path, datetime.date.today()))
             log_data.write(message)
             log_data.write("\n")
 
 
-def md5_check(file_path1, file_path2):
+def relocate_prores(file_path, new_mov_path):
     '''
-    Makes MD5s and checks if they are the same
+    Copy ProRes from Grack_h22 to Grack_f47 in a single read,
+    verifying each chunk of the copy as it is written and
+    recopying only differing chunks. Returns 'MATCH' or 'FAIL'
     '''
-    path1 = os.path.split(file_path1)
-    filename1, ext = os.path.splitext(path1[1])
-    path2 = os.path.split(file_path2)
-    filename2, ext = os.path.splitext(path2[1])
+    try:
+        logger.info("relocate_prores(): Beginning verified copy of %s to %s", file_path, new_mov_path)
+        dst, checksum, mb_per_sec, repaired = verified_copy(file_path, new_mov_path)
+    except OSError as err:
+        logger.warning("relocate_prores(): Verified copy failed for %s\n%s", file_path, err)
+        return 'FAIL'
 
-    md5_file1 = [
-        'md5sum', file_path1
-    ]
+    logger.info("relocate_prores(): MD5 checksums match! %s copied to %s at %s MB/s", checksum, dst, mb_per_sec)
+    if repaired:
+        logger.warning("relocate_prores(): %s chunks differed on first copy and were repaired", repaired)
+    return 'MATCH'
 
-    try:
-        logger.info("Beginning MD5 generation for ProRes file %s", file_path1)
-        check1 = subprocess.check_output(md5_file1)
-        check1 = str(check1)
-    except (subprocess.CalledProcessError, Exception) as err:
-        logger.exception("MD5 command failure: %s\n%s", file_path1, err)
-
-    md5_file2 = [
-        'md5sum', file_path2
-    ]
 
-    try:
-        logger.info("Beginning MD5 generation for ProRes file %s", file_path2)
-        check2 = subprocess.check_output(md5_file2)
-        check2 = str(check2)
-    except (subprocess.CalledProcessError, Exception) as err:
-        logger.exception("MD5 command failure: %s\n%s", file_path2, err)
-
-    if check1[2:36] == check2[2:36]:
-        logger.info("MD5 checksums match! ProRes1: %s ProRes2: %s", check1[2:36], check2[2:36])
-        return 'MATCH'
-    else:
-        logger.warning("MD5 checksums DO NOT MATCH %s and %s", check1, check2)
-        return 'FAIL'
+def process_file(file_path):
+    '''
+    Checks one ProRes against mediaconch policy, transcodes to
+    H.264 mp4 and triggers ProRes/MP4 clean up
+    '''
+    with file_lease.held(file_path) as lease:
+        if lease is None:
+            logger.info("SKIPPING: %s is leased by another run or host. %s", file_path, file_lease.describe(file_path))
+            return
+        if not file_path.endswith(".mov"):
+            logger.info("%s - Skipping as this is not a .mov file", file_path)
+            return
+        result = conformance_check(file_path, MOV_POLICY)
+        if 'PASS!' in result:
+            logger.info("MediaConch policy pass: %s", file_path)
+            logger.info("Beginning FFmpeg transcode to H.264 mp4")
+            ffmpeg_call = []
+            ffmpeg_call = create_ffmpeg_command(file_path)
+            # FFmpeg encoding begins
+            try:
+                with io_governor.mount_streams(file_path, ffmpeg_call[-1]):
+                    process_supervisor.call(ffmpeg_call, label=file_path)
+            except subprocess.TimeoutExpired:
+                # Stalled and stopped by process_supervisor, remove partial
+                # MP4 and leave ProRes for next run
+                logger.warning("FFmpeg stalled and was stopped for %s, partial MP4 removed", file_path)
+                if os.path.isfile(ffmpeg_call[-1]):
+                    os.remove(ffmpeg_call[-1])
+                raise
+            except Exception:
+                logger.exception("FFmpeg command failed: %s", ffmpeg_call)
+                raise
+
+        elif 'FAIL!' in result:
+            fail_mov_path = set_output_path(file_path, 'fail')
+            trim = os.path.split(file_path)
+            fail_log_path = set_output_path(trim[0], 'log')
+            fail_log(fail_log_path, fail_mov_path, result)
+            logger.warning("%s - failed Mediaconch policy. Moving to failures/ folder.", file_path)
+            # Move prores to failures/ path
+            try:
+                verified_move(file_path, fail_mov_path)
+                logger.info("ProRes moved to failed/ and log appended.")
+            except Exception:
+                logger.exception("Unable to move %s to %s", file_path, fail_mov_path)
+            return
+
+        # Clean up after encoding
+        clean_up(file_path)
+    logger.info("ProRes <%s> to MP4 transcode complete", file_path)
 
 
 def main():
     '''
-    Script receives sys.argv from GNU parallel list grep and processes one ProRes from list
+    Script receives paths from start script list (sys.argv[1:]), as files,
+    folders, text file lists or '-' for a list on stdin, and processes each
+    ProRes in one process with JOBS encoding at once
     '''
-    check_control()
     if len(sys.argv) < 2:
         print(
             "SCRIPT EXITING: Error with shell script input. Please input:\n \
@@ -247,42 +286,16 @@ def main():
         logger.warning("SCRIPT EXITING: Error with shell script input. Please input:\n \
                         python3 batch_transcode_proresHD_mp4.py /path_to_file/file.mov")
         sys.exit()
-    else:
-        file_path = sys.argv[1]
-        if file_path.endswith(".mov"):
-            result = conformance_check(file_path, MOV_POLICY)
-            if 'PASS!' in result:
-                logger.info("MediaConch policy pass: %s", file_path)
-                logger.info("Beginning FFmpeg transcode to H.264 mp4")
-                ffmpeg_call = []
-                ffmpeg_call = create_ffmpeg_command(file_path)
-                # FFmpeg encoding begins
-                try:
-                    subprocess.call(ffmpeg_call)
-                except Exception:
-                    logger.exception("FFmpeg command failed: %s", ffmpeg_call)
-                    raise
 
-            elif 'FAIL!' in result:
-                fail_mov_path = set_output_path(file_path, 'fail')
-                trim = os.path.split(file_path)
-                fail_log_path = set_output_path(trim[0], 'log')
-                fail_log(fail_log_path, fail_mov_path, result)
-                logger.warning("%s - failed Mediaconch policy. Moving to failures/ folder.", file_path)
-                # Move prores to failures/ path
-                try:
-                    shutil.move(file_path, fail_mov_path)
-                    logger.info("ProRes moved to failed/ and log appended. Script exiting!")
-                except Exception:
-                    logger.exception("Unable to move %s to %s. Script exiting", file_path, fail_mov_path)
-                sys.exit()
-        else:
-            logger.info("%s - Skipping as this is not a .mov file", file_path)
-
-        # Clean up after encoding
-        clean_up(file_path)
-
-    logger.info("================== END ProRes <%s> to MP4 transcode END ==================", file_path)
+    logger.info("================== START ProRes mov to mp4 transcode START ==================")
+    if not check_control():
+        logger.info('Script run prevented by downtime_control.json. Script exiting.')
+        sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    file_list = batch_mode.read_paths(sys.argv[1:], ('.mov',), recursive=True)
+    logger.info("Batch of %s files received, running %s at once", len(file_list), JOBS)
+    counts = batch_mode.run_batch(file_list, process_file, JOBS, logger, keep_going=check_control)
+    logger.info("Batch complete: %s files run, %s failed, %s left for next run", counts['run'], counts['failed'], counts['left'])
+    logger.info("================== END ProRes mov to MP4 transcode END ==================")
 
 
 def clean_up(file_path):
@@ -300,21 +313,25 @@ def clean_up(file_path):
             logger.info("clean_up(): PASS! MP4 policy check")
             mp4_complete_path = set_output_path(file_path, 'mp4')
             try:
-                shutil.move(new_file, mp4_complete_path)
-                logger.info("clean_up(): Moving %s to mp4_completed folder: %s", new_file, mp4_complete_path)
+                _, _, mb_per_sec = verified_move(new_file, mp4_complete_path)
+                logger.info("clean_up(): Moving %s to mp4_completed folder: %s (%s MB/s)", new_file, mp4_complete_path, mb_per_sec)
             except Exception:
                 logger.warning("clean_up(): Unable to move %s to mp4_completed/ folder: %s", new_file, mp4_complete_path)
             # Move ProRes move to success/ path on Grack_F47
-#            logger.info("clean_up(): MP4 creation successful. Moving ProRes to Grack_F47")
-#            new_mov_path = set_output_path(file_path, 'success')
-#            rsync(file_path, new_mov_path)
-#            test = md5_check(file_path, new_mov_path)
-            move_to_copy = set_output_path(file_path, 'copy')
-            logger.info("Moving MOV to copy folder: %s:", move_to_copy)
-            try:
-                shutil.move(file_path, move_to_copy)
-            except Exception:
-                logger.exception("Unable to move %s to %s", file_path, move_to_copy)
+            logger.info("clean_up(): MP4 creation successful. Moving ProRes to Grack_F47")
+            new_mov_path = set_output_path(file_path, 'success')
+            test = relocate_prores(file_path, new_mov_path)
+            if 'MATCH' in test:
+                logger.info("clean_up(): Deleting ProRes %s following verified copy", file_path)
+                try:
+                    os.remove(file_path)
+                except Exception:
+                    logger.exception("clean_up(): Unable to delete %s", file_path)
+            else:
+                trim = os.path.split(file_path)
+                fail_log_path = set_output_path(trim[0], 'log')
+                fail_log(fail_log_path, file_path, f"Verified copy to {new_mov_path} failed. ProRes left in place")
+                logger.warning("clean_up(): ProRes %s left in place after failed verified copy", file_path)
 
         elif 'FAIL!' in result:
             # Failed. Delete MP4 and leave ProRes to try again
@@ -324,7 +341,7 @@ def clean_up(file_path):
             fail_log(fail_log_path, fail_mp4_path, result)
             logger.warning("clean_up(): FAILED: %s failed the MP4 policy checker. Moving to failures.", new_file)
             try:
-                shutil.move(new_file, fail_mp4_path)
+                verified_move(new_file, fail_mp4_path)
             except Exception:
                 logger.exception("Unable to move %s to %s", new_file, fail_mp4_path)
         else:
@@ -334,21 +351,5 @@ def clean_up(file_path):
         logger.info("clean_up(): NOT AN MP4 FILE: %s SKIPPING", new_file)
 
 
-def rsync(file_path1, file_path2):
-    '''
-    Move ProRes from Grack_h22 to Grack_f47 using rsync
-    '''
-    rsync_cmd = [
-        'rsync', '-avh',
-        file_path1, file_path2
-    ]
-
-    try:
-        logger.info("rsync(): Beginning rsync move of file %s to %s", file_path1, file_path2)
-        subprocess.call(rsync_cmd)
-    except Exception:
-        logger.exception("rsync(): Move command failure: %s to %s", file_path1, file_path2)
-
-
 if __name__ == "__main__":
     main()
@@ -39,7 +39,7 @@ if [ -s "${dump_to}proresHD_dump_text.txt" ]
     echo " == Start batch_transcode_proresHD_mp4 in folder path - $date_FULL == " >> "${log}batch_transcode_proresHD_mp4.log"
     echo " == Shell script creating proresHD_dump_text.txt for folder path - $date_FULL == " >> "${log}batch_transcode_proresHD_mp4.log"
 
-    grep '/mnt/' "${dump_to}proresHD_dump_text.txt" | parallel --jobs 2 "python3 ${python}batch_transcode_proresHD_mp4.py {}"
+    grep '/mnt/' "${dump_to}proresHD_dump_text.txt" | python3 ${python}batch_transcode_proresHD_mp4.py -
 
     echo " ===================== SHELL SCRIPT END ======================== " >> "${log}batch_transcode_proresHD_mp4.log"
   else
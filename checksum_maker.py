@@ -11,15 +11,39 @@ Actions of the script:
     iii. Returns the MD5 checksum, formatted hexdigest / Returns None if exception raised
 4. The MD5 checksum is passed back to the calling script
 
+Batch mode, for manifesting many files in one process:
+    python3 checksum_maker.py batch <directory|glob|file_list.txt> <manifest.md5>
+1. Builds a list of files from a directory walk, glob pattern or text
+   file list (one path per line).
+2. Reads any existing manifest and skips paths already listed there,
+   so an interrupted run resumes where it left off.
+3. Groups the files by mount point (qnap_08, qnap_10, grack etc) and
+   hashes each group in its own worker pool, sized per mount, so each
+   NAS is kept busy without overloading any single one.
+4. Appends each checksum to the manifest as it completes, in md5sum
+   compatible format ('<md5>  <path>'), for 'md5sum -c' checks.
+
 Joanna White 2023
 Python 3
 '''
 
 import os
 import sys
+import glob
 import hashlib
+import threading
+import concurrent.futures
 import tenacity
 
+# Concurrent hashing streams permitted per mount, override with
+# CHECKSUM_MOUNT_LIMITS="qnap_08=4,qnap_10=4,grack=6"
+MOUNT_LIMITS = {
+    'qnap_08': 4,
+    'qnap_10': 4,
+    'grack': 6
+}
+DEFAULT_LIMIT = 2
+
 
 def md5_65536(file):
     '''
@@ -66,5 +90,140 @@ def make_checksum(filepath):
     return checksum
 
 
+def get_mount_limits():
+    '''
+    Return mount limits dictionary, updated
+    from environment variable if present
+    '''
+    limits = dict(MOUNT_LIMITS)
+    env_limits = os.environ.get('CHECKSUM_MOUNT_LIMITS')
+    if not env_limits:
+        return limits
+
+    for item in env_limits.split(','):
+        if '=' not in item:
+            continue
+        mount, limit = item.split('=', 1)
+        try:
+            limits[mount.strip().lower()] = int(limit)
+        except ValueError:
+            print(f"Skipping invalid mount limit: {item}")
+    return limits
+
+
+def get_mount(filepath, limits=None):
+    '''
+    Match filepath to a named mount from limits,
+    otherwise return the mount point of the path
+    '''
+    if limits is None:
+        limits = MOUNT_LIMITS
+    for mount in limits:
+        if mount in filepath.lower():
+            return mount
+
+    path = os.path.abspath(filepath)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def build_file_list(source):
+    '''
+    Accepts directory, text file list
+    or glob pattern and returns file paths
+    '''
+    if os.path.isdir(source):
+        file_list = []
+        for root, _, files in os.walk(source):
+            for file in files:
+                file_list.append(os.path.join(root, file))
+    elif os.path.isfile(source):
+        with open(source, 'r') as data:
+            file_list = [x.rstrip('\n') for x in data.readlines() if x.strip()]
+    else:
+        file_list = glob.glob(source, recursive=True)
+
+    return sorted(x for x in set(file_list) if os.path.isfile(x))
+
+
+def read_manifest(manifest):
+    '''
+    Return paths already checksummed in an
+    md5sum format manifest, for resuming runs
+    '''
+    completed = set()
+    if not os.path.isfile(manifest):
+        return completed
+
+    with open(manifest, 'r') as data:
+        for line in data:
+            line = line.rstrip('\n')
+            if len(line) > 34 and line[32:34] == '  ':
+                completed.add(line[34:])
+    return completed
+
+
+def batch_checksum(source, manifest):
+    '''
+    Checksum all files found in source, with worker pool
+    per mount point. Writes each result to manifest as completed
+    '''
+    limits = get_mount_limits()
+    completed = read_manifest(manifest)
+    file_list = [x for x in build_file_list(source) if x not in completed]
+    print(f"Files to checksum: {len(file_list)} ({len(completed)} already in manifest)")
+    if not file_list:
+        return []
+
+    mounts = {}
+    for filepath in file_list:
+        mounts.setdefault(get_mount(filepath, limits), []).append(filepath)
+
+    lock = threading.Lock()
+    failures = []
+
+    def write_result(filepath, checksum):
+        with lock:
+            if not checksum:
+                failures.append(filepath)
+                print(f"Checksum failed: {filepath}")
+                return
+            with open(manifest, 'a') as data:
+                data.write(f"{checksum}  {filepath}\n")
+                data.flush()
+                os.fsync(data.fileno())
+
+    pools = []
+    futures = {}
+    for mount, paths in mounts.items():
+        workers = limits.get(mount, DEFAULT_LIMIT)
+        print(f"Mount {mount}: {len(paths)} files with {workers} workers")
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        pools.append(pool)
+        for filepath in paths:
+            futures[pool.submit(make_checksum, filepath)] = filepath
+
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            filepath = futures[future]
+            try:
+                checksum = future.result()
+            except Exception as err:
+                print(err)
+                checksum = None
+            write_result(filepath, checksum)
+    finally:
+        for pool in pools:
+            pool.shutdown(wait=True)
+
+    return failures
+
+
 if __name__ == "__main__":
-    make_checksum(sys.argv[1])
+    if len(sys.argv) == 4 and sys.argv[1] == 'batch':
+        failed = batch_checksum(sys.argv[2], sys.argv[3])
+        if failed:
+            sys.exit(f"Checksum failures for {len(failed)} files")
+    else:
+        make_checksum(sys.argv[1])
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, INDEXED STORE OF WHOLE FILE CHECKSUMS **
+Replaces appending 'path, checksum' lines to the flat checksum_manifest.log
+with an SQLite database, so concurrent writers never interleave and any
+look up is an index search rather than a scan of the whole log.
+
+Actions of the module:
+1. Opens (or creates) the database in WAL journal mode with a busy
+   timeout, so many concurrent transcode scripts can append at once.
+2. add_checksum() writes path, checksum and timestamp in a single
+   transaction, and returns any other paths holding the same checksum.
+3. Look ups are available by path, by checksum or by date range, and
+   find_duplicates() returns every checksum recorded against more than
+   one path.
+4. export_text() writes the old 'path, checksum' text format, and
+   import_text() loads an existing checksum_manifest.log.
+
+NOTE: SQLite WAL mode needs the database on a local disk, not an NFS
+      mount. The default location is alongside the script logs.
+
+Command line use:
+    python3 checksum_manifest.py import <checksum_manifest.log>
+    python3 checksum_manifest.py export <output.log>
+    python3 checksum_manifest.py path <filepath>
+    python3 checksum_manifest.py checksum <md5>
+    python3 checksum_manifest.py date <YYYY-MM-DD> [<YYYY-MM-DD>]
+    python3 checksum_manifest.py duplicates
+
+2026
+Python 3
+'''
+
+import os
+import sys
+import sqlite3
+import datetime
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+CHECKSUM_DB = os.environ.get('CHECKSUM_DB', os.path.join(LOG, 'checksum_manifest.db'))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS manifest (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        checksum TEXT NOT NULL,
+        created TEXT,
+        UNIQUE (path, checksum)
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_manifest_path ON manifest (path)',
+    'CREATE INDEX IF NOT EXISTS idx_manifest_checksum ON manifest (checksum)',
+    'CREATE INDEX IF NOT EXISTS idx_manifest_created ON manifest (created)'
+]
+
+
+def get_connection(db_path=None):
+    '''
+    Open database connection in WAL mode,
+    creating tables and indexes where needed
+    '''
+    if db_path is None:
+        db_path = CHECKSUM_DB
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=60000')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def add_checksum(fpath, checksum, db_path=None):
+    '''
+    Write path and checksum in one transaction
+    Returns any other paths holding the same checksum
+    '''
+    created = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn = get_connection(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT OR IGNORE INTO manifest (path, checksum, created) VALUES (?, ?, ?)',
+            (fpath, checksum.lower(), created)
+        )
+        rows = conn.execute(
+            'SELECT DISTINCT path FROM manifest WHERE checksum = ? AND path != ?',
+            (checksum.lower(), fpath)
+        ).fetchall()
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    return [x[0] for x in rows]
+
+
+def lookup_path(fpath, db_path=None):
+    '''
+    Return (path, checksum, created) entries for path
+    '''
+    conn = get_connection(db_path)
+    try:
+        return conn.execute(
+            'SELECT path, checksum, created FROM manifest WHERE path = ? ORDER BY created',
+            (fpath,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def lookup_checksum(checksum, db_path=None):
+    '''
+    Return (path, checksum, created) entries for checksum
+    '''
+    conn = get_connection(db_path)
+    try:
+        return conn.execute(
+            'SELECT path, checksum, created FROM manifest WHERE checksum = ? ORDER BY created',
+            (checksum.lower(),)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def lookup_date(start, end=None, db_path=None):
+    '''
+    Return entries created between start and end dates
+    (YYYY-MM-DD). End date defaults to start, inclusive
+    '''
+    if end is None:
+        end = start
+    end = datetime.date.fromisoformat(end) + datetime.timedelta(days=1)
+    conn = get_connection(db_path)
+    try:
+        return conn.execute(
+            'SELECT path, checksum, created FROM manifest WHERE created >= ? AND created < ? ORDER BY created',
+            (start, end.isoformat())
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def find_duplicates(db_path=None):
+    '''
+    Return dictionary of checksums found
+    against more than one path
+    '''
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            '''SELECT checksum, path FROM manifest WHERE checksum IN (
+                   SELECT checksum FROM manifest GROUP BY checksum
+                   HAVING COUNT(DISTINCT path) > 1
+               ) ORDER BY checksum, path'''
+        ).fetchall()
+    finally:
+        conn.close()
+
+    duplicates = {}
+    for checksum, path in rows:
+        duplicates.setdefault(checksum, []).append(path)
+    return duplicates
+
+
+def export_text(output, db_path=None):
+    '''
+    Write all entries to output in the
+    checksum_manifest.log 'path, checksum' format
+    '''
+    conn = get_connection(db_path)
+    count = 0
+    try:
+        with open(output, 'w') as log_data:
+            for path, checksum in conn.execute('SELECT path, checksum FROM manifest ORDER BY id'):
+                log_data.write(f"{path}, {checksum}\n")
+                count += 1
+    finally:
+        conn.close()
+    return count
+
+
+def import_text(log_path, db_path=None):
+    '''
+    Load an existing checksum_manifest.log into the
+    database. Entries have no date so created is left empty
+    '''
+    entries = []
+    with open(log_path, 'r') as log_data:
+        for line in log_data:
+            if ', ' not in line:
+                continue
+            path, checksum = line.rstrip('\n').rsplit(', ', 1)
+            if len(checksum) == 32:
+                entries.append((path, checksum.lower()))
+
+    conn = get_connection(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany('INSERT OR IGNORE INTO manifest (path, checksum) VALUES (?, ?)', entries)
+        conn.execute('COMMIT')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return len(entries)
+
+
+def main():
+    '''
+    Command line access to manifest store
+    '''
+    if len(sys.argv) < 2:
+        sys.exit("Usage: checksum_manifest.py import|export|path|checksum|date|duplicates <argument>")
+
+    action = sys.argv[1]
+    if action == 'duplicates':
+        for checksum, paths in find_duplicates().items():
+            print(checksum)
+            for path in paths:
+                print(f"\t{path}")
+        return
+    if len(sys.argv) < 3:
+        sys.exit(f"Action '{action}' requires an argument")
+
+    if action == 'import':
+        print(f"Imported {import_text(sys.argv[2])} entries from {sys.argv[2]}")
+    elif action == 'export':
+        print(f"Exported {export_text(sys.argv[2])} entries to {sys.argv[2]}")
+    elif action in ('path', 'checksum', 'date'):
+        if action == 'path':
+            rows = lookup_path(sys.argv[2])
+        elif action == 'checksum':
+            rows = lookup_checksum(sys.argv[2])
+        else:
+            rows = lookup_date(*sys.argv[2:4])
+        for path, checksum, created in rows:
+            print(f"{created}\t{checksum}\t{path}")
+    else:
+        sys.exit(f"Unknown action: {action}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, LIVE DOWNTIME CONTROL OF RUNNING JOBS **
+downtime_control.json is read when a script starts, so a multi hour
+FFmpeg already running can't be paused, slowed or drained when storage
+maintenance is announced. This module watches the JSON for changes and
+gives transcode_scheduler.py a mode and job limit per workflow, which it
+applies to its running jobs within seconds.
+
+The existing true/false keys (rna_transcode, ofcom_transcode, h22_transcode,
+power_off_all) are unchanged. Modes and limits go in a "control_plane"
+object keyed by scheduler workflow name, or "all" for every workflow:
+    "control_plane": {
+        "all": {"mode": "run"},
+        "h22_ffv1_v210": {"mode": "pause"},
+        "ofcom_ffv1_v210": {"mode": "run", "jobs": 1}
+    }
+Modes:
+    run    admit jobs as normal (default)
+    hold   admit no new jobs, running jobs continue
+    pause  admit no new jobs and SIGSTOP running jobs' process groups
+           (FFmpeg included), which are sent SIGCONT on return to run
+    drain  admit no new jobs, hand unstarted work back (ie, work queue
+           claims) and report when the last running job has finished
+"jobs" lowers a workflow's concurrency straight away: running jobs over
+the limit (newest first) are stopped and continued as slots free.
+A workflow's own entry overrides "all" and the more restrictive mode wins.
+
+Actions of watch_control():
+1. Checks the JSON's modification time and size every POLL seconds.
+2. On change reads it, ignoring unreadable or half written JSON.
+3. Passes the new contents to callback(data).
+
+Command line use (writes the JSON atomically, keeping other keys):
+    python3 control_plane.py set <workflow|all> <run|hold|pause|drain> [<jobs>]
+    python3 control_plane.py show
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import signal
+import asyncio
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+MODES = ('run', 'hold', 'drain', 'pause')
+POLL = 2
+
+
+def read_control(path=CONTROL_JSON):
+    '''
+    Return control JSON contents, or None if unreadable
+    '''
+    try:
+        with open(path, 'r') as control:
+            return json.load(control)
+    except (OSError, ValueError):
+        return None
+
+
+def workflow_control(data, workflow):
+    '''
+    Return (mode, job limit or None) for workflow,
+    the more restrictive of its own and 'all' entries
+    '''
+    entries = (data or {}).get('control_plane', {})
+    mode = 'run'
+    jobs = None
+    for key in ('all', workflow):
+        entry = entries.get(key)
+        if not isinstance(entry, dict):
+            continue
+        if entry.get('mode') in MODES and MODES.index(entry['mode']) > MODES.index(mode):
+            mode = entry['mode']
+        try:
+            limit = int(entry['jobs'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        jobs = limit if jobs is None else min(jobs, limit)
+    return mode, jobs
+
+
+def signal_job(pid, sig):
+    '''
+    Send signal to job's process group, so FFmpeg and
+    other children stop or continue with the script
+    Returns False if the job has already exited
+    '''
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def stop_job(pid):
+    '''
+    Pause job and its children
+    '''
+    return signal_job(pid, signal.SIGSTOP)
+
+
+def continue_job(pid):
+    '''
+    Continue paused job and its children
+    '''
+    return signal_job(pid, signal.SIGCONT)
+
+
+async def watch_control(callback, stopping, path=CONTROL_JSON, interval=POLL):
+    '''
+    Call callback(data) with control JSON contents
+    at start and whenever the file changes
+    '''
+    last = None
+    while not stopping.is_set():
+        try:
+            stat = os.stat(path)
+            current = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            current = None
+        if current and current != last:
+            data = read_control(path)
+            if data is not None:
+                last = current
+                callback(data)
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def set_mode(workflow, mode, jobs=None, path=CONTROL_JSON):
+    '''
+    Write mode and job limit for workflow into control
+    JSON, keeping all other keys. Returns new contents
+    '''
+    data = read_control(path)
+    if data is None:
+        raise ValueError(f"Unable to read {path}")
+    entry = {'mode': mode}
+    if jobs is not None:
+        entry['jobs'] = int(jobs)
+    data.setdefault('control_plane', {})[workflow] = entry
+    tmp = f"{path}.partial"
+    with open(tmp, 'w') as control:
+        json.dump(data, control, indent=4)
+    os.replace(tmp, path)
+    return data
+
+
+def main():
+    '''
+    Command line mode change or display
+    '''
+    if len(sys.argv) < 2 or sys.argv[1] not in ('set', 'show'):
+        sys.exit("Usage: control_plane.py set <workflow|all> <run|hold|pause|drain> [<jobs>] | show")
+    if sys.argv[1] == 'set':
+        if len(sys.argv) < 4 or sys.argv[3] not in MODES:
+            sys.exit(f"Usage: control_plane.py set <workflow|all> <{'|'.join(MODES)}> [<jobs>]")
+        set_mode(sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None)
+    data = read_control()
+    if data is None:
+        sys.exit(f"Unable to read {CONTROL_JSON}")
+    print(json.dumps(data, indent=4))
+
+
+if __name__ == '__main__':
+    main()
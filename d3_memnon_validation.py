@@ -4,9 +4,13 @@
 Memnon workflow for Video Ops D3 FFV1 MKV returns
 
 1. Retrieve FFV1 MKVs from watch folder along with name matched XML
+   (only MKVs whose size/mtime are stable and whose XML has arrived),
+   or a single MKV path from sys.argv[1] when queued by transcode_scheduler
 2. Run checks, if fail move to failure folder with human log:
-    a. Create Hashlib MD5 and compare to MD5 in XML file
-    b. Run FFmpeg check against FFV1 for flipped bits / CRC difference
+    a. Read the MKV once, creating Hashlib MD5 while streaming the same
+       bytes into FFmpeg for flipped bits / CRC difference check.
+       Reading stops at the first CRC mismatch
+    b. Compare the MD5 to MD5 in XML file
     c. Validate file against MediaConch policy
     d. Possibly update PAR if needed (as per Bluefish metadata updating)
 3. MKV files are moved into new Splitting script workflow in QNAP-08
@@ -21,8 +25,9 @@ handled with a second MediaConch check for 576 height.
 # Global packages
 import os
 import sys
-import shutil
+import hashlib
 import logging
+import threading
 import subprocess
 from datetime import datetime
 import xmltodict
@@ -30,6 +35,10 @@ import xmltodict
 # Local packages
 sys.path.append(os.environ['CODE'])
 import utils
+from file_mover import verified_move
+import watch_folder
+import io_governor
+import file_lease
 
 # Vars
 LOG_PATH = os.environ['LOG_PATH']
@@ -39,6 +48,7 @@ FAILURES = os.path.join(ARRIVALS, 'failures')
 XML_FILES = os.path.join(ARRIVALS, 'xml_files')
 VALIDATE608 = os.path.join(os.environ['QNAP08_POLICIES'], 'videoops_mediaconch_policy_mkv_608.xml')
 VALIDATE576 = os.path.join(os.environ['QNAP08_POLICIES'], 'videoops_mediaconch_policy_mkv_576.xml')
+READ_SIZE = 16 * 1024 * 1024
 
 # Logging
 LOGGER = logging.getLogger('d3_memnon_validation')
@@ -59,7 +69,13 @@ def main():
         LOGGER.info('Script run prevented by downtime_control.json. Script exiting.')
         sys.exit('Script run prevented by downtime_control.json. Script exiting.')
 
-    mkv_list = [ x for x in os.listdir(ARRIVALS) if x.endswith(('.mkv', '.MKV'))]
+    if len(sys.argv) > 1:
+        # Single MKV queued by transcode_scheduler once it and its XML are complete
+        mkv_list = [os.path.basename(sys.argv[1])]
+    else:
+        mkv_paths = [os.path.join(ARRIVALS, x) for x in os.listdir(ARRIVALS) if x.endswith(('.mkv', '.MKV'))]
+        mkv_paths = [x for x in mkv_paths if os.path.isfile(os.path.splitext(x)[0] + '.xml')]
+        mkv_list = [os.path.basename(x) for x in watch_folder.stable_files(mkv_paths)]
     if len(mkv_list) > 0:
         LOGGER.info("---------- D3 MEMNON VALIDATION START ------------------------------")
     for mkv in mkv_list:
@@ -67,71 +83,84 @@ def main():
             LOGGER.info('Script run prevented by downtime_control.json. Script exiting.')
             sys.exit('Script run prevented by downtime_control.json. Script exiting.')
 
-        can_id = mkv.split('.')[0]
+        can_id = os.path.splitext(mkv)[0]
         xpath = os.path.join(ARRIVALS, f"{can_id}.xml")
         fpath = os.path.join(ARRIVALS, mkv)
-        LOGGER.info("New file to process: %s", fpath)
-
-        # Get file MD5
-        LOGGER.info("Generating local MD5 and comparing to XML supplied checksum")
-        local_hash = utils.create_md5_65536(fpath)
-        LOGGER.info("Local MD5 created: %s", local_hash)
-        xml_hash, duration = get_xml_hash(ARRIVALS, can_id)
-        if duration:
-            capture_duration_log(f"{can_id}.xml", duration)
-        if xml_hash is None:
-            LOGGER.warning("Failed to retrieve MD5 has from XML file for %s", mkv)
-            shutil.move(fpath, FAILURES)
-            shutil.move(xpath, FAILURES)
-            error_log(mkv, f"{mkv} file had no supplier XML.")
-            error_log(mkv, f"File MD5: {local_hash.lower()}")
-            error_log(mkv, "XML supplied MD5: Not found")
-            continue
-        if local_hash.lower() != xml_hash.lower():
-            LOGGER.warning("Moving MKV %s to failures path. Checksums do not match:\n%s\n%s", mkv, hash, xml_hash)
-            shutil.move(fpath, FAILURES)
-            shutil.move(xpath, FAILURES)
-            error_log(mkv, f"{mkv} file failed MD5 Checksum tests:")
-            error_log(mkv, f"File MD5: {local_hash.lower()}")
-            error_log(mkv, f"XML supplied MD5: {xml_hash.lower()}")
-            continue
-        LOGGER.info("MKV %s passed MD5 checksum comparison:\n%s\n%s", mkv, local_hash.lower(), xml_hash.lower())
-
-        # Run FFV1 report and see if CRC match
-        LOGGER.info("Start FFmpeg report for FFV1 CRC checksum health")
-        ffmpeg_report = scan_ffv1_codec(fpath)
-        if 'slice CRC mismatch' in str(ffmpeg_report):
-            LOGGER.warning("Moving MKV %s to failures path. CRC checksum mismatch in MKV file. See local error log for timestamps", mkv)
-            error_log(mkv, f"FFV1 report revealed Slice CRC checksum mismatches for file {mkv}:")
-            mismatches = get_crc_mismatch(ffmpeg_report)
-            for mis in mismatches:
-                error_log(mkv, f"CRC mismatch: {mis}")
-            # Move to failures
-            shutil.move(fpath, FAILURES)
-            shutil.move(xpath, FAILURES)
-            continue
-        LOGGER.info("MKV %s passed Slice CRC checks", mkv)
-
-        # Mediaconch checking
-        LOGGER.info("Comparing file to 608 OFCOM MediaConch Policy")
-        confirm608 = utils.get_mediaconch(fpath, VALIDATE608)
-        if not confirm608:
-            LOGGER.warning("MKV %s failed 608 policy: \n%s", mkv, confirm608)
-            LOGGER.info("Comparing file to 576 OFCOM MediaConch Policy")
-            confirm576 = utils.get_mediaconch(fpath, VALIDATE576)
-            if not confirm576:
-                LOGGER.warning("MKV %s failed 576 policy:\n%s", mkv, confirm576)
-                LOGGER.warning("Moving MKV %s to failures path.", mkv)
-                shutil.move(fpath, FAILURES)
-                shutil.move(xpath, FAILURES)
-                error_log(mkv, f"Mediaconch failure for 608 policy:\n{confirm608}")
-                error_log(mkv, f"Mediaconch failure for 608 policy:\n{confirm576}")
+        with file_lease.held(fpath) as lease:
+            if lease is None:
+                LOGGER.info("Skipping %s, leased by another run or host. %s", fpath, file_lease.describe(fpath))
+                continue
+            LOGGER.info("New file to process: %s", fpath)
+
+            xml_hash, duration = get_xml_hash(ARRIVALS, can_id)
+            if duration:
+                capture_duration_log(f"{can_id}.xml", duration)
+            if xml_hash is None:
+                LOGGER.warning("Failed to retrieve MD5 has from XML file for %s", mkv)
+                verified_move(fpath, FAILURES)
+                verified_move(xpath, FAILURES)
+                error_log(mkv, f"{mkv} file had no supplier XML.")
+                error_log(mkv, "File MD5: Not generated")
+                error_log(mkv, "XML supplied MD5: Not found")
                 continue
-        LOGGER.info("MKV %s passed Mediaconch checks", mkv)
 
-        LOGGER.info("Moving MKV %s into Memnon splitting path: %s", mkv, DEPARTURES)
-        shutil.move(fpath, os.path.join(DEPARTURES, mkv))
-        shutil.move(xpath, os.path.join(XML_FILES, f"{can_id}.xml"))
+            # Single read of file for MD5 and FFV1 CRC decode
+            LOGGER.info("Generating local MD5 and FFmpeg report for FFV1 CRC checksum health")
+            with io_governor.mount_streams(fpath) as tokens:
+                local_hash, ffmpeg_report, returncode = hash_and_scan_ffv1(fpath, tokens)
+            if 'slice CRC mismatch' in ffmpeg_report:
+                LOGGER.warning("Moving MKV %s to failures path. CRC checksum mismatch in MKV file. See local error log for timestamps", mkv)
+                error_log(mkv, f"FFV1 report revealed Slice CRC checksum mismatches for file {mkv}:")
+                mismatches = get_crc_mismatch(ffmpeg_report)
+                for mis in mismatches:
+                    error_log(mkv, f"CRC mismatch: {mis}")
+                # Move to failures
+                verified_move(fpath, FAILURES)
+                verified_move(xpath, FAILURES)
+                continue
+            if local_hash is None or returncode != 0:
+                LOGGER.warning("Moving MKV %s to failures path. FFmpeg could not decode file:\n%s", mkv, ffmpeg_report[-2000:])
+                verified_move(fpath, FAILURES)
+                verified_move(xpath, FAILURES)
+                error_log(mkv, f"FFmpeg failed to decode file {mkv} (exit code {returncode}):\n{ffmpeg_report[-2000:]}")
+                continue
+            LOGGER.info("Local MD5 created: %s", local_hash)
+            if local_hash.lower() != xml_hash.lower():
+                LOGGER.warning("Moving MKV %s to failures path. Checksums do not match:\n%s\n%s", mkv, local_hash, xml_hash)
+                verified_move(fpath, FAILURES, local_hash)
+                verified_move(xpath, FAILURES)
+                error_log(mkv, f"{mkv} file failed MD5 Checksum tests:")
+                error_log(mkv, f"File MD5: {local_hash.lower()}")
+                error_log(mkv, f"XML supplied MD5: {xml_hash.lower()}")
+                continue
+            LOGGER.info("MKV %s passed MD5 checksum comparison:\n%s\n%s", mkv, local_hash.lower(), xml_hash.lower())
+            LOGGER.info("MKV %s passed Slice CRC checks", mkv)
+
+            # Mediaconch checking
+            LOGGER.info("Comparing file to 608 OFCOM MediaConch Policy")
+            confirm608 = utils.get_mediaconch(fpath, VALIDATE608)
+            if not confirm608:
+                LOGGER.warning("MKV %s failed 608 policy: \n%s", mkv, confirm608)
+                LOGGER.info("Comparing file to 576 OFCOM MediaConch Policy")
+                confirm576 = utils.get_mediaconch(fpath, VALIDATE576)
+                if not confirm576:
+                    LOGGER.warning("MKV %s failed 576 policy:\n%s", mkv, confirm576)
+                    LOGGER.warning("Moving MKV %s to failures path.", mkv)
+                    verified_move(fpath, FAILURES)
+                    verified_move(xpath, FAILURES)
+                    error_log(mkv, f"Mediaconch failure for 608 policy:\n{confirm608}")
+                    error_log(mkv, f"Mediaconch failure for 608 policy:\n{confirm576}")
+                    continue
+            LOGGER.info("MKV %s passed Mediaconch checks", mkv)
+
+            LOGGER.info("Moving MKV %s into Memnon splitting path: %s", mkv, DEPARTURES)
+            try:
+                new_path, _, mb_per_sec = verified_move(fpath, os.path.join(DEPARTURES, mkv), local_hash)
+                LOGGER.info("MKV moved and checksum verified: %s (%s MB/s)", new_path, mb_per_sec)
+            except OSError as err:
+                LOGGER.warning("Verified move failed for %s. Leaving in place:\n%s", fpath, err)
+                continue
+            verified_move(xpath, os.path.join(XML_FILES, f"{can_id}.xml"))
 
     LOGGER.info("---------- D3 MEMNON VALIDATION END --------------------------------")
 
@@ -180,24 +209,60 @@ def get_xml_hash(fpath, fname):
         return checksum, duration
 
 
-def scan_ffv1_codec(fpath):
+def hash_and_scan_ffv1(fpath, tokens=None):
     '''
-    Run FFmpeg report on fpath
-    Return any responses for errors
-    (turned off -report, to avoid generating log)
+    Read file once in large sequential chunks, updating MD5
+    and streaming the same bytes to FFmpeg stdin for FFV1 CRC
+    decode. Stops reading at the first slice CRC mismatch, or if
+    FFmpeg exits early. Returns (MD5 or None, FFmpeg report, exit code)
     '''
     cmd = [
-        'ffmpeg',
-        '-i', fpath,
+        'ffmpeg', '-hide_banner', '-nostats',
+        '-i', 'pipe:0',
         '-f', 'null', '-'
     ]
-    try:
-        ffmpeg_report = subprocess.run(cmd, shell=False, capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as err:
-        print(err)
-        return None
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    report = []
+    crc_error = threading.Event()
+
+    def read_report():
+        for line in proc.stderr:
+            line = line.decode('utf-8', errors='replace')
+            report.append(line)
+            if 'slice CRC mismatch' in line:
+                crc_error.set()
+
+    reader = threading.Thread(target=read_report, daemon=True)
+    reader.start()
+
+    hash_md5 = hashlib.md5()
+    complete = False
+    with open(fpath, 'rb', buffering=0) as data:
+        while not crc_error.is_set():
+            chunk = data.read(READ_SIZE)
+            if not chunk:
+                complete = True
+                break
+            hash_md5.update(chunk)
+            io_governor.throttle(tokens, len(chunk))
+            try:
+                proc.stdin.write(chunk)
+            except (BrokenPipeError, ValueError):
+                break
 
-    return ffmpeg_report
+    if crc_error.is_set():
+        proc.kill()
+        complete = False
+    try:
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    proc.wait()
+    reader.join()
+
+    if not complete or crc_error.is_set():
+        return None, ''.join(report), proc.returncode
+    return hash_md5.hexdigest(), ''.join(report), proc.returncode
 
 
 def get_crc_mismatch(ffmpeg_report):
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, FURTHER DELIVERABLES FROM ONE FFV1 DECODE **
+Partners needing V210 and ProRes masters had them made in two jobs:
+batch_transcode_h22_ffv1_v210.py decoded the FFV1 to write V210, then
+batch_transcode_h22_v210_prores.py read and decoded that V210 again to
+write ProRes. The FFV1 to V210 encode now writes every deliverable a
+collection needs from the one decode, through a split filter graph.
+
+Actions:
+1. requested() reads DELIVERABLES_JSON (deliverables.json in the script
+   log folder), which lists the deliverables each collection needs on
+   top of the V210 master, by a fragment of its path, eg:
+       {"/YFA/": ["prores"], "/SASE/": ["prores", "proxy"]}
+   Collections not listed get the V210 alone, as before.
+2. multi_output_call() turns the script's V210 FFmpeg call into one
+   with an output for each deliverable. The decoded frames pass through
+   the V210 call's filter (setfield) and are split, so every output
+   holds the same frames. ProRes 422 HQ and the H.264 proxy use the
+   settings of the v210_prores and proresHD_mp4 workflows, with the
+   V210 call's colour metadata.
+3. reserved() predicts and reserves space for each deliverable with
+   space_preflight.py, alongside the script's V210 reservation.
+4. conformance_check() runs each deliverable's own MediaConch policy.
+   The V210 framemd5 comparison verifies the decode all deliverables
+   share, so deliverables are only checked once it matches.
+   deliverable_path() gives their transcode, finished and failure paths
+   beside the V210 folders, where the v210_prores workflow puts ProRes.
+
+2026
+Python 3.7+
+'''
+
+import os
+import json
+import contextlib
+import subprocess
+
+# Local import
+import process_supervisor
+import space_preflight
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+DELIVERABLES_JSON = os.environ.get('DELIVERABLES_JSON', os.path.join(LOG, 'deliverables.json'))
+COLOUR = ['-color_primaries', '-color_trc', '-colorspace', '-color_range']
+
+# Settings of each deliverable after the V210 master, output
+# folders are beside the collection's transcode/ folder
+PROFILES = {
+    'prores': {
+        'job_type': 'v210_prores',
+        'extension': '.mov',
+        'transcode': 'prores_transcode',
+        'pass': 'finished_prores',
+        'policy': os.path.join(os.environ.get('H22_POLICIES', ''), 'prores_transcode_check.xml'),
+        'filter': None,
+        'settings': [
+            '-map', '0:a?',
+            '-c:v', 'prores_ks', '-profile:v', '3',
+            '-pix_fmt', 'yuv422p10le', '-vendor', 'ap10',
+            '-flags', '+ildct', '-movflags', 'faststart',
+            '-c:a', 'pcm_s24le', '-f', 'mov'
+        ]
+    },
+    'proxy': {
+        'job_type': 'ffv1_h264',
+        'extension': '.mp4',
+        'transcode': 'proxy_transcode',
+        'pass': 'finished_proxy',
+        'policy': os.environ.get('POLICY_MP4'),
+        'filter': 'bwdif=mode=send_frame:deint=interlaced',
+        'settings': [
+            '-map', '0:a:0?',
+            '-movflags', '+faststart',
+            '-c:v', 'libx264', '-preset', 'slow',
+            '-pix_fmt', 'yuv420p', '-crf', '28',
+            '-c:a', 'aac', '-f', 'mp4'
+        ]
+    }
+}
+
+
+def requested(fullpath):
+    '''
+    Return deliverables after V210 listed for the
+    collection of fullpath, in PROFILES order
+    '''
+    try:
+        with open(DELIVERABLES_JSON, 'r') as data:
+            collections = json.load(data)
+    except (OSError, ValueError):
+        return []
+    names = set()
+    for fragment, deliverables in collections.items():
+        if fragment in fullpath:
+            names.update(deliverables)
+    return [x for x in PROFILES if x in names]
+
+
+def deliverable_path(v210_output, name, use='transcode'):
+    '''
+    Return transcode, pass or fail path of
+    deliverable name for V210 output path
+    '''
+    profile = PROFILES[name]
+    collection = os.path.dirname(os.path.dirname(v210_output))
+    filename = os.path.splitext(os.path.basename(v210_output))[0]
+    if use == 'fail':
+        return os.path.join(collection, 'failures/', f'{filename}_{name}{profile["extension"]}')
+    return os.path.join(collection, f'{profile[use]}/', f'{filename}{profile["extension"]}')
+
+
+def multi_output_call(ffmpeg_call, outputs):
+    '''
+    Return FFmpeg call writing the script's V210 output and
+    each of outputs (name: path) from one decode and filter
+    '''
+    index = ffmpeg_call.index('-i')
+    video_filter = 'null'
+    v210_options = []
+    colour = []
+    args = ffmpeg_call[index + 2:-1]
+    position = 0
+    while position < len(args):
+        arg = args[position]
+        if arg in ('-vf', '-map'):
+            if arg == '-vf':
+                video_filter = args[position + 1]
+            position += 2
+            continue
+        if arg in COLOUR:
+            colour.extend(args[position:position + 2])
+        if arg != '-nostdin':
+            v210_options.append(arg)
+        position += 1
+
+    pads = ['[v210]'] + [f"[{x}_split]" if PROFILES[x]['filter'] else f"[{x}]" for x in outputs]
+    graph = f"[0:v:0]{video_filter},split={len(pads)}{''.join(pads)}"
+    for name in outputs:
+        if PROFILES[name]['filter']:
+            graph += f";[{name}_split]{PROFILES[name]['filter']}[{name}]"
+
+    call = [ffmpeg_call[0], '-nostdin', '-i', ffmpeg_call[index + 1], '-filter_complex', graph]
+    call += ['-map', '[v210]', '-map', '0', '-map', '-0:v'] + v210_options + [ffmpeg_call[-1]]
+    for name, path in outputs.items():
+        call += ['-map', f'[{name}]'] + colour + PROFILES[name]['settings'] + [path]
+    return call
+
+
+@contextlib.contextmanager
+def reserved(source, outputs, db_path=None):
+    '''
+    Predict and reserve space for each deliverable in outputs
+    for the with block. Yields dictionary with 'held' True if
+    any won't fit. Set 'complete' to record sizes in history
+    '''
+    space = {'reservations': [], 'figures': [], 'held': False, 'complete': False}
+    try:
+        for name, path in outputs.items():
+            prediction = space_preflight.predict_size(source, PROFILES[name]['job_type'], db_path)
+            reservation, figures = space_preflight.wait_reserve(path, prediction['bytes'], space_preflight.HOLD_TIMEOUT, db_path)
+            space['figures'].append(f"{name}: {figures}")
+            if reservation is None:
+                space['held'] = True
+                break
+            space['reservations'].append((reservation, prediction))
+        yield space
+    finally:
+        for reservation, prediction in space['reservations']:
+            space_preflight.release(reservation, prediction if space['complete'] else None, db_path)
+
+
+def conformance_check(name, filepath):
+    '''
+    Checks deliverable against its own MediaConch policy
+    '''
+    policy = PROFILES[name]['policy']
+    if not policy or not os.path.isfile(policy):
+        return f"FAIL! No MediaConch policy found for {name} deliverable: {policy}"
+    mediaconch_cmd = [
+        'mediaconch', '--force',
+        '-p', policy,
+        filepath
+    ]
+    try:
+        success = str(process_supervisor.check_output(mediaconch_cmd, label=filepath))
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
+    except subprocess.CalledProcessError as err:
+        return f"FAIL! Mediaconch policy retrieval failure: {err}"
+
+    if 'pass!' in success and 'N/A!' not in success:
+        return "PASS!"
+    return f"FAIL! {success}"
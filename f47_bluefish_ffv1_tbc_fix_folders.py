@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
 '''
-*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1] AND DRIVE PARALLEL ***
+*** THIS SCRIPT MUST RUN WITH SHELL SCRIPT LAUNCH TO PASS FILES TO SYS.ARGV[1:] ***
 
 Script that takes BlueFish MKV tbc 1/1000 and encodes to MKV tbc 1/25:
-1. Shell script searches in paths for files that end in '.mkv' and passes on one at a time to Python
-2. Receives single path as sys.argv[1], checks metadata of file acquiring field order, colour data etc
+1. Shell script searches in paths for files that end in '.mkv' and passes the list on stdin to Python,
+   which works through them in one process, JOBS at a time (batch_mode.py)
+2. Receives paths as sys.argv[1:], checks metadata of each file acquiring field order, colour data etc
    and updates DAR from 1.26 to 1.29.
-3. Populates FFmpeg subprocess command based on format decision from retrieved data
-4. Transcodes new file into QNAP_08 path with inherited source name
-5. Runs framemd5 checks against the FFV1 matroska and duplicate, checks if they're identical
+3. Populates FFmpeg subprocess command based on format decision from retrieved data,
+   a stream copy rewriting timestamps where they are already regular (tbc_remux.py)
+4. Transcodes (or remuxes) new file into QNAP_08 path with inherited source name
+5. Runs framemd5 checks against the FFV1 matroska and duplicate (packet hashes for a remux),
+   checks if they're identical
    If identical:
      i. verifies new MKV passes mediaconch policy
      ii. If yes, deletes source MKV file and updates log with success
@@ -24,13 +27,21 @@ Python 3.7+
 
 import os
 import sys
-import json
 import time
-import shutil
 import logging
 import datetime
 import subprocess
 
+# Local import
+import batch_mode
+import io_governor
+import process_supervisor
+import file_lease
+import finalise_queue
+import space_preflight
+import tbc_remux
+from transcode_calibration import get_profile
+
 # Global paths from environment vars
 SOURCE = os.environ['BLUEFISH_MKV']
 MKV_POLICY = os.environ['MKV_POLICY']
@@ -38,6 +49,8 @@ TBC_LOG = os.environ['TBC_LOG']
 LOG = os.environ['SCRIPT_LOG']
 FRAMEMD5_PATH = os.environ['BLUEFISH_TEMP']
 CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+PROFILE = get_profile('bluefish_tbc')
+JOBS = PROFILE.get('jobs', 3)
 
 # Setup logging
 logger = logging.getLogger('QNAP_08_bluefish_ffv1_tbc_fix.py')
@@ -51,12 +64,9 @@ logger.setLevel(logging.INFO)
 def check_control():
     '''
     Check control json for downtime requests
+    Returns False if no new transcodes should start
     '''
-    with open(CONTROL_JSON) as control:
-        j = json.load(control)
-        if not j['ofcom_transcode']:
-            logger.info('Script run prevented by downtime_control.json. Script exiting.')
-            sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    return batch_mode.control_flag(CONTROL_JSON, 'ofcom_transcode')
 
 
 def get_colour(fullpath):
@@ -70,7 +80,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    colour_prim = subprocess.check_output(mediainfo_cmd1)
+    colour_prim = process_supervisor.check_output(mediainfo_cmd1)
     colour_prim = str(colour_prim)
 
     mediainfo_cmd3 = [
@@ -80,7 +90,7 @@ def get_colour(fullpath):
         fullpath
     ]
 
-    col_matrix = subprocess.check_output(mediainfo_cmd3)
+    col_matrix = process_supervisor.check_output(mediainfo_cmd3)
     col_matrix = str(col_matrix)
 
     if 'BT.709' in colour_prim:
@@ -115,7 +125,7 @@ def get_interl(fullpath):
         fullpath
     ]
 
-    interl_setting = subprocess.check_output(mediainfo_cmd)
+    interl_setting = process_supervisor.check_output(mediainfo_cmd)
     interl_setting = str(interl_setting)
 
     if 'TFF' in interl_setting:
@@ -141,7 +151,7 @@ def get_fps(fullpath):
         fullpath
     ]
 
-    fps = subprocess.check_output(mediainfo_cmd)
+    fps = process_supervisor.check_output(mediainfo_cmd)
     fps = fps.decode('utf-8')
     if '.' in fps:
         fps = fps.split('.')[0]
@@ -161,7 +171,7 @@ def get_dar(fullpath):
     ]
 
     cmd[3] = cmd[3].replace('"', '')
-    dar_setting = subprocess.check_output(cmd)
+    dar_setting = process_supervisor.check_output(cmd)
     dar_setting = dar_setting.decode('utf-8')
     dar = str(dar_setting).rstrip('\n')
     return dar
@@ -182,8 +192,7 @@ def adjust_dar_metadata(filepath):
         '--set', 'display-height=228'
     ]
 
-    confirmed = subprocess.run(cmd, shell=False, check=True, universal_newlines=True, stdout=subprocess.PIPE, text=True)
-    confirmed = str(confirmed.stdout)
+    confirmed = process_supervisor.check_output(cmd, label=filepath).decode('utf-8')
     print(confirmed)
 
     if 'The changes are written to the file.' not in str(confirmed):
@@ -210,22 +219,28 @@ def create_ffmpeg_command(fullpath, outpath, data=None):
         "ffmpeg"
     ]
 
+    # Decode threads from transcode_calibration.py profile where calibrated
     input_video_file = [
         "-i", fullpath,
         "-nostdin"
     ]
+    if PROFILE.get('threads'):
+        input_video_file = ["-threads", str(PROFILE['threads'])] + input_video_file
 
     map_command = [
         "-map", "0"
     ]
 
+    # Slices and threads from transcode_calibration.py profile where calibrated
     video_settings = [
         "-c:v", "ffv1",
         "-level", "3",
         "-g", "1",
         "-slicecrc", "1",
-        "-slices", "24"
+        "-slices", str(PROFILE.get('slices', 24))
     ]
+    if PROFILE.get('threads'):
+        video_settings.extend(["-threads", str(PROFILE['threads'])])
 
     colour_build = [
         "-color_primaries", f"{data[4]}",
@@ -261,8 +276,11 @@ def conformance_check(filepath):
     ]
 
     try:
-        success = subprocess.check_output(mediaconch_cmd)
+        success = process_supervisor.check_output(mediaconch_cmd)
         success = success.decode('utf-8')
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         success = ""
         print(f"Mediaconch policy retrieval failure for {filepath}")
@@ -298,7 +316,11 @@ def make_framemd5(mkv_path1, mkv_path2):
     ]
 
     try:
-        subprocess.call(framemd5_mkv)
+        with io_governor.mount_streams(mkv_path1, output_mkv1):
+            process_supervisor.call(framemd5_mkv, label=mkv_path1)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         logger.exception("Framemd5 command failure: %s", mkv_path1)
 
@@ -311,7 +333,11 @@ def make_framemd5(mkv_path1, mkv_path2):
     ]
 
     try:
-        subprocess.call(framemd5_mkv2)
+        with io_governor.mount_streams(mkv_path2, output_mkv2):
+            process_supervisor.call(framemd5_mkv2, label=mkv_path2)
+    except subprocess.TimeoutExpired:
+        # Stalled and stopped by process_supervisor, leave file for next run
+        raise
     except Exception:
         logger.exception("Framemd5 command failure: %s", mkv_path2)
 
@@ -373,136 +399,198 @@ def fail_log(fullpath, message):
         log_data.close()
 
 
-def main():
+def queue_finalise(operations, logger_list, lease):
+    '''
+    Hand moves and deletes to the background
+    finalisation queue, which runs them in order,
+    if this run still holds the file's lease
+    '''
+    if not file_lease.still_held(lease):
+        logger_list.append(f"WARNING: Lease on {lease['file']} lost, files left in place for its new holder: {operations}")
+        return
+    try:
+        batch = finalise_queue.enqueue(operations, origin='bluefish_tbc')
+    except Exception as err:
+        logger_list.append(f"WARNING: Unable to queue finalisation, files left in place: {operations}\n{err}")
+        return
+    for operation in operations:
+        logger_list.append(f"Queued finalisation batch {batch}: {' '.join(x for x in operation[:3] if x)}")
+
+
+def process_file(fullpath):
     '''
-    Receives sys.argv[1] path to FFV1 mkv from shell start script via GNU parallel
-    Extracts metadata of file, passes to FFmpeg subprocess command, transcodes V210
-    Makes framemd5 comparison, and passes V210 mov through mediaconch policy
-    If all pass, cleans up files moving to success folder and deletes FFV1 mkv.
+    Extracts metadata of one BlueFish MKV, passes to FFmpeg subprocess command,
+    transcodes FFV1 with corrected tbc, makes framemd5 comparison and passes
+    new MKV through mediaconch policy. If all pass, source MKV moves to completed.
     '''
     logger_list = []
-    if len(sys.argv) < 2:
-        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
-        sys.exit(f'Error with shell script input {sys.argv}')
-    else:
-        logger.info("================== START BlueFish MKV TBC correction START ==================")
-        check_control()
-        fullpath = sys.argv[1]
-        root, file = os.path.split(fullpath)
-        outpath = os.path.join(root, 'transcoded', file)
-        completed = os.path.join(root, 'completed', file)
-        if os.path.exists(fullpath):
-            # Build and execute FFmpeg subprocess call
-            logger_list.append(f"******** {fullpath} being processed ********")
-            ffmpeg_data = []
-
-            # Update CID with DAR warning
-            dar = get_dar(fullpath)
-            print(f"************ {dar} ************")
-            if '1.26' in dar:
-                logger_list.append(f'{file}\tFile has 1.26 DAR. Converting to 1.29 DAR')
-                logger_list.append(f'{file}\tFile found with 1.26 DAR. Converting to 1.29 DAR')
-                confirmed = adjust_dar_metadata(fullpath)
-                if not confirmed:
-                    logger_list.append(f'WARNING: {file}\tCould not adjust DAR metadata.')
-                else:
-                    logger_list.append(f'{file}\tFile DAR header metadata changed to 1.29')
-
-            # Extract MKV metadata to list and pass to subprocess blocks
-            setfield = get_interl(fullpath)
-            colour_data = get_colour(fullpath)
-            color_primaries = colour_data[0]
-            color_trc = 'bt709'
-            colormatrix = colour_data[1]
-            fps = get_fps(fullpath)
-            codec = 'ffv1'
-            ffmpeg_data = [codec, fps, colormatrix, color_trc, color_primaries, setfield]
+    root, file = os.path.split(fullpath)
+    outpath = os.path.join(root, 'transcoded', file)
+    completed = os.path.join(root, 'completed', file)
+    if not os.path.exists(fullpath):
+        logger.info("SKIPPING: Filename doesn't exist: %s", fullpath)
+        return
+    with file_lease.held(fullpath) as lease:
+        if lease is None:
+            logger.info("SKIPPING: %s is leased by another run or host. %s", fullpath, file_lease.describe(fullpath))
+            return
+        if finalise_queue.pending(fullpath, outpath):
+            logger.info("SKIPPING: %s has moves or deletion still in the finalisation queue", fullpath)
+            return
+        # Build and execute FFmpeg subprocess call
+        logger_list.append(f"******** {fullpath} being processed ********")
+        ffmpeg_data = []
+
+        # Update CID with DAR warning
+        dar = get_dar(fullpath)
+        print(f"************ {dar} ************")
+        if '1.26' in dar:
+            logger_list.append(f'{file}\tFile has 1.26 DAR. Converting to 1.29 DAR')
+            logger_list.append(f'{file}\tFile found with 1.26 DAR. Converting to 1.29 DAR')
+            confirmed = adjust_dar_metadata(fullpath)
+            if not confirmed:
+                logger_list.append(f'WARNING: {file}\tCould not adjust DAR metadata.')
+            else:
+                logger_list.append(f'{file}\tFile DAR header metadata changed to 1.29')
+
+        # Extract MKV metadata to list and pass to subprocess blocks
+        setfield = get_interl(fullpath)
+        colour_data = get_colour(fullpath)
+        color_primaries = colour_data[0]
+        color_trc = 'bt709'
+        colormatrix = colour_data[1]
+        fps = get_fps(fullpath)
+        codec = 'ffv1'
+        ffmpeg_data = [codec, fps, colormatrix, color_trc, color_primaries, setfield]
+        remux = False
+        # Packet framemd5 renamed 'failed_' by a remux that failed verification
+        failed_remux = os.path.join(FRAMEMD5_PATH, f"failed_{file}.bluefish.mkv.packets.framemd5")
+        if os.path.isfile(failed_remux):
+            logger_list.append(f"Remux failed verification on an earlier run ({failed_remux}), re-encoding")
+        elif tbc_remux.ENABLED:
+            remux, note = tbc_remux.regular_timestamps(fullpath, fps)
+            logger_list.append(note)
+        if remux:
+            ffmpeg_call = tbc_remux.remux_call(fullpath, outpath, fps)
+        else:
             ffmpeg_call = create_ffmpeg_command(fullpath, outpath, ffmpeg_data)
-            ffmpeg_call_neat = (" ".join(ffmpeg_call), "\n")
-            logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
-
+        ffmpeg_call_neat = (" ".join(ffmpeg_call), "\n")
+        logger_list.append(f"FFmpeg call: {ffmpeg_call_neat}")
+
+        with space_preflight.reserved(fullpath, outpath, 'ffv1_ffv1', ffmpeg_call) as space:
+            if space['reservation'] is None:
+                logger.warning("HOLD: %s, not enough space for FFV1 output: %s. Leaving for next run", fullpath, space['figures'])
+                return
+            logger_list.append(f"Space reserved for FFV1 output: {space['figures']}")
             tic = time.perf_counter()
             try:
-                subprocess.call(ffmpeg_call)
+                with io_governor.mount_streams(fullpath, outpath):
+                    if process_supervisor.call(space['call'], label=fullpath) == 0:
+                        space['complete'] = True
+            except subprocess.TimeoutExpired:
+                # Stalled and stopped by process_supervisor, remove partial
+                # MKV and leave source for next run
+                logger.warning("FFmpeg stalled and was stopped for %s, partial MKV removed", fullpath)
+                queue_finalise([('remove', outpath)], logger_list, lease)
+                raise
             except Exception:
-                logger_list.append(f"WARNING: FFmpeg command failed: {ffmpeg_call}")
+                logger_list.append(f"WARNING: FFmpeg command failed: {space['call']}")
             toc = time.perf_counter()
-            encode_time = (toc - tic) // 60
-            seconds_time = (toc - tic)
-            logger_list.append(f"*** Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
-
-            # Check framemd5's match for MKV and MOV
-            tic2 = time.perf_counter()
+        encode_time = (toc - tic) // 60
+        seconds_time = (toc - tic)
+        logger_list.append(f"*** Encoding time for {file} was {encode_time} minutes // or in seconds {seconds_time}")
+
+        if remux:
+            # Stream copy keeps source header, so set field order and DAR
+            if not tbc_remux.set_header(outpath, setfield):
+                logger_list.append(f"WARNING: {file}\tCould not set field order '{setfield}' in header")
+            if '1.29' in get_dar(fullpath) and '1.29' not in get_dar(outpath):
+                if not adjust_dar_metadata(outpath):
+                    logger_list.append(f'WARNING: {file}\tCould not adjust DAR metadata of remux.')
+
+        # Check framemd5's match for MKV and MOV, by packet for a remux
+        tic2 = time.perf_counter()
+        if remux:
+            md5_mkv1 = tbc_remux.packet_framemd5(fullpath, os.path.join(FRAMEMD5_PATH, f"{file}.bluefish.mkv.packets.framemd5"))
+            md5_mkv2 = tbc_remux.packet_framemd5(outpath, os.path.join(FRAMEMD5_PATH, f"{file}.corrected.mkv.packets.framemd5"))
+        else:
             md5_mkv1, md5_mkv2 = make_framemd5(fullpath, outpath)
-            toc2 = time.perf_counter()
-            md5_time = (toc2 - tic2) // 60
-            md5_seconds = (toc2 - tic2)
-            logger_list.append(f"*** MD5 creation time for files: {md5_time} minutes or {md5_seconds} seconds")
+        toc2 = time.perf_counter()
+        md5_time = (toc2 - tic2) // 60
+        md5_seconds = (toc2 - tic2)
+        logger_list.append(f"*** MD5 creation time for files: {md5_time} minutes or {md5_seconds} seconds")
+        if remux:
+            result = 'MATCH' if tbc_remux.packets_match(md5_mkv1, md5_mkv2) and tbc_remux.rate_matches(outpath, fps) else 'FAIL'
+        else:
             result = diff_check(md5_mkv1, md5_mkv2)
-            if 'MATCH' in result:
-                logger_list.append("Framemd5 check passed for source and copy MKV files")
-
-                # Run conformance check
-                result = conformance_check(outpath)
-                if "PASS!" in result:
-                    logger_list.append(f"PASS! {outpath} passed the policy checker and it's Matroska can be deleted")
-                    try:
-                        # Delete FFV1 mkv after successful transcode to MKV
-                        shutil.move(fullpath, completed)
-                        fname = os.path.split(fullpath)[-1]
-                        completed_pth = os.path.join(completed, fname)
-                        logger_list.append("*** FILE BEING MOVED TO COMPLETED PATH: %s", fname)
-                    except Exception:
-                        logger_list.append(f"WARNING: Deletion failure: {fullpath}")
+        if 'MATCH' in result:
+            logger_list.append("Framemd5 check passed for source and copy MKV files")
+
+            # Run conformance check
+            result = conformance_check(outpath)
+            if "PASS!" in result:
+                logger_list.append(f"PASS! {outpath} passed the policy checker and it's Matroska can be deleted")
+                # Move FFV1 mkv after successful transcode to MKV
+                logger_list.append(f"*** FILE BEING QUEUED TO MOVE TO COMPLETED PATH: {fullpath}")
+                queue_finalise([('move', fullpath, completed)], logger_list, lease)
+            else:
+                logger_list.append(f"WARNING: {outpath} failed the policy checker. Leaving Matroska for second encoding attempt")
+                fail_log(fullpath, f"Failed Mediaconch policy check:\n{result}")
+
+                logger_list.append(f"Deleting {outpath} file as failed mediaconch policy")
+                queue_finalise([('remove', outpath)], logger_list, lease)
+
+            # Collate and output all logs at once for concurrent runs
+            for line in logger_list:
+                if 'WARNING' in str(line):
+                    logger.warning("%s", line)
                 else:
-                    logger_list.append(f"WARNING: {outpath} failed the policy checker. Leaving Matroska for second encoding attempt")
-                    fail_log(fullpath, f"Failed Mediaconch policy check:\n{result}")
-
-                    try:
-                        logger_list.append(f"Deleting {outpath} file as failed mediaconch policy")
-                        os.remove(outpath)
-                    except Exception:
-                        logger_list.append(f"WARNING: Unable to delete {outpath}")
-
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
-                    else:
-                        logger.info("%s", line)
+                    logger.info("%s", line)
 
-            else:
-                logger_list.append(f"--- {outpath} ---")
-                fail_log(fullpath, "Failed FRAMEMD5 checks, appending 'failed_' for review.")
-                fail_log(fullpath, f"Deleting: {outpath}")
-                logger_list.append("FRAMEMD5 FILES DO NOT MATCH")
-
-                md5_mkv1_split = os.path.split(md5_mkv1)
-                rename_md5_mkv1 = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv1_split[1]}')
-                md5_mkv2_split = os.path.split(md5_mkv2)
-                rename_md5_mkv2 = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv2_split[1]}')
-
-                # Move framemd5 files from qnap02 to qnap04 (new block)
-                logger_list.append(f"MOVING: {md5_mkv2} TO {rename_md5_mkv2}")
-                os.rename(md5_mkv2, rename_md5_mkv2)
-                os.rename(md5_mkv1, rename_md5_mkv1)
-                try:
-                    logger_list.append(f"Deleting {outpath} file as failed mediaconch policy")
-                    os.remove(outpath)
-                except Exception:
-                    logger_list.append(f"WARNING: Unable to delete {outpath}")
-
-                # Collate and output all logs at once for concurrent runs
-                for line in logger_list:
-                    if 'WARNING' in str(line):
-                        logger.warning("%s", line)
-                    else:
-                        logger.info("%s", line)
         else:
-            logger.info("SKIPPING: Filename doesn't exist: %s", fullpath)
+            logger_list.append(f"--- {outpath} ---")
+            fail_log(fullpath, "Failed FRAMEMD5 checks, appending 'failed_' for review.")
+            fail_log(fullpath, f"Deleting: {outpath}")
+            logger_list.append("FRAMEMD5 FILES DO NOT MATCH")
+
+            md5_mkv1_split = os.path.split(md5_mkv1)
+            rename_md5_mkv1 = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv1_split[1]}')
+            md5_mkv2_split = os.path.split(md5_mkv2)
+            rename_md5_mkv2 = os.path.join(FRAMEMD5_PATH, f'failed_{md5_mkv2_split[1]}')
+
+            # Move framemd5 files from qnap02 to qnap04 (new block)
+            logger_list.append(f"MOVING: {md5_mkv2} TO {rename_md5_mkv2}")
+            queue_finalise([('move', md5_mkv2, rename_md5_mkv2), ('move', md5_mkv1, rename_md5_mkv1)], logger_list, lease)
+            logger_list.append(f"Deleting {outpath} file as failed mediaconch policy")
+            queue_finalise([('remove', outpath)], logger_list, lease)
+
+            # Collate and output all logs at once for concurrent runs
+            for line in logger_list:
+                if 'WARNING' in str(line):
+                    logger.warning("%s", line)
+                else:
+                    logger.info("%s", line)
 
-    logger.info("================== END BlueFish MKV TBC correction END =============\n")
 
+def main():
+    '''
+    Receives paths to FFV1 mkv from shell start script (sys.argv[1:]), as
+    files, folders, text file lists or '-' for a list on stdin, and runs
+    process_file() for each in one process with JOBS encoding at once
+    '''
+    if len(sys.argv) < 2:
+        logger.warning("SCRIPT EXITING: Error with shell script input:\n %s", sys.argv)
+        sys.exit(f'Error with shell script input {sys.argv}')
+
+    logger.info("================== START BlueFish MKV TBC correction START ==================")
+    if not check_control():
+        logger.info('Script run prevented by downtime_control.json. Script exiting.')
+        sys.exit('Script run prevented by downtime_control.json. Script exiting.')
+    file_list = batch_mode.read_paths(sys.argv[1:], ('.mkv',))
+    logger.info("Batch of %s files received, running %s at once", len(file_list), JOBS)
+    counts = batch_mode.run_batch(file_list, process_file, JOBS, logger, keep_going=check_control)
+    logger.info("Batch complete: %s files run, %s failed, %s left for next run", counts['run'], counts['failed'], counts['left'])
+    logger.info("================== END BlueFish MKV TBC correction END =============\n")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, PER FILE LEASES ACROSS RUNS AND HOSTS **
+Overlapping cron runs, or more than one server, can start work on the
+same file. 'partial.' files and FFmpeg '-n' only catch this once the
+second worker has already started. A lease claims the file first.
+
+Actions of acquire():
+1. Writes host, PID and time to a unique temporary file, then hard links
+   it to '.{filename}.lease' in the file's folder. link() is atomic on
+   NFS, so only one worker on any host can create the lease.
+2. If a lease exists and its heartbeat (mtime) is older than LEASE_TTL,
+   or it belongs to a PID on this host that is no longer running, it is
+   stale. It is renamed aside (only one worker can win the rename),
+   checked to be the same lease that was judged stale, removed, and the
+   claim is retried.
+3. Returns the lease dictionary, or None if another live worker holds it.
+
+held(fpath) is a context manager that acquires the lease, renews its
+heartbeat every HEARTBEAT seconds from a thread while the with block
+runs and releases it at the end. It yields None if the file is leased
+elsewhere, so the calling script can skip the file. Stage pipeline
+scripts call acquire() and keep_alive() in their first stage and
+release() when the file completes. Before moving or deleting files
+still_held() renews the lease at once, and returns False if it was
+broken meanwhile (ie while the job was stopped by SIGSTOP), so the
+file is left for the new holder. The scheduler renews leases of jobs
+it has stopped with renew_paused().
+
+Shell scripts claim a lease for their own PID:
+    python3 file_lease.py claim <file> <pid>
+which exits 0 if claimed (a background process then renews the lease
+until that PID exits, then releases it) or 1 if leased elsewhere.
+    python3 file_lease.py release <file>
+    python3 file_lease.py show <file>
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+import contextlib
+
+LEASE_TTL = int(os.environ.get('LEASE_TTL', 300))
+HEARTBEAT = 60
+HOST = socket.gethostname()
+
+
+def lease_path(fpath):
+    '''
+    Path of lease file for fpath
+    '''
+    folder, fname = os.path.split(os.path.abspath(fpath))
+    return os.path.join(folder, f".{fname}.lease")
+
+
+def read_lease(path):
+    '''
+    Return lease dictionary from lease file,
+    with 'mtime' of last heartbeat, or None
+    '''
+    try:
+        with open(path, 'r') as data:
+            lease = json.load(data)
+        lease['mtime'] = os.stat(path).st_mtime
+        return lease
+    except (OSError, ValueError):
+        return None
+
+
+def pid_alive(pid):
+    '''
+    True if PID is running on this host
+    '''
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError, TypeError):
+        return True
+    return True
+
+
+def is_stale(lease, ttl=LEASE_TTL):
+    '''
+    Lease heartbeat has expired, or its
+    PID on this host has exited
+    '''
+    if time.time() - lease['mtime'] > ttl:
+        return True
+    return lease.get('host') == HOST and not pid_alive(lease.get('pid'))
+
+
+def break_stale(path, stale):
+    '''
+    Remove stale lease, only if it is still the
+    same lease that was read. Returns True if removed
+    '''
+    aside = f"{path}.stale.{uuid.uuid4().hex}"
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return True
+    current = read_lease(aside)
+    if current and current.get('token') != stale.get('token'):
+        # A fresh lease was taken between read and rename, put it back
+        try:
+            os.link(aside, path)
+        except OSError:
+            pass
+        os.remove(aside)
+        return False
+    os.remove(aside)
+    return True
+
+
+def acquire(fpath, pid=None, ttl=LEASE_TTL):
+    '''
+    Claim lease on fpath for pid (default this process)
+    Returns lease dictionary, or None if held elsewhere
+    '''
+    path = lease_path(fpath)
+    lease = {
+        'file': os.path.abspath(fpath),
+        'host': HOST,
+        'pid': int(pid or os.getpid()),
+        'token': uuid.uuid4().hex,
+        'acquired': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'path': path
+    }
+    tmp = f"{path}.{lease['token']}"
+    with open(tmp, 'w') as data:
+        json.dump(lease, data)
+        data.flush()
+        os.fsync(data.fileno())
+    try:
+        for _ in range(3):
+            try:
+                os.link(tmp, path)
+                return lease
+            except FileExistsError:
+                pass
+            # Some NFS servers report an error for a link that succeeded
+            if os.path.exists(path) and os.stat(tmp).st_nlink == 2:
+                return lease
+            existing = read_lease(path)
+            if existing is None:
+                # Lease being written or removed, recheck after a moment
+                time.sleep(0.2)
+                existing = read_lease(path)
+                if existing is None:
+                    continue
+            if not is_stale(existing, ttl):
+                return None
+            break_stale(path, existing)
+        return None
+    finally:
+        os.remove(tmp)
+
+
+def renew(lease):
+    '''
+    Update lease heartbeat. Returns False if
+    the lease has been lost to another worker
+    '''
+    current = read_lease(lease['path'])
+    if not current or current.get('token') != lease['token']:
+        return False
+    os.utime(lease['path'], None)
+    return True
+
+
+def still_held(lease):
+    '''
+    Renew lease now, before acting on the file. Returns
+    False if it was lost, ie broken while the process
+    was stopped and its heartbeat thread with it
+    '''
+    if lease.get('lost') or not renew(lease):
+        lease['lost'] = True
+        return False
+    return True
+
+
+def renew_paused(fpath, pid):
+    '''
+    Renew heartbeat of lease held on this host by pid,
+    for a job stopped with SIGSTOP whose own heartbeat
+    thread is frozen. Returns True if renewed
+    '''
+    lease = read_lease(lease_path(fpath))
+    if not lease or lease.get('host') != HOST or lease.get('pid') != pid:
+        return False
+    try:
+        os.utime(lease_path(fpath), None)
+    except OSError:
+        return False
+    return True
+
+
+def keep_alive(lease, heartbeat=HEARTBEAT):
+    '''
+    Renew lease every heartbeat seconds from a
+    thread until released, for leases held across
+    several stages or worker threads
+    '''
+    stop = threading.Event()
+
+    def renew_loop():
+        while not stop.wait(heartbeat):
+            if not renew(lease):
+                lease['lost'] = True
+                break
+
+    lease['_stop'] = stop
+    threading.Thread(target=renew_loop, daemon=True).start()
+    return lease
+
+
+def release(lease):
+    '''
+    Stop heartbeat and remove lease if
+    it is still held by this lease
+    '''
+    if lease.get('_stop'):
+        lease['_stop'].set()
+    current = read_lease(lease['path'])
+    if current and current.get('token') == lease['token']:
+        try:
+            os.remove(lease['path'])
+        except FileNotFoundError:
+            pass
+
+
+@contextlib.contextmanager
+def held(fpath, heartbeat=HEARTBEAT):
+    '''
+    Hold lease on fpath, renewing it until the with
+    block ends. Yields lease, or None if held elsewhere
+    '''
+    lease = acquire(fpath)
+    if lease is None:
+        yield None
+        return
+    keep_alive(lease, heartbeat)
+    try:
+        yield lease
+    finally:
+        release(lease)
+
+
+def describe(fpath):
+    '''
+    Return text description of current lease holder
+    '''
+    lease = read_lease(lease_path(fpath))
+    if not lease:
+        return f"No lease on {fpath}"
+    age = round(time.time() - lease['mtime'])
+    state = 'STALE' if is_stale(lease) else 'live'
+    return f"{state} lease on {fpath}: host {lease.get('host')} pid {lease.get('pid')} since {lease.get('acquired')}, heartbeat {age}s ago"
+
+
+def claim_for_pid(fpath, pid):
+    '''
+    Claim lease for another process (a shell script) and fork a
+    child which renews it until that process exits, then releases it
+    Returns True if claimed
+    '''
+    lease = acquire(fpath, pid)
+    if lease is None:
+        return False
+    if os.fork() == 0:
+        os.setsid()
+        while pid_alive(pid):
+            time.sleep(min(HEARTBEAT, 5))
+            if not renew(lease):
+                os._exit(0)
+        release(lease)
+        os._exit(0)
+    return True
+
+
+def main():
+    '''
+    Command line lease claim, release and show
+    '''
+    if len(sys.argv) < 3 or sys.argv[1] not in ('claim', 'release', 'show'):
+        sys.exit("Usage: file_lease.py claim <file> <pid> | release <file> | show <file>")
+    action, fpath = sys.argv[1:3]
+    if action == 'claim':
+        if len(sys.argv) < 4:
+            sys.exit("Usage: file_lease.py claim <file> <pid>")
+        if not claim_for_pid(fpath, int(sys.argv[3])):
+            print(describe(fpath))
+            sys.exit(1)
+    elif action == 'release':
+        path = lease_path(fpath)
+        lease = read_lease(path)
+        if lease and lease.get('host') == HOST:
+            lease['path'] = path
+            release(lease)
+    else:
+        print(describe(fpath))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, VERIFIED FILE MOVES ACROSS MOUNTS **
+Replacement for shutil.move() which, between two NFS mounts, silently
+becomes a Python copy followed by a delete with no check of what landed.
+
+Actions of verified_move():
+1. If the destination is a folder the source filename is appended,
+   and an existing destination file raises FileExistsError.
+2. Tries os.rename(), which is instant where source and destination
+   share a filesystem. Any error other than a cross-device link is raised.
+3. Across devices, holding an io_governor stream token for the source
+   and destination mounts, the file is copied to 'partial.{filename}' in the
+   destination folder:
+    i. If a checksum is supplied the copy is made in the kernel with
+       copy_file_range() (falling back to sendfile()), then the partial
+       file is read back from storage and its MD5 compared to the checksum.
+    ii. If no checksum is supplied the source is read in large chunks,
+        hashed and written in the same pass.
+   Where SPACE_PREALLOCATE is set the partial file is allocated in full
+   before the copy starts.
+4. The partial file is fsynced, renamed atomically to the destination
+   filename and the folder fsynced. Only then is the source deleted.
+5. Returns the destination path, MD5 checksum and throughput in MB/s
+   (None for a rename) so the calling script can log them. On any
+   failure the partial file is removed, the source is left in place and
+   the exception is raised for the calling script to handle.
+
+Actions of verified_copy(), for relocating large files that must be
+checked chunk by chunk before the source is deleted:
+1. Reads the source once, updating a whole file MD5 and an MD5 per
+   chunk while writing the same bytes to 'partial.{filename}'.
+2. Every written chunk is synced and dropped from cache, then read back
+   by a verifying thread while the copy carries on, so verification
+   overlaps the copy instead of following it.
+3. Only chunks whose read back differs are copied again, up to the
+   retry limit, and re-verified.
+4. Once every chunk matches the partial file is renamed into place and
+   (destination, MD5, MB/s, number of chunks repaired) is returned. The
+   source is left for the calling script to delete.
+
+2026
+Python 3
+'''
+
+import os
+import sys
+import time
+import queue
+import errno
+import shutil
+import hashlib
+import threading
+
+# Local import
+import io_governor
+import space_preflight
+
+CHUNK_SIZE = 16 * 1024 * 1024
+KERNEL_CHUNK = 1024 * 1024 * 1024
+
+
+def get_destination(src, dst):
+    '''
+    Return full destination path, matching
+    shutil.move() handling of folder targets
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst):
+        raise FileExistsError(f"Destination path already exists: {dst}")
+    return dst
+
+
+def fsync_folder(folder):
+    '''
+    Flush folder entry so rename survives a crash
+    '''
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def drop_cache(fd):
+    '''
+    Ask the kernel to drop cached pages so
+    read back comes from storage, not memory
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def hash_file(fpath, uncached=False, tokens=None):
+    '''
+    MD5 of file in large sequential reads
+    '''
+    hash_md5 = hashlib.md5()
+    with open(fpath, 'rb', buffering=0) as data:
+        if uncached:
+            drop_cache(data.fileno())
+        while True:
+            chunk = data.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hash_md5.update(chunk)
+            io_governor.throttle(tokens, len(chunk))
+    return hash_md5.hexdigest()
+
+
+def preallocate_copy(fd, size):
+    '''
+    Allocate whole copy up front where SPACE_PREALLOCATE
+    is set, so it lands contiguously on the NAS
+    '''
+    if not space_preflight.PREALLOCATE or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        pass
+
+
+def kernel_copy(src, tmp, tokens=None):
+    '''
+    Copy src to tmp without passing data through
+    Python, using copy_file_range or sendfile
+    '''
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc, open(tmp, 'xb') as fdst:
+        preallocate_copy(fdst.fileno(), size)
+        offset = 0
+        use_range = hasattr(os, 'copy_file_range')
+        while offset < size:
+            count = min(KERNEL_CHUNK, size - offset)
+            if use_range:
+                try:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), count, offset, offset)
+                except OSError as err:
+                    if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_range = False
+                    continue
+            else:
+                os.lseek(fdst.fileno(), offset, os.SEEK_SET)
+                copied = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, count)
+            if copied == 0:
+                raise OSError(f"Unexpected end of file copying {src} at byte {offset}")
+            offset += copied
+            io_governor.throttle(tokens, copied)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+        drop_cache(fdst.fileno())
+
+
+def hash_copy(src, tmp, tokens=None):
+    '''
+    Copy src to tmp, hashing bytes as they pass
+    Returns MD5 hexdigest of the data written
+    '''
+    hash_md5 = hashlib.md5()
+    with open(src, 'rb', buffering=0) as fsrc, open(tmp, 'xb', buffering=0) as fdst:
+        preallocate_copy(fdst.fileno(), os.path.getsize(src))
+        while True:
+            chunk = fsrc.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hash_md5.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                written = fdst.write(view)
+                view = view[written:]
+            io_governor.throttle(tokens, len(chunk))
+        os.fsync(fdst.fileno())
+    return hash_md5.hexdigest()
+
+
+def verified_move(src, dst, checksum=None):
+    '''
+    Move src to dst, renaming where possible otherwise
+    copying with checksum verification before deleting src
+    Returns (destination, checksum, MB/s)
+    '''
+    dst = get_destination(src, dst)
+    try:
+        os.rename(src, dst)
+        return dst, checksum, None
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+
+    folder, fname = os.path.split(dst)
+    tmp = os.path.join(folder, f"partial.{fname}")
+    size = os.path.getsize(src)
+    tic = time.perf_counter()
+    try:
+        with io_governor.mount_streams(src, dst) as tokens:
+            if checksum:
+                kernel_copy(src, tmp, tokens)
+                new_checksum = hash_file(tmp, uncached=True, tokens=tokens)
+                if new_checksum.lower() != checksum.lower():
+                    raise OSError(f"Checksum mismatch moving {src}: expected {checksum} found {new_checksum}")
+            else:
+                checksum = hash_copy(src, tmp, tokens)
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+        fsync_folder(folder)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    toc = time.perf_counter()
+
+    os.remove(src)
+    mb_per_sec = round(size / (1024 * 1024) / max(toc - tic, 0.001), 1)
+    return dst, checksum, mb_per_sec
+
+
+def read_chunk(fd, offset, length):
+    '''
+    Read length bytes from offset of open fd
+    '''
+    data = bytearray()
+    while len(data) < length:
+        chunk = os.pread(fd, length - len(data), offset + len(data))
+        if not chunk:
+            break
+        data.extend(chunk)
+    return bytes(data)
+
+
+def write_chunk(fd, data, offset):
+    '''
+    Write all of data at offset of open fd
+    '''
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def flush_chunk(fd, offset, length):
+    '''
+    Commit chunk to storage and drop it from cache
+    so the verifying read comes from storage
+    '''
+    os.fdatasync(fd)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+def verify_chunks(tmp, chunk_queue, mismatches, errors=None):
+    '''
+    Verifying thread, reads back each (index, offset,
+    length, md5) from tmp and records mismatched indexes
+    Read errors are appended to errors for the copy to raise
+    '''
+    try:
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            while True:
+                item = chunk_queue.get()
+                if item is None:
+                    break
+                index, offset, length, digest = item
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+                if hashlib.md5(read_chunk(fd, offset, length)).hexdigest() != digest:
+                    mismatches.add(index)
+        finally:
+            os.close(fd)
+    except Exception as err:
+        if errors is None:
+            raise
+        errors.append(err)
+
+
+def queue_chunk(chunk_queue, item, verifier):
+    '''
+    Queue item for verifier, waiting while the queue is
+    full. Returns False if the verifier has stopped
+    '''
+    while verifier.is_alive():
+        try:
+            chunk_queue.put(item, timeout=5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def verified_copy(src, dst, retries=2):
+    '''
+    Copy src to dst in one read of src, verifying each
+    chunk of dst with an overlapping read back and
+    recopying only chunks that differ
+    Returns (destination, checksum, MB/s, chunks repaired)
+    '''
+    dst = get_destination(src, dst)
+    folder, fname = os.path.split(dst)
+    tmp = os.path.join(folder, f"partial.{fname}")
+    size = os.path.getsize(src)
+    hash_md5 = hashlib.md5()
+    digests = []
+    mismatches = set()
+    errors = []
+    chunk_queue = queue.Queue(maxsize=8)
+    repaired = 0
+
+    with io_governor.mount_streams(src, dst) as tokens:
+        tic = time.perf_counter()
+        src_fd = os.open(src, os.O_RDONLY)
+        dst_fd = None
+        try:
+            # Truncates any partial left by an interrupted copy
+            dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            verifier = threading.Thread(target=verify_chunks, args=(tmp, chunk_queue, mismatches, errors), daemon=True)
+            verifier.start()
+            try:
+                offset = 0
+                while offset < size:
+                    data = read_chunk(src_fd, offset, CHUNK_SIZE)
+                    if not data:
+                        raise OSError(f"Unexpected end of file reading {src} at byte {offset}")
+                    hash_md5.update(data)
+                    digest = hashlib.md5(data).hexdigest()
+                    digests.append(digest)
+                    write_chunk(dst_fd, data, offset)
+                    flush_chunk(dst_fd, offset, len(data))
+                    io_governor.throttle(tokens, len(data))
+                    if not queue_chunk(chunk_queue, (len(digests) - 1, offset, len(data), digest), verifier):
+                        break
+                    offset += len(data)
+            finally:
+                queue_chunk(chunk_queue, None, verifier)
+                verifier.join()
+            if errors:
+                # Chunks not read back can't count as verified, so fail the copy and keep the source
+                raise OSError(f"Verifying read of {tmp} failed: {errors[0]}") from errors[0]
+            if offset < size:
+                raise OSError(f"Verifying read of {tmp} stopped at byte {offset}")
+
+            for _ in range(retries):
+                if not mismatches:
+                    break
+                retry = sorted(mismatches)
+                mismatches.clear()
+                for index in retry:
+                    offset = index * CHUNK_SIZE
+                    data = read_chunk(src_fd, offset, CHUNK_SIZE)
+                    if hashlib.md5(data).hexdigest() != digests[index]:
+                        raise OSError(f"Source {src} changed or unreadable at byte {offset}")
+                    write_chunk(dst_fd, data, offset)
+                    flush_chunk(dst_fd, offset, len(data))
+                    repaired += 1
+                chunk_queue = queue.Queue()
+                for index in retry:
+                    offset = index * CHUNK_SIZE
+                    chunk_queue.put((index, offset, min(CHUNK_SIZE, size - offset), digests[index]))
+                chunk_queue.put(None)
+                verify_chunks(tmp, chunk_queue, mismatches)
+            if mismatches:
+                raise OSError(f"{len(mismatches)} chunks still differ after {retries} retries copying {src}")
+
+            os.fsync(dst_fd)
+            os.close(dst_fd)
+            dst_fd = None
+            shutil.copystat(src, tmp)
+            os.rename(tmp, dst)
+            fsync_folder(folder)
+        except BaseException:
+            if dst_fd is not None:
+                os.close(dst_fd)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        finally:
+            os.close(src_fd)
+    toc = time.perf_counter()
+
+    mb_per_sec = round(size / (1024 * 1024) / max(toc - tic, 0.001), 1)
+    return dst, hash_md5.hexdigest(), mb_per_sec, repaired
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit("Usage: file_mover.py <source> <destination> [<md5 checksum>]")
+    result = verified_move(*sys.argv[1:4])
+    print(f"Moved to {result[0]} MD5 {result[1]} at {result[2]} MB/s")
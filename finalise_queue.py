@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, BACKGROUND FINALISATION QUEUE **
+Once a file is verified the script still moves the output to success/,
+completed/ or failures/ and deletes the 100GB+ source over NFS, holding
+its job slot (and the scheduler's) for the whole time. Scripts instead
+hand these moves, deletes and renames to this queue and return to
+encoding straight away, while one worker per host carries them out.
+
+Actions:
+1. enqueue() writes a batch of operations for one file to an SQLite
+   database in a single transaction, with synchronous=FULL so a queued
+   batch survives power loss, then starts the worker if it isn't running.
+   Operations are:
+    move    file_mover.verified_move(src, dst, checksum)
+    rename  os.replace(src, dst), ie 'partial.' files on the same mount
+    remove  os.remove(src)
+2. The worker runs a batch's operations strictly in order, so a source
+   is never deleted before the move of its output has succeeded. Batches
+   run in the order queued, WORKERS at a time.
+3. A failed operation is retried after RETRY_DELAY seconds, doubling
+   each attempt, up to MAX_ATTEMPTS. It is then marked failed and the
+   rest of its batch blocked, leaving the files in place for review.
+   The worker stays up while any retry is scheduled.
+4. Operations are safe to repeat: a move whose source is gone and whose
+   destination exists (matching the queued MD5, if any), or a remove
+   of a missing file, is complete. A move interrupted after the copy
+   landed but before the source delete is finished by comparing MD5s.
+   Operations left running by a crash are run again when the worker
+   next starts.
+5. Every operation's result, attempts and error are kept in the database
+   and written to finalise_queue.log.
+6. pending() tells a script whether a source or output still has
+   operations queued, so a file isn't picked up again (or its new output
+   moved or deleted) before its earlier batch has finished.
+
+NOTE: SQLite needs the database on a local disk, not an NFS mount. The
+      default location is alongside the script logs.
+
+Command line use:
+    python3 finalise_queue.py run
+    python3 finalise_queue.py status
+    python3 finalise_queue.py retry <batch>
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import time
+import fcntl
+import sqlite3
+import logging
+import datetime
+import subprocess
+import concurrent.futures
+
+# Local import
+from file_mover import verified_move, hash_file
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+FINALISE_DB = os.environ.get('FINALISE_DB', os.path.join(LOG, 'finalise_queue.db'))
+OPERATIONS = ('move', 'rename', 'remove')
+WORKERS = 2
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 60
+IDLE = 300
+WAIT = 5
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS operations (
+        id INTEGER PRIMARY KEY,
+        batch INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        origin TEXT,
+        op TEXT NOT NULL,
+        src TEXT NOT NULL,
+        dst TEXT,
+        checksum TEXT,
+        status TEXT NOT NULL,
+        attempts INTEGER DEFAULT 0,
+        next_try REAL DEFAULT 0,
+        error TEXT,
+        created TEXT,
+        updated TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_operations_status ON operations (status, next_try)',
+    'CREATE INDEX IF NOT EXISTS idx_operations_batch ON operations (batch, seq)',
+    'CREATE INDEX IF NOT EXISTS idx_operations_src ON operations (src, status)'
+]
+
+logger = logging.getLogger('finalise_queue')
+
+
+def get_connection(db_path=None):
+    '''
+    Open queue connection in WAL mode with full sync,
+    creating tables and indexes where needed
+    '''
+    if db_path is None:
+        db_path = FINALISE_DB
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.execute('PRAGMA busy_timeout=60000')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def now_text():
+    '''
+    Timestamp for database rows
+    '''
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def enqueue(operations, origin=None, db_path=None, start=True):
+    '''
+    Queue operations, a list of (op, src, dst=None, checksum=None),
+    to run in order as one batch. Folder destinations have the
+    source filename appended. Returns batch number
+    '''
+    rows = []
+    for seq, operation in enumerate(operations):
+        op, src, dst, checksum = (tuple(operation) + (None, None))[:4]
+        if op not in OPERATIONS:
+            raise ValueError(f"Unknown finalise operation {op}: choose from {', '.join(OPERATIONS)}")
+        if dst and os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        rows.append((seq, origin, op, src, dst, checksum))
+
+    created = now_text()
+    conn = get_connection(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        batch = conn.execute('SELECT COALESCE(MAX(batch), 0) + 1 FROM operations').fetchone()[0]
+        conn.executemany(
+            'INSERT INTO operations (batch, seq, origin, op, src, dst, checksum, status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(batch, seq, origin, op, src, dst, checksum, 'pending', created, created)
+             for seq, origin, op, src, dst, checksum in rows]
+        )
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    if start:
+        start_worker(db_path)
+    return batch
+
+
+def pending(*fpaths, db_path=None):
+    '''
+    True if any of fpaths is the source of an operation
+    not yet complete (pending, running, failed or blocked)
+    '''
+    conn = get_connection(db_path)
+    try:
+        row = conn.execute(
+            f"SELECT 1 FROM operations WHERE src IN ({', '.join('?' * len(fpaths))}) AND status != 'done' LIMIT 1", fpaths
+        ).fetchone()
+    finally:
+        conn.close()
+    return row is not None
+
+
+def start_worker(db_path=None):
+    '''
+    Launch background worker, which exits at
+    once if another already holds the lock
+    '''
+    command = [sys.executable, os.path.abspath(__file__), 'run']
+    env = dict(os.environ)
+    if db_path:
+        env['FINALISE_DB'] = db_path
+    subprocess.Popen(command, env=env, start_new_session=True, stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def finish_move(src, dst, checksum):
+    '''
+    Move src to dst, completing a move interrupted
+    after the copy landed but before src was deleted
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if not os.path.exists(src) and os.path.exists(dst):
+        if checksum and hash_file(dst) != checksum.lower():
+            raise FileExistsError(f"Source missing and destination path exists with different MD5: {dst}")
+        return 'already moved'
+    if os.path.exists(src) and os.path.exists(dst):
+        if os.path.getsize(src) != os.path.getsize(dst):
+            raise FileExistsError(f"Destination path already exists with different size: {dst}")
+        dst_checksum = hash_file(dst)
+        if dst_checksum != (checksum or hash_file(src)).lower():
+            raise FileExistsError(f"Destination path already exists with different MD5: {dst}")
+        os.remove(src)
+        return 'completed interrupted move'
+    _, _, mb_per_sec = verified_move(src, dst, checksum)
+    return f"moved ({mb_per_sec} MB/s)" if mb_per_sec else 'renamed'
+
+
+def run_operation(op, src, dst, checksum):
+    '''
+    Carry out one operation, returning a note for
+    the log. Repeating a completed operation is safe
+    '''
+    if op == 'move':
+        return finish_move(src, dst, checksum)
+    if op == 'rename':
+        if not os.path.exists(src) and os.path.exists(dst):
+            return 'already renamed'
+        os.replace(src, dst)
+        return 'renamed'
+    if not os.path.exists(src):
+        return 'already removed'
+    os.remove(src)
+    return 'removed'
+
+
+def next_operations(conn, limit):
+    '''
+    Mark and return up to limit operations that are due
+    and whose earlier operations in the batch are done
+    '''
+    conn.execute('BEGIN IMMEDIATE')
+    rows = conn.execute(
+        '''SELECT id, batch, origin, op, src, dst, checksum, attempts FROM operations o
+           WHERE status = 'pending' AND next_try <= ?
+           AND NOT EXISTS (SELECT 1 FROM operations p WHERE p.batch = o.batch AND p.seq < o.seq AND p.status != 'done')
+           ORDER BY batch, seq LIMIT ?''',
+        (time.time(), limit)
+    ).fetchall()
+    conn.executemany("UPDATE operations SET status = 'running', updated = ? WHERE id = ?",
+                     [(now_text(), row[0]) for row in rows])
+    conn.execute('COMMIT')
+    return rows
+
+
+def record_result(conn, row, error=None):
+    '''
+    Mark operation done, or schedule a retry, or on the
+    last attempt mark it failed and block its batch
+    '''
+    op_id, batch, origin, op, src, dst, _, attempts = row
+    attempts += 1
+    if error is None:
+        conn.execute("UPDATE operations SET status = 'done', attempts = ?, error = NULL, updated = ? WHERE id = ?",
+                     (attempts, now_text(), op_id))
+        return
+    if attempts < MAX_ATTEMPTS:
+        delay = RETRY_DELAY * 2 ** (attempts - 1)
+        conn.execute("UPDATE operations SET status = 'pending', attempts = ?, next_try = ?, error = ?, updated = ? WHERE id = ?",
+                     (attempts, time.time() + delay, error, now_text(), op_id))
+        logger.warning("Batch %s (%s) %s %s failed, attempt %s of %s, retrying in %ss: %s",
+                       batch, origin, op, src, attempts, MAX_ATTEMPTS, delay, error)
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute("UPDATE operations SET status = 'failed', attempts = ?, error = ?, updated = ? WHERE id = ?",
+                 (attempts, error, now_text(), op_id))
+    conn.execute("UPDATE operations SET status = 'blocked', updated = ? WHERE batch = ? AND status = 'pending'",
+                 (now_text(), batch))
+    conn.execute('COMMIT')
+    logger.warning("Batch %s (%s) %s %s FAILED after %s attempts, rest of batch blocked: %s",
+                   batch, origin, op, src, attempts, error)
+
+
+def next_due(conn):
+    '''
+    Return time the earliest pending operation
+    is due, or None if none are pending
+    '''
+    return conn.execute("SELECT MIN(next_try) FROM operations WHERE status = 'pending'").fetchone()[0]
+
+
+def run_worker(db_path=None, idle=IDLE):
+    '''
+    Run queued operations until none are pending and none
+    have been due for idle seconds, staying up for retries
+    scheduled later. Only one worker per database runs at once
+    '''
+    db_path = db_path or FINALISE_DB
+    lock = open(f"{db_path}.lock", 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+
+    conn = get_connection(db_path)
+    conn.execute("UPDATE operations SET status = 'pending', updated = ? WHERE status = 'running'", (now_text(),))
+    running = {}
+    last_work = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            while True:
+                for row in next_operations(conn, WORKERS - len(running)):
+                    running[pool.submit(run_operation, *row[3:7])] = row
+                if not running:
+                    due = next_due(conn)
+                    if due is None and time.time() - last_work >= idle:
+                        break
+                    # Poll every WAIT seconds, so newly queued work isn't held behind a distant retry
+                    time.sleep(WAIT if due is None else min(WAIT, max(due - time.time(), 0.1)))
+                    continue
+                done, _ = concurrent.futures.wait(running, timeout=WAIT, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    row = running.pop(future)
+                    try:
+                        note = future.result()
+                    except Exception as err:
+                        record_result(conn, row, str(err))
+                        continue
+                    record_result(conn, row)
+                    logger.info("Batch %s (%s) %s %s%s: %s", row[1], row[2], row[3], row[4],
+                                f" -> {row[5]}" if row[5] else '', note)
+                last_work = time.time()
+    finally:
+        conn.close()
+        lock.close()
+    return True
+
+
+def status(db_path=None):
+    '''
+    Return counts of operations by status, and
+    the failed and blocked operations
+    '''
+    conn = get_connection(db_path)
+    try:
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM operations GROUP BY status').fetchall())
+        problems = conn.execute(
+            "SELECT batch, origin, op, src, dst, status, attempts, error FROM operations WHERE status IN ('failed', 'blocked') ORDER BY batch, seq"
+        ).fetchall()
+    finally:
+        conn.close()
+    return counts, problems
+
+
+def retry(batch, db_path=None):
+    '''
+    Return failed and blocked operations of
+    batch to the queue. Returns number reset
+    '''
+    conn = get_connection(db_path)
+    try:
+        cursor = conn.execute(
+            "UPDATE operations SET status = 'pending', attempts = 0, next_try = 0, updated = ? WHERE batch = ? AND status IN ('failed', 'blocked')",
+            (now_text(), batch)
+        )
+        return cursor.rowcount
+    finally:
+        conn.close()
+
+
+def main():
+    '''
+    Run worker, print queue status or retry a batch
+    '''
+    if len(sys.argv) < 2 or sys.argv[1] not in ('run', 'status', 'retry'):
+        sys.exit("Usage: finalise_queue.py run | status | retry <batch>")
+
+    if sys.argv[1] == 'run':
+        hdlr = logging.FileHandler(os.path.join(LOG, 'finalise_queue.log'))
+        hdlr.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)s\t%(message)s'))
+        logger.addHandler(hdlr)
+        logger.setLevel(logging.INFO)
+        run_worker()
+    elif sys.argv[1] == 'status':
+        counts, problems = status()
+        print(', '.join(f"{key}: {value}" for key, value in sorted(counts.items())) or 'Queue empty')
+        for batch, origin, op, src, dst, state, attempts, error in problems:
+            print(f"{batch}\t{origin}\t{state}\t{op} {src}{f' -> {dst}' if dst else ''}\t{attempts} attempts\t{error or ''}")
+    else:
+        if len(sys.argv) < 3:
+            sys.exit("Usage: finalise_queue.py retry <batch>")
+        print(f"{retry(int(sys.argv[2]))} operations returned to queue")
+        start_worker()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, REPAIR OF FRAMEMD5 MISMATCHES **
+A failed framemd5 comparison deleted the whole V210 output and moved
+the Matroska to framemd5_fail/, though often only a few frames at one
+spot were bad, from a transient NAS read error. As FFV1 and V210 are
+intra-only, the bad frames can be encoded again on their own and
+spliced into the output.
+
+Actions:
+1. find_ranges() compares the source and output framemd5s. Repair is
+   only tried where the files hold the same number of frames, audio and
+   header lines match and no more than MAX_SHARE of the frames (in no
+   more than MAX_RANGES ranges) differ. Mismatching frames within
+   2 x BOUNDARY frames of each other are repaired as one range.
+2. Each range is encoded from the source with segment_encode.py, which
+   re-reads the source frames and verifies the new segment against
+   them. The re-read must match the source framemd5, otherwise the
+   source itself reads unreliably and repair is abandoned.
+3. The output is rebuilt beside itself as a stream copy: untouched
+   frames from the output, repaired ranges from the new segments and
+   audio from the output. It must hold the same number of frames.
+4. Only the repaired ranges plus BOUNDARY frames either side are hashed
+   from the rebuilt output and checked against the source framemd5.
+   Those lines replace the old lines in the output framemd5 and the
+   rebuilt output replaces the old one. The script then compares the
+   framemd5s again as the final check.
+repair() returns False with the reason at any failure, so the script
+escalates the file to framemd5_fail/ for review as before.
+
+Use in a script, when framemd5s don't match:
+    repaired, note = frame_repair.repair(ffmpeg_call, md5_mkv, md5_mov, label=fullpath)
+
+2026
+Python 3.7+
+'''
+
+import os
+import shutil
+import fractions
+import subprocess
+
+# Local import
+import io_governor
+import process_supervisor
+import segment_encode
+import space_preflight
+
+BOUNDARY = 5
+MAX_RANGES = 20
+MAX_SHARE = 0.05
+
+
+def read_framemd5(md5_path):
+    '''
+    Return video (stream 0) lines and all
+    other lines (headers, audio) of framemd5
+    '''
+    video, other = [], []
+    try:
+        with open(md5_path, 'r') as data:
+            for line in data:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    continue
+                if not line.startswith('#') and line.split(',', 1)[0].strip() == '0':
+                    video.append(line)
+                else:
+                    other.append(line)
+    except OSError:
+        pass
+    return video, other
+
+
+def frame_hash(line):
+    '''
+    Hash (last column) of framemd5 line
+    '''
+    return line.rsplit(',', 1)[-1].strip()
+
+
+def find_ranges(md5_source, md5_output):
+    '''
+    Return (first, last) frame ranges that differ between
+    framemd5s and a note, or None and the reason repair
+    can't be tried
+    '''
+    source_video, source_other = read_framemd5(md5_source)
+    output_video, output_other = read_framemd5(md5_output)
+    if not source_video or not output_video:
+        return None, "Framemd5 missing or holds no video frames"
+    if len(source_video) != len(output_video):
+        return None, f"Frame counts differ ({len(source_video)} source, {len(output_video)} output), frames lost or added rather than damaged"
+    if source_other != output_other:
+        return None, "Header or audio lines differ, not a video frame fault"
+    bad = [index for index, (source, output) in enumerate(zip(source_video, output_video)) if source != output]
+    if not bad:
+        return None, "No mismatching video frames found"
+    if len(bad) > MAX_SHARE * len(source_video):
+        return None, f"{len(bad)} of {len(source_video)} frames mismatch, too many to repair"
+    ranges = []
+    for index in bad:
+        if ranges and index - ranges[-1][1] <= 2 * BOUNDARY:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    if len(ranges) > MAX_RANGES:
+        return None, f"Mismatching frames spread over {len(ranges)} ranges, too many to repair"
+    ranges = [tuple(x) for x in ranges]
+    return ranges, f"{len(bad)} mismatching frames in {len(ranges)} range(s): {', '.join(f'{x[0]}-{x[1]}' for x in ranges)}"
+
+
+def count_frames(fpath):
+    '''
+    Return video packet count of file, or None
+    '''
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-count_packets', '-show_entries', 'stream=nb_read_packets',
+        '-of', 'default=noprint_wrappers=1:nokey=1', fpath
+    ]
+    try:
+        with io_governor.mount_streams(fpath):
+            return int(process_supervisor.check_output(cmd, label=fpath).decode('utf-8').strip())
+    except subprocess.TimeoutExpired:
+        raise
+    except (ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def window_framemd5(fpath, first, count, rate, md5_path):
+    '''
+    Framemd5 of count frames of file from frame first, keeping
+    the file's timestamps so lines match a whole file framemd5
+    '''
+    seek = ['-ss', f"{float((first - fractions.Fraction(1, 2)) / rate):.6f}"] if first else []
+    cmd = [
+        'ffmpeg', '-nostdin', '-y', '-copyts'
+    ] + seek + [
+        '-i', fpath, '-map', '0:v:0',
+        '-vf', segment_encode.LUTYUV,
+        '-frames:v', str(count),
+        '-f', 'framemd5', md5_path
+    ]
+    with io_governor.mount_streams(fpath, md5_path):
+        process_supervisor.call(cmd, label=fpath)
+    return read_framemd5(md5_path)[0]
+
+
+def rewrite_framemd5(md5_path, replacements):
+    '''
+    Replace video lines of framemd5 by frame
+    index from replacements dictionary
+    '''
+    with open(md5_path, 'r') as data:
+        lines = data.readlines()
+    index = 0
+    for position, line in enumerate(lines):
+        if line.startswith('#') or not line.strip() or line.split(',', 1)[0].strip() != '0':
+            continue
+        if index in replacements:
+            lines[position] = f"{replacements[index]}\n"
+        index += 1
+    with open(f"{md5_path}.tmp", 'w') as data:
+        data.writelines(lines)
+    os.replace(f"{md5_path}.tmp", md5_path)
+
+
+def repair(ffmpeg_call, md5_source, md5_output, label=None):
+    '''
+    Re-encode mismatching frame ranges of the script's FFmpeg
+    call's output and splice them in. Returns True and note if
+    repaired ranges verify, or False and the reason
+    '''
+    if not segment_encode.supported(ffmpeg_call):
+        return False, "FFmpeg call can't be re-encoded by frame range"
+    source = ffmpeg_call[ffmpeg_call.index('-i') + 1]
+    output = ffmpeg_call[-1]
+    label = label or source
+    if not os.path.isfile(output):
+        return False, f"Output missing, nothing to repair: {output}"
+    ranges, note = find_ranges(md5_source, md5_output)
+    if not ranges:
+        return False, note
+    rate = segment_encode.probe(source)[1]
+    if not rate:
+        return False, f"Frame rate of source could not be read: {source}"
+    source_video = read_framemd5(md5_source)[0]
+    total = len(source_video)
+
+    folder = os.path.join(os.path.dirname(output), f".{os.path.basename(output)}.repair")
+    # Rebuilt output sits beside the old one until verified
+    reservation, figures = space_preflight.reserve(folder, os.path.getsize(output))
+    if reservation is None:
+        return False, f"No space to rebuild output beside the original: {figures}"
+    try:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        entries = []
+        position = 0
+        for first, last in ranges:
+            segment = segment_encode.encode_segment(ffmpeg_call, rate, (first, last - first + 1), folder, label)
+            if not segment:
+                return False, f"{note}. Re-encode of frames {first}-{last} failed verification"
+            fresh = segment_encode.read_hashes(segment_encode.segment_paths(folder, first)[1])
+            if fresh != [frame_hash(x) for x in source_video[first:last + 1]]:
+                return False, f"{note}. Source frames {first}-{last} read differently to the source framemd5, source reads unreliable"
+            if first > position:
+                entries.append((output, position, first))
+            entries.append(segment)
+            position = last + 1
+        if position < total:
+            entries.append((output, position, None))
+
+        rebuilt = os.path.join(folder, 'repaired.mov')
+        if segment_encode.concat_segments(ffmpeg_call, entries, rebuilt, folder, streams=output, rate=rate) != 0:
+            return False, f"{note}. Splicing repaired ranges into output failed"
+        frames = count_frames(rebuilt)
+        if frames != total:
+            return False, f"{note}. Repaired output holds {frames} frames, {total} expected"
+
+        replacements = {}
+        for first, last in ranges:
+            start = max(0, first - BOUNDARY)
+            end = min(total - 1, last + BOUNDARY)
+            lines = window_framemd5(rebuilt, start, end - start + 1, rate, os.path.join(folder, f"window_{start:08d}.framemd5"))
+            if [frame_hash(x) for x in lines] != [frame_hash(x) for x in source_video[start:end + 1]]:
+                return False, f"{note}. Repaired frames {start}-{end} do not match source framemd5"
+            replacements.update(zip(range(start, end + 1), lines))
+
+        os.replace(rebuilt, output)
+        rewrite_framemd5(md5_output, replacements)
+        return True, f"{note}. Re-encoded, spliced and verified with {BOUNDARY} frames either side"
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        space_preflight.release(reservation)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, PER MOUNT I/O STREAM AND BANDWIDTH BUDGETS **
+Workers from several workflows read and write the same NAS mounts at
+once (qnap_08 holds the BlueFish, Ofcom and Memnon paths and receives
+the f47 output). Many sequential readers on one QNAP become random I/O,
+so each mount is given a budget of concurrent streams and bandwidth that
+all scripts on the server share.
+
+Actions of mount_streams(*paths):
+1. Names the mount of each path with checksum_maker.get_mount(), so
+   mounts are named as for batch checksums (qnap_08, qnap_10, grack)
+   or by mount point.
+2. Takes one stream token per distinct mount, in sorted order so two
+   workers needing the same mounts cannot deadlock. A token is an flock
+   on one of the mount's slot files in LOCK_DIR, so tokens are shared
+   by separate processes and released by the kernel if a worker dies.
+3. Waits, checking every WAIT seconds, while all of a mount's slots
+   are held.
+4. Returns the tokens to the with block and releases them on exit.
+
+Stream limits default to checksum_maker MOUNT_LIMITS / DEFAULT_LIMIT
+(override with CHECKSUM_MOUNT_LIMITS="qnap_08=4,grack=6"). Bandwidth
+per mount in MB/s is set with IO_MOUNT_BANDWIDTH="qnap_08=400", and is
+shared equally between the mount's streams. Python read/write loops pass
+byte counts to throttle() to keep within the share; FFmpeg subprocesses
+are limited by stream count only. The current throughput_windows.py
+window can lower both per mount (ie, fewer qnap_08 streams during the
+daytime backup window).
+
+2026
+Python 3.7+
+'''
+
+import os
+import time
+import fcntl
+import tempfile
+import contextlib
+
+# Local import
+from checksum_maker import get_mount, get_mount_limits, DEFAULT_LIMIT
+import throughput_windows
+
+LOCK_DIR = os.environ.get('IO_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'transcode_io_locks'))
+WAIT = 2
+
+
+def get_bandwidths():
+    '''
+    Return MB/s per mount from IO_MOUNT_BANDWIDTH
+    '''
+    bandwidths = {}
+    for item in os.environ.get('IO_MOUNT_BANDWIDTH', '').split(','):
+        if '=' not in item:
+            continue
+        mount, limit = item.split('=', 1)
+        try:
+            bandwidths[mount.strip().lower()] = float(limit)
+        except ValueError:
+            print(f"Skipping invalid mount bandwidth: {item}")
+    return bandwidths
+
+
+def get_budget(mount):
+    '''
+    Return (streams, MB/s or None) for mount, lowered
+    by the current throughput window's caps
+    '''
+    streams = get_mount_limits().get(mount, DEFAULT_LIMIT)
+    bandwidth = get_bandwidths().get(mount)
+    window = throughput_windows.mount_caps().get(mount, {})
+    try:
+        if window.get('streams'):
+            streams = min(streams, int(window['streams']))
+        if window.get('bandwidth'):
+            bandwidth = min(bandwidth or float(window['bandwidth']), float(window['bandwidth']))
+    except (TypeError, ValueError):
+        print(f"Skipping invalid throughput window cap for {mount}: {window}")
+    return max(streams, 1), bandwidth
+
+
+def acquire(mount, timeout=None):
+    '''
+    Take one stream token for mount, waiting
+    while all slots are held. Returns token
+    '''
+    streams, bandwidth = get_budget(mount)
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    slot_name = mount.strip('/').replace('/', '_') or 'root'
+    start = time.time()
+    while True:
+        for slot in range(streams):
+            lock_path = os.path.join(LOCK_DIR, f"{slot_name}.{slot}.lock")
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            rate = bandwidth * 1024 * 1024 / streams if bandwidth else None
+            return {'mount': mount, 'slot': slot, 'fd': fd, 'rate': rate,
+                    'bytes': 0, 'start': time.perf_counter(), 'waited': round(time.time() - start, 1)}
+        if timeout is not None and time.time() - start > timeout:
+            raise TimeoutError(f"No I/O stream free on {mount} after {timeout} seconds")
+        time.sleep(WAIT)
+
+
+def release(token):
+    '''
+    Return stream token
+    '''
+    try:
+        fcntl.flock(token['fd'], fcntl.LOCK_UN)
+    finally:
+        os.close(token['fd'])
+
+
+@contextlib.contextmanager
+def mount_streams(*paths, timeout=None):
+    '''
+    Hold one stream token for each mount used by paths
+    '''
+    mounts = sorted({get_mount(path, get_mount_limits()) for path in paths if path})
+    tokens = []
+    try:
+        for mount in mounts:
+            tokens.append(acquire(mount, timeout))
+        yield tokens
+    finally:
+        for token in reversed(tokens):
+            release(token)
+
+
+def throttle(tokens, nbytes):
+    '''
+    Sleep as needed to keep bytes moved
+    within each token's bandwidth share
+    '''
+    delay = 0
+    for token in tokens or []:
+        token['bytes'] += nbytes
+        if not token['rate']:
+            continue
+        expected = token['bytes'] / token['rate']
+        delay = max(delay, expected - (time.perf_counter() - token['start']))
+    if delay > 0:
+        time.sleep(delay)
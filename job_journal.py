@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, CRASH SAFE JOURNAL OF PER FILE STAGES **
+If the server restarts mid job, a file's progress is only whatever is
+left in transcode/, the framemd5 folders and failures/, so the next run
+starts again from the encode (or trips over outputs FFmpeg '-n' won't
+overwrite). The journal records each stage a file completes so the next
+run resumes after the last one.
+
+Actions:
+1. record() writes a stage completion (ie, encoded, source-hashed,
+   verified) for a workflow and source file in one SQLite transaction,
+   with synchronous=FULL so a committed stage survives power loss. The
+   row holds the source's size and mtime, the size and mtime of each
+   artefact the stage made (ie, the V210 mov) and any values later
+   stages need (ie, the checksum or MediaConch result).
+2. resume_plan() reads the stages recorded since the file last finished
+   and returns those that can be skipped. A stage is skipped when the
+   source is unchanged, every journalled stage it depends on is also
+   skipped, and its artefacts are unchanged, or are no longer needed
+   because every stage that uses them is also skipped. Stages that are
+   not journalled are skipped when every stage that uses them is.
+3. finish() marks the file's run complete, so a later file at the same
+   path starts afresh. Files that stop part way keep their journal.
+
+stage_pipeline.run_pipeline() calls these when given a journal name.
+
+NOTE: SQLite needs the database on a local disk, not an NFS mount. The
+      default location is alongside the script logs.
+
+Command line use:
+    python3 job_journal.py show <workflow> <filepath>
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import sqlite3
+import datetime
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+JOURNAL_DB = os.environ.get('JOB_JOURNAL_DB', os.path.join(LOG, 'job_journal.db'))
+FINISHED = 'finished'
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS journal (
+        id INTEGER PRIMARY KEY,
+        workflow TEXT NOT NULL,
+        source TEXT NOT NULL,
+        source_stat TEXT,
+        stage TEXT NOT NULL,
+        artefacts TEXT,
+        data TEXT,
+        recorded TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_journal_source ON journal (workflow, source)'
+]
+
+
+def get_connection(db_path=None):
+    '''
+    Open journal connection in WAL mode with full sync,
+    creating tables and indexes where needed
+    '''
+    if db_path is None:
+        db_path = JOURNAL_DB
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.execute('PRAGMA busy_timeout=60000')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def file_stat(fpath):
+    '''
+    Return [size, mtime] of file, or None if missing
+    '''
+    try:
+        stat = os.stat(fpath)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def record(workflow, source, stage, artefacts=None, data=None, db_path=None):
+    '''
+    Write completed stage for source, with the size and
+    mtime of artefacts and values later stages need
+    '''
+    created = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    artefact_stats = {x: file_stat(x) for x in artefacts or []}
+    conn = get_connection(db_path)
+    try:
+        conn.execute(
+            'INSERT INTO journal (workflow, source, source_stat, stage, artefacts, data, recorded) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (workflow, source, json.dumps(file_stat(source)), stage,
+             json.dumps(artefact_stats), json.dumps(data or {}), created)
+        )
+    finally:
+        conn.close()
+
+
+def finish(workflow, source, db_path=None):
+    '''
+    Mark run of source complete
+    '''
+    record(workflow, source, FINISHED, db_path=db_path)
+
+
+def load(workflow, source, db_path=None):
+    '''
+    Return stage: (artefacts, data) recorded since the
+    source last finished, for the source as it is now
+    '''
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            'SELECT stage, source_stat, artefacts, data FROM journal WHERE workflow = ? AND source = ? ORDER BY id',
+            (workflow, source)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    current = file_stat(source)
+    stages = {}
+    for stage, source_stat, artefacts, data in rows:
+        if stage == FINISHED:
+            stages = {}
+        elif json.loads(source_stat) == current:
+            stages[stage] = (json.loads(artefacts), json.loads(data))
+    return stages
+
+
+def resume_plan(workflow, source, stages, db_path=None):
+    '''
+    Return pipeline stage name: data to restore for each
+    stage that needn't run again. stages are stage_pipeline
+    dictionaries, journalled where they have a 'journal' key
+    '''
+    recorded = load(workflow, source, db_path)
+    by_name = {x['name']: x for x in stages}
+    users = {x['name']: [y['name'] for y in stages if x['name'] in y.get('after', [])] for x in stages}
+
+    def valid(artefacts):
+        return all(file_stat(path) == stat for path, stat in artefacts.items())
+
+    skip = {x['name'] for x in stages
+            if x.get('always') or not x.get('journal') or x['journal'] in recorded}
+    changed = True
+    while changed:
+        changed = False
+        for name in sorted(skip):
+            stage = by_name[name]
+            if stage.get('always'):
+                continue
+            if not stage.get('journal'):
+                keep = users[name] and all(x in skip for x in users[name])
+            else:
+                artefacts = recorded[stage['journal']][0]
+                keep = (all(x in skip for x in stage.get('after', []))
+                        and (valid(artefacts) or (users[name] and all(x in skip for x in users[name]))))
+            if not keep:
+                skip.discard(name)
+                changed = True
+
+    return {name: recorded[by_name[name]['journal']][1] if by_name[name].get('journal') else {}
+            for name in skip if not by_name[name].get('always')}
+
+
+def main():
+    '''
+    Print journal of a workflow's source file
+    '''
+    if len(sys.argv) < 4 or sys.argv[1] != 'show':
+        sys.exit("Usage: job_journal.py show <workflow> <filepath>")
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            'SELECT recorded, stage, artefacts, data FROM journal WHERE workflow = ? AND source = ? ORDER BY id',
+            (sys.argv[2], sys.argv[3])
+        ).fetchall()
+    finally:
+        conn.close()
+    for recorded, stage, artefacts, data in rows:
+        print(f"{recorded}\t{stage}\t{', '.join(json.loads(artefacts))}\t{data}")
+
+
+if __name__ == '__main__':
+    main()
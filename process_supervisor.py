@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, SUPERVISION OF EXTERNAL COMMANDS **
+subprocess.call(ffmpeg_call) blocked with no view of progress and no
+limit, as did the mediainfo, mediaconch, mkvpropedit and diff calls,
+so one hung NFS read or wedged process held a job slot indefinitely.
+Every external command in the transcode scripts now runs under
+call() or check_output() here.
+
+Actions:
+1. FFmpeg commands are given '-progress pipe:<fd>' on a pipe of their
+   own (so framemd5s written to stdout are untouched), and frame, fps,
+   speed and out_time are read as the encode runs. Percent complete and
+   ETA come from the first input's duration.
+2. Every command is checked every POLL seconds for progress: FFmpeg's
+   frame count and output time, bytes read from its stdout, and the
+   I/O and CPU counters (/proc) of the command and its children (ie,
+   diff run under sudo). A command showing no progress for STALL
+   seconds (SUPERVISOR_STALL, default 600) is stalled, not counting
+   time it or this script were stopped by SIGSTOP: it is sent
+   SIGTERM, then SIGKILL after KILL_GRACE seconds, and
+   subprocess.TimeoutExpired is raised, so the stage or file fails and
+   is left in place for the next run.
+3. Progress for each running command is written every POLL seconds to
+   PROGRESS_DIR (progress/ beside the script logs) as JSON, named by the
+   script and command PIDs. Records are removed when a command ends,
+   except stalled ones, which transcode_scheduler.py reads when the job
+   exits to requeue the file, and logs with its queue reports.
+
+Use in a script, in place of subprocess.call / check_output:
+    returncode = process_supervisor.call(ffmpeg_call, label=fullpath)
+    output = process_supervisor.check_output(mediainfo_cmd, label=fullpath)
+
+Command line use (live progress of all supervised commands on the host):
+    python3 process_supervisor.py show
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+
+# Local import
+from file_lease import pid_alive
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+PROGRESS_DIR = os.environ.get('PROGRESS_DIR', os.path.join(LOG, 'progress'))
+STALL = int(os.environ.get('SUPERVISOR_STALL', 600))
+KILL_GRACE = 10
+POLL = 5
+HOST = socket.gethostname()
+
+
+def probe_duration(cmd):
+    '''
+    Return duration in seconds of FFmpeg
+    command's first input, or None
+    '''
+    if '-i' not in cmd or cmd.index('-i') + 1 >= len(cmd):
+        return None
+    probe = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        cmd[cmd.index('-i') + 1]
+    ]
+    try:
+        return float(subprocess.check_output(probe, timeout=60))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+
+
+def is_ffmpeg(cmd):
+    '''
+    True if command runs FFmpeg
+    '''
+    return os.path.basename(cmd[0]) == 'ffmpeg'
+
+
+def descendants(pid):
+    '''
+    Return pid and PIDs of all its children
+    '''
+    found = [pid]
+    for parent in found:
+        try:
+            for task in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{task}/children', 'r') as data:
+                    found.extend(int(x) for x in data.read().split())
+        except (OSError, ValueError):
+            continue
+    return found
+
+
+def activity(pid):
+    '''
+    Sum of characters read and written and CPU ticks
+    for pid and its children. Changes while it progresses
+    '''
+    total = 0
+    for proc in descendants(pid):
+        try:
+            with open(f'/proc/{proc}/io', 'r') as data:
+                for line in data:
+                    if line.startswith(('rchar:', 'wchar:')):
+                        total += int(line.split()[1])
+        except (OSError, ValueError):
+            pass
+        try:
+            with open(f'/proc/{proc}/stat', 'r') as data:
+                fields = data.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+
+def is_stopped(pid):
+    '''
+    True if pid is stopped (state T), ie
+    paused by the control plane with SIGSTOP
+    '''
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as data:
+            return data.read().rsplit(')', 1)[1].split()[0] in ('T', 't')
+    except (OSError, IndexError):
+        return False
+
+
+def record_path(pid):
+    '''
+    Progress record path for a command started by this script
+    '''
+    return os.path.join(PROGRESS_DIR, f'{os.getpid()}-{pid}.json')
+
+
+def write_record(record):
+    '''
+    Write progress record atomically, ignoring failures
+    so progress reporting never stops a command
+    '''
+    try:
+        os.makedirs(PROGRESS_DIR, exist_ok=True)
+        path = record_path(record['pid'])
+        with open(f'{path}.tmp', 'w') as data:
+            json.dump(record, data)
+        os.replace(f'{path}.tmp', path)
+    except OSError:
+        pass
+
+
+def remove_record(pid):
+    '''
+    Remove progress record of a finished command
+    '''
+    try:
+        os.remove(record_path(pid))
+    except OSError:
+        pass
+
+
+def read_progress(stream, progress):
+    '''
+    Read FFmpeg -progress key=value lines into
+    progress dictionary until the pipe closes
+    '''
+    for line in iter(stream.readline, b''):
+        key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+        if key in ('frame', 'fps', 'speed', 'out_time_us', 'total_size', 'progress'):
+            progress[key] = value
+
+
+def read_output(stream, chunks):
+    '''
+    Collect command stdout, counting bytes as progress
+    '''
+    for chunk in iter(lambda: stream.read(65536), b''):
+        chunks.append(chunk)
+
+
+def update_record(record, progress, chunks):
+    '''
+    Fill in progress figures and return the values
+    that must change while the command progresses
+    '''
+    record['updated'] = time.time()
+    if progress:
+        try:
+            record['frame'] = int(progress.get('frame', 0))
+            record['fps'] = float(progress.get('fps', 0))
+            record['out_time'] = round(int(progress.get('out_time_us', 0)) / 1000000, 1)
+        except ValueError:
+            pass
+        speed = progress.get('speed', '').rstrip('x').strip()
+        record['speed'] = float(speed) if speed.replace('.', '', 1).isdigit() else None
+        if record['duration'] and record.get('out_time') is not None:
+            record['percent'] = round(min(100.0, 100 * record['out_time'] / record['duration']), 1)
+            if record['speed']:
+                record['eta'] = round(max(0, record['duration'] - record['out_time']) / record['speed'])
+    return (progress.get('frame'), progress.get('out_time_us'), progress.get('total_size'),
+            sum(len(x) for x in chunks), activity(record['pid']))
+
+
+def stop(proc):
+    '''
+    Terminate stalled command, then kill if it
+    hasn't exited after KILL_GRACE seconds
+    '''
+    proc.terminate()
+    try:
+        proc.wait(timeout=KILL_GRACE)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        try:
+            proc.wait(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def run(cmd, label=None, capture=False, stall=None):
+    '''
+    Run command under supervision. Returns exit code and
+    stdout (if capture). Raises subprocess.TimeoutExpired
+    if the command is killed after stalling
+    '''
+    stall = STALL if stall is None else stall
+    cmd = list(cmd)
+    progress = {}
+    chunks = []
+    pass_fds = ()
+    read_fd = None
+    if is_ffmpeg(cmd) and '-progress' not in cmd:
+        read_fd, write_fd = os.pipe()
+        cmd = cmd[:1] + ['-progress', f'pipe:{write_fd}'] + cmd[1:]
+        pass_fds = (write_fd,)
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE if capture else None, pass_fds=pass_fds)
+    finally:
+        for fd in pass_fds:
+            os.close(fd)
+    readers = []
+    if read_fd is not None:
+        readers.append(threading.Thread(target=read_progress, args=(os.fdopen(read_fd, 'rb'), progress), daemon=True))
+    if capture:
+        readers.append(threading.Thread(target=read_output, args=(proc.stdout, chunks), daemon=True))
+    for reader in readers:
+        reader.start()
+
+    now = time.time()
+    record = {
+        'pid': proc.pid, 'parent': os.getpid(), 'host': HOST, 'label': label or cmd[-1],
+        'tool': os.path.basename(cmd[0]), 'status': 'running', 'started': now, 'progressed': now,
+        'duration': probe_duration(cmd) if is_ffmpeg(cmd) else None
+    }
+    last = None
+    stalled = False
+    polled = time.time()
+    while True:
+        try:
+            proc.wait(timeout=POLL)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+        current = update_record(record, progress, chunks)
+        # Time stopped by SIGSTOP (this script's poll or the command itself) isn't a stall
+        paused = record['updated'] - polled > 3 * POLL or is_stopped(proc.pid)
+        polled = record['updated']
+        if current != last or paused:
+            last = current
+            record['progressed'] = record['updated']
+        elif record['updated'] - record['progressed'] >= stall:
+            stalled = True
+            record['status'] = 'stalled'
+            write_record(record)
+            stop(proc)
+            break
+        write_record(record)
+
+    for reader in readers:
+        reader.join(timeout=KILL_GRACE)
+    output = b''.join(chunks)
+    if stalled:
+        raise subprocess.TimeoutExpired(cmd, stall, output=output)
+    remove_record(proc.pid)
+    return proc.returncode, output
+
+
+def call(cmd, label=None, stall=None):
+    '''
+    Supervised subprocess.call, returns exit code
+    '''
+    return run(cmd, label=label, stall=stall)[0]
+
+
+def check_output(cmd, label=None, stall=None):
+    '''
+    Supervised subprocess.check_output, returns stdout
+    bytes or raises subprocess.CalledProcessError
+    '''
+    returncode, output = run(cmd, label=label, capture=True, stall=stall)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output=output)
+    return output
+
+
+def read_records(parent=None):
+    '''
+    Return progress records on this host,
+    only those of one script if parent given
+    '''
+    records = []
+    try:
+        names = os.listdir(PROGRESS_DIR)
+    except OSError:
+        return records
+    for name in sorted(names):
+        if not name.endswith('.json') or (parent and not name.startswith(f'{parent}-')):
+            continue
+        try:
+            with open(os.path.join(PROGRESS_DIR, name), 'r') as data:
+                records.append(json.load(data))
+        except (OSError, ValueError):
+            continue
+    return records
+
+
+def clear_stalled(parent):
+    '''
+    Remove and return stalled records of a
+    finished script, for requeueing its file
+    '''
+    stalled = []
+    for record in read_records(parent):
+        if record.get('status') == 'stalled':
+            stalled.append(record)
+        try:
+            os.remove(os.path.join(PROGRESS_DIR, f"{parent}-{record['pid']}.json"))
+        except OSError:
+            pass
+    return stalled
+
+
+def prune():
+    '''
+    Remove records left by scripts that
+    are no longer running on this host
+    '''
+    for record in read_records():
+        if not pid_alive(record.get('parent')):
+            try:
+                os.remove(os.path.join(PROGRESS_DIR, f"{record['parent']}-{record['pid']}.json"))
+            except (OSError, KeyError):
+                pass
+
+
+def describe(record):
+    '''
+    One line summary of a progress record
+    '''
+    now = time.time()
+    text = f"{record['tool']} pid {record['pid']} {record['label']}"
+    if record.get('percent') is not None:
+        text += f": {record['percent']}%"
+    if record.get('fps'):
+        text += f" at {record['fps']} fps"
+    if record.get('speed'):
+        text += f" ({record['speed']}x)"
+    if record.get('eta') is not None:
+        text += f", ETA {record['eta'] // 60}m {record['eta'] % 60}s"
+    text += f", running {round(now - record['started'])}s, last progress {round(now - record['progressed'])}s ago"
+    if record.get('status') != 'running':
+        text += f" [{record['status'].upper()}]"
+    return text
+
+
+def main():
+    '''
+    Print live progress of supervised commands
+    '''
+    if len(sys.argv) < 2 or sys.argv[1] != 'show':
+        sys.exit("Usage: process_supervisor.py show")
+    prune()
+    records = read_records()
+    if not records:
+        print("No supervised commands running")
+    for record in records:
+        print(describe(record))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, SEGMENT PARALLEL ENCODING OF LONG FILES **
+A three hour tape is encoded by one FFmpeg process even when the queue
+is empty and most cores are idle. FFV1 (-g 1) and V210 are intra-only,
+so a file can be cut at any frame, encoded in ranges side by side and
+joined again without re-encoding.
+
+Actions:
+1. plan_segments() reads the source's duration and frame rate with
+   ffprobe and, where the file is longer than two SEGMENT_SECONDS and
+   SEGMENT_JOBS allows (SEGMENT_JOBS=0, the default, turns this off),
+   splits it into up to SEGMENT_JOBS frame ranges, no more than the
+   host's idle cores.
+2. Each range is encoded by its own FFmpeg, built from the script's
+   FFmpeg call: seeking to halfway before the first frame (so a frame
+   is never taken twice or missed, whatever the timestamp rounding)
+   and stopping after the range's frame count. The decoded frames are
+   split so the same FFmpeg also writes a framemd5 of the source range.
+   Video only, as audio is taken whole from the source in step 4.
+3. Each segment is verified as soon as it completes: its framemd5
+   (lutyuv trimmed, as the scripts' checks) must match the source
+   range hash for hash, and all but the last must hold exactly the
+   planned frames. A failing segment is encoded once more.
+4. The verified segments are joined with the concat demuxer as a stream
+   copy, audio and other streams copied from the source, so timestamps
+   run on from one segment to the next. The scripts' own whole file
+   framemd5 comparison then runs as normal.
+Segments run through process_supervisor.py and io_governor.py, and
+their space is reserved with space_preflight.py, as the segments and
+the joined output exist together until the join completes. encode()
+returns None where a file isn't split, so the script encodes as one
+process, and False if segment encoding fails, so it can fall back.
+
+Only FFmpeg calls without frame rate conversion (an 'fps' filter) are
+split, as frames dropped or repeated would move the range boundaries.
+
+2026
+Python 3.7+
+'''
+
+import os
+import math
+import shutil
+import logging
+import fractions
+import subprocess
+import concurrent.futures
+
+# Local import
+import io_governor
+import process_supervisor
+import space_preflight
+
+SEGMENT_JOBS = int(os.environ.get('SEGMENT_JOBS', 0))
+SEGMENT_SECONDS = int(os.environ.get('SEGMENT_SECONDS', 600))
+LUTYUV = "lutyuv=y=if(gt(val\\,1019)\\,1019\\,if(lt(val\\,4)\\,4\\,val)):u=if(gt(val\\,1019)\\,1019\\,if(lt(val\\,4)\\,4\\,val)):v=if(gt(val\\,1019)\\,1019\\,if(lt(val\\,4)\\,4\\,val))"
+# Options of the script's call left out of segment calls, with their argument count
+DROP = {'-map': 1, '-c:a': 1, '-acodec': 1, '-vf': 1, '-f': 1, '-truncate': 1, '-n': 0, '-y': 0, '-dn': 0, '-nostdin': 0}
+
+logger = logging.getLogger('segment_encode')
+
+
+def probe(fpath):
+    '''
+    Return duration (seconds) and frame rate
+    (Fraction) of first video stream, or (None, None)
+    '''
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=r_frame_rate:format=duration',
+        '-of', 'default=noprint_wrappers=1', fpath
+    ]
+    try:
+        output = subprocess.check_output(cmd, timeout=120).decode('utf-8')
+        values = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+        return float(values['duration']), fractions.Fraction(values['r_frame_rate'])
+    except (OSError, ValueError, KeyError, ZeroDivisionError, subprocess.SubprocessError):
+        return None, None
+
+
+def idle_cores():
+    '''
+    Cores not in use by load on this host
+    '''
+    return max(1, int((os.cpu_count() or 1) - os.getloadavg()[0]))
+
+
+def supported(ffmpeg_call):
+    '''
+    True if call can be split by frame ranges
+    '''
+    if '-i' not in ffmpeg_call or ffmpeg_call.count('-i') > 1:
+        return False
+    if '-vf' in ffmpeg_call and 'fps' in ffmpeg_call[ffmpeg_call.index('-vf') + 1]:
+        return False
+    return True
+
+
+def plan_segments(fpath, jobs=None):
+    '''
+    Return frame rate and list of (start frame, frame count)
+    ranges, count None for the last (to end of file). Empty
+    list where the file shouldn't be split
+    '''
+    jobs = SEGMENT_JOBS if jobs is None else jobs
+    duration, rate = probe(fpath)
+    if not duration or not rate or jobs < 2:
+        return rate, []
+    count = min(jobs, idle_cores(), int(duration // SEGMENT_SECONDS))
+    if count < 2:
+        return rate, []
+    total = int(round(duration * rate))
+    per = math.ceil(total / count)
+    segments = [(index * per, per) for index in range(count - 1)]
+    segments.append(((count - 1) * per, None))
+    return rate, segments
+
+
+def segment_call(ffmpeg_call, start, frames, rate, output, md5_output):
+    '''
+    Build FFmpeg call encoding one frame range of the script's
+    call to output, with framemd5 of the source frames
+    '''
+    index = ffmpeg_call.index('-i')
+    source = ffmpeg_call[index + 1]
+    video_filter = 'null'
+    options = []
+    args = ffmpeg_call[index + 2:-1]
+    position = 0
+    while position < len(args):
+        arg = args[position]
+        if arg == '-vf':
+            video_filter = args[position + 1]
+        if arg in DROP:
+            position += DROP[arg] + 1
+            continue
+        options.append(arg)
+        position += 1
+
+    seek = ['-ss', f"{float((start - fractions.Fraction(1, 2)) / rate):.6f}"] if start else []
+    limit = ['-frames:v', str(frames)] if frames else []
+    graph = f"[0:v:0]{video_filter},split=2[enc][chk];[chk]{LUTYUV}[md5]"
+    return [ffmpeg_call[0], '-nostdin'] + seek + ['-i', source, '-filter_complex', graph, '-map', '[enc]'] + \
+        options + limit + ['-f', 'mov', '-y', output] + \
+        ['-map', '[md5]'] + limit + ['-f', 'framemd5', '-y', md5_output]
+
+
+def read_hashes(md5_path):
+    '''
+    Return frame hashes (last column) of framemd5
+    '''
+    try:
+        with open(md5_path, 'r') as data:
+            return [line.rsplit(',', 1)[-1].strip() for line in data if line.strip() and not line.startswith('#')]
+    except OSError:
+        return []
+
+
+def segment_paths(folder, start):
+    '''
+    Return segment, source range framemd5 and
+    segment framemd5 paths for segment at start
+    '''
+    name = f"segment_{start:08d}"
+    return (os.path.join(folder, f"{name}.mov"),
+            os.path.join(folder, f"{name}.source.framemd5"),
+            os.path.join(folder, f"{name}.mov.framemd5"))
+
+
+def encode_segment(ffmpeg_call, rate, segment, folder, label):
+    '''
+    Encode and verify one segment, once more if it
+    fails. Returns segment path, or None if it failed
+    '''
+    start, frames = segment
+    name = f"segment_{start:08d}"
+    output, source_md5, output_md5 = segment_paths(folder, start)
+    source = ffmpeg_call[ffmpeg_call.index('-i') + 1]
+    check = ['ffmpeg', '-nostdin', '-y', '-i', output, '-vf', LUTYUV, '-f', 'framemd5', output_md5]
+    for attempt in (1, 2):
+        # A stall raises subprocess.TimeoutExpired, failing the file for requeue as a single encode would
+        with io_governor.mount_streams(source, output):
+            returncode = process_supervisor.call(segment_call(ffmpeg_call, start, frames, rate, output, source_md5),
+                                                 label=f"{label} frames {start}+{frames or 'end'}")
+        if returncode == 0:
+            process_supervisor.call(check, label=output)
+        expected = read_hashes(source_md5)
+        hashes = read_hashes(output_md5)
+        if returncode == 0 and hashes and hashes == expected and (frames is None or len(hashes) == frames):
+            return output
+        logger.warning("Segment %s of %s failed verification (attempt %s): exit %s, %s source and %s output frames",
+                       name, label, attempt, returncode, len(expected), len(hashes))
+    return None
+
+
+def concat_segments(ffmpeg_call, entries, output, folder, streams=None, rate=None):
+    '''
+    Join segments as a stream copy, with audio and other
+    streams copied from streams (default the source). An
+    entry is a segment path, or a (path, first frame, end
+    frame) range of a file, end None to its end, needing
+    rate. Returns exit code
+    '''
+    source = ffmpeg_call[ffmpeg_call.index('-i') + 1]
+    streams = streams or source
+    list_path = os.path.join(folder, 'segments.txt')
+    with open(list_path, 'w') as data:
+        for entry in entries:
+            if isinstance(entry, str):
+                data.write(f"file '{entry}'\n")
+                continue
+            path, first, end = entry
+            data.write(f"file '{path}'\n")
+            if first:
+                # Microseconds rounded up, so the seek lands on the first frame not the one before
+                data.write(f"inpoint {math.ceil(first * 1000000 / rate) / 1000000:.6f}\n")
+            if end is not None:
+                data.write(f"outpoint {float((end - fractions.Fraction(1, 2)) / rate):.6f}\n")
+                data.write(f"duration {float((end - first) / rate):.6f}\n")
+    metadata = []
+    if '-metadata:s:v:0' in ffmpeg_call:
+        metadata = ['-metadata:s:v:0', ffmpeg_call[ffmpeg_call.index('-metadata:s:v:0') + 1]]
+    cmd = [
+        ffmpeg_call[0], '-nostdin',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-i', streams,
+        '-map', '0:v', '-map', '1', '-map', '-1:v', '-dn',
+        '-c', 'copy', '-movflags', 'write_colr'
+    ] + metadata + ['-f', 'mov', '-y', output]
+    with io_governor.mount_streams(streams, output):
+        return process_supervisor.call(cmd, label=output)
+
+
+def encode(ffmpeg_call, size, label=None, jobs=None):
+    '''
+    Encode script's FFmpeg call as parallel segments joined
+    into its output. Returns True if made and verified, None
+    if not split (encode as one) or False if segments failed
+    '''
+    if not supported(ffmpeg_call):
+        return None
+    source = ffmpeg_call[ffmpeg_call.index('-i') + 1]
+    output = ffmpeg_call[-1]
+    label = label or source
+    rate, segments = plan_segments(source, jobs)
+    if not segments:
+        return None
+    folder = os.path.join(os.path.dirname(output), f".{os.path.basename(output)}.segments")
+    # Segments and joined output exist together until the join completes
+    reservation, figures = space_preflight.reserve(folder, size)
+    if reservation is None:
+        logger.info("Not splitting %s, no space for segments alongside output: %s", label, figures)
+        return None
+
+    logger.info("Encoding %s as %s segments of %s frames at %s fps", label, len(segments), segments[0][1], rate)
+    try:
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            paths = list(pool.map(lambda segment: encode_segment(ffmpeg_call, rate, segment, folder, label), segments))
+        if None in paths:
+            logger.warning("Segment encoding failed for %s, %s of %s segments verified", label,
+                           len([x for x in paths if x]), len(segments))
+            return False
+        if concat_segments(ffmpeg_call, paths, output, folder) != 0:
+            logger.warning("Joining segments failed for %s", label)
+            if os.path.isfile(output):
+                os.remove(output)
+            return False
+        return True
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+        space_preflight.release(reservation)
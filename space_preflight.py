@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, DISK SPACE PREFLIGHT FOR ENCODE OUTPUTS **
+FFV1 to V210 outputs are 2-3 times the size of the source, and a full
+transcode/ volume was only found when FFmpeg died hours into the encode.
+Before an encode starts its output size is predicted and reserved
+against the destination's free space, with every other in flight job
+on the server counted, and a job that cannot fit is held.
+
+Actions:
+1. predict_size() probes the source with ffprobe (codec, resolution,
+   frame rate, duration, audio streams) and estimates the output for
+   the job type: V210 from its fixed 128 bytes per 48 pixels per line,
+   ProRes 422 HQ from bytes per pixel, FFV1 re-encodes from the source
+   size, plus audio as PCM. Each estimate is then scaled by the median
+   actual/estimate ratio of the last HISTORY jobs of the same type, and
+   MARGIN is added on top.
+2. reserve() takes the destination's free space (statvfs), subtracts
+   the part of each other live reservation on the same filesystem not
+   yet written, and MIN_FREE_GB, and records a reservation if the output
+   fits. Reservations are in an SQLite database so every script on the
+   server shares them, and those of processes that have died are removed.
+   wait_reserve() retries every WAIT seconds, for up to HOLD_TIMEOUT,
+   while other jobs finish.
+3. release() removes the reservation once the encode ends and records
+   the actual output size of a completed encode, so predictions learn
+   from history.
+4. Where PREALLOCATE is set (SPACE_PREALLOCATE=1), preallocate() asks
+   the filesystem for the predicted extent up front ('fallocate
+   --keep-size') so the QNAP lays the output out contiguously, and
+   write_in_place() changes the FFmpeg call to write into it ('-y
+   -truncate 0' in place of '-n'). trim() frees any allocation left past
+   the end of the finished file. Filesystems that can't preallocate are
+   skipped.
+5. reserved() wraps these around a script's encode:
+    with space_preflight.reserved(source, output, job_type, ffmpeg_call) as space:
+        if space['reservation'] is None:
+            (hold the file, logging space['figures'])
+        if process_supervisor.call(space['call'], label=source) == 0:
+            space['complete'] = True
+
+NOTE: SQLite needs the database on a local disk, not an NFS mount. The
+      default location is alongside the script logs.
+
+Command line use:
+    python3 space_preflight.py predict <job_type> <source>
+    python3 space_preflight.py show
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import datetime
+import contextlib
+import statistics
+import subprocess
+
+# Local import
+from file_lease import pid_alive
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+SPACE_DB = os.environ.get('SPACE_DB', os.path.join(LOG, 'space_reservations.db'))
+MIN_FREE_GB = float(os.environ.get('SPACE_MIN_FREE_GB', 20))
+PREALLOCATE = os.environ.get('SPACE_PREALLOCATE', '') == '1'
+HOST = socket.gethostname()
+HOLD_TIMEOUT = int(os.environ.get('SPACE_HOLD_TIMEOUT', 600))
+HISTORY = 20
+MARGIN = 1.05
+WAIT = 60
+# ProRes 422 HQ averages 220Mb/s for 1080 line 29.97fps
+PRORES_HQ_BYTES_PER_PIXEL = 0.45
+# Output size as a share of source size where not calculated
+SOURCE_RATIOS = {
+    'ffv1_ffv1': 1.0,
+    'prores_h264': 0.1,
+    'ffv1_h264': 0.1
+}
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS reservations (
+        id INTEGER PRIMARY KEY,
+        output TEXT NOT NULL,
+        device INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        host TEXT,
+        pid INTEGER,
+        created TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY,
+        job_type TEXT NOT NULL,
+        estimate INTEGER NOT NULL,
+        actual INTEGER NOT NULL,
+        recorded TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_history_type ON history (job_type)'
+]
+
+
+def get_connection(db_path=None):
+    '''
+    Open database connection in WAL mode,
+    creating tables and indexes where needed
+    '''
+    if db_path is None:
+        db_path = SPACE_DB
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=60000')
+    for statement in SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def probe(fpath):
+    '''
+    Return ffprobe streams and format of
+    source as a dictionary, empty if unreadable
+    '''
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name,width,height,r_frame_rate,channels,sample_rate,bits_per_raw_sample,bits_per_sample:format=duration,size',
+        '-of', 'json', fpath
+    ]
+    try:
+        return json.loads(subprocess.check_output(cmd, timeout=120))
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return {}
+
+
+def frame_rate(rate):
+    '''
+    Convert '30000/1001' to float
+    '''
+    try:
+        num, _, den = rate.partition('/')
+        return float(num) / float(den or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def estimate_size(data, job_type, source_size):
+    '''
+    Estimate output bytes from probe data
+    '''
+    fmt = data.get('format', {})
+    duration = float(fmt.get('duration') or 0)
+    video = [x for x in data.get('streams', []) if x.get('codec_type') == 'video']
+    audio = [x for x in data.get('streams', []) if x.get('codec_type') == 'audio']
+    if job_type in SOURCE_RATIOS or not video or not duration:
+        return int(source_size * SOURCE_RATIOS.get(job_type, 1.0))
+
+    width = int(video[0].get('width') or 0)
+    height = int(video[0].get('height') or 0)
+    frames = duration * frame_rate(video[0].get('r_frame_rate'))
+    if job_type == 'v210_prores':
+        frame_bytes = width * height * PRORES_HQ_BYTES_PER_PIXEL
+    else:
+        # V210 lines hold 48 pixels in every 128 bytes
+        frame_bytes = -(-width // 48) * 128 * height
+    audio_bytes = 0
+    for stream in audio:
+        bits = int(stream.get('bits_per_raw_sample') or stream.get('bits_per_sample') or 24)
+        audio_bytes += int(stream.get('channels') or 2) * int(stream.get('sample_rate') or 48000) * bits / 8 * duration
+    return int(frame_bytes * frames + audio_bytes)
+
+
+def history_ratio(job_type, db_path=None):
+    '''
+    Median actual/estimate of recent jobs of
+    job_type, or 1.0 with too little history
+    '''
+    conn = get_connection(db_path)
+    try:
+        rows = conn.execute(
+            'SELECT estimate, actual FROM history WHERE job_type = ? ORDER BY id DESC LIMIT ?', (job_type, HISTORY)
+        ).fetchall()
+    finally:
+        conn.close()
+    ratios = [actual / estimate for estimate, actual in rows if estimate > 0]
+    return statistics.median(ratios) if len(ratios) >= 3 else 1.0
+
+
+def predict_size(fpath, job_type, db_path=None):
+    '''
+    Return {'estimate': bytes from the probe alone,
+    'bytes': estimate corrected by history plus margin}
+    '''
+    source_size = os.path.getsize(fpath)
+    estimate = estimate_size(probe(fpath), job_type, source_size)
+    ratio = history_ratio(job_type, db_path)
+    return {'job_type': job_type, 'estimate': estimate, 'ratio': round(ratio, 3),
+            'bytes': int(estimate * ratio * MARGIN)}
+
+
+def written(fpath):
+    '''
+    Bytes already written to output
+    '''
+    try:
+        return os.path.getsize(fpath)
+    except OSError:
+        return 0
+
+
+def reserve(output, size, db_path=None):
+    '''
+    Reserve size bytes for output if it fits in the
+    destination's free space after other reservations
+    Returns reservation dictionary, or None and reason
+    '''
+    folder = os.path.dirname(output) or '.'
+    device = os.stat(folder).st_dev
+    conn = get_connection(db_path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('SELECT id, output, bytes, pid FROM reservations WHERE host = ? AND device = ?',
+                            (HOST, device)).fetchall()
+        outstanding = 0
+        for row_id, row_output, row_bytes, pid in rows:
+            if not pid_alive(pid):
+                conn.execute('DELETE FROM reservations WHERE id = ?', (row_id,))
+                continue
+            outstanding += max(row_bytes - written(row_output), 0)
+        stats = os.statvfs(folder)
+        free = stats.f_bavail * stats.f_frsize
+        needed = size + outstanding + MIN_FREE_GB * 1024 ** 3
+        figures = (f"needs {round(size / 1024 ** 3, 1)}GB, {round(free / 1024 ** 3, 1)}GB free, "
+                   f"{round(outstanding / 1024 ** 3, 1)}GB reserved by {len(rows)} other job(s), "
+                   f"{MIN_FREE_GB}GB kept free")
+        if needed > free:
+            conn.execute('COMMIT')
+            return None, figures
+        cursor = conn.execute(
+            'INSERT INTO reservations (output, device, bytes, host, pid, created) VALUES (?, ?, ?, ?, ?, ?)',
+            (output, device, size, HOST, os.getpid(), datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return {'id': cursor.lastrowid, 'output': output, 'bytes': size}, figures
+
+
+def wait_reserve(output, size, timeout=0, db_path=None):
+    '''
+    Retry reserve() every WAIT seconds for
+    up to timeout seconds while space frees
+    '''
+    start = time.time()
+    while True:
+        reservation, figures = reserve(output, size, db_path)
+        if reservation or time.time() - start + WAIT > timeout:
+            return reservation, figures
+        time.sleep(WAIT)
+
+
+def release(reservation, prediction=None, db_path=None):
+    '''
+    Remove reservation, and where given the prediction of a
+    completed output record its actual size against the estimate
+    '''
+    actual = written(reservation['output'])
+    conn = get_connection(db_path)
+    try:
+        conn.execute('DELETE FROM reservations WHERE id = ?', (reservation['id'],))
+        if prediction and prediction['estimate'] > 0 and actual > 0:
+            conn.execute('INSERT INTO history (job_type, estimate, actual, recorded) VALUES (?, ?, ?, ?)',
+                         (prediction['job_type'], prediction['estimate'], actual,
+                          datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+    finally:
+        conn.close()
+    return actual
+
+
+def preallocate(output, size):
+    '''
+    Allocate size bytes to a new, empty output file
+    without changing its length. Returns True if done
+    '''
+    if os.path.exists(output):
+        return False
+    try:
+        open(output, 'xb').close()
+        subprocess.run(['fallocate', '--keep-size', '-l', str(size), output],
+                       check=True, stderr=subprocess.DEVNULL, timeout=600)
+    except (OSError, subprocess.SubprocessError):
+        if os.path.exists(output) and os.path.getsize(output) == 0:
+            os.remove(output)
+        return False
+    return True
+
+
+def write_in_place(ffmpeg_call):
+    '''
+    Return FFmpeg call that writes into a preallocated
+    output instead of refusing it ('-n') or truncating it
+    '''
+    call = list(ffmpeg_call)
+    if '-n' in call:
+        call.remove('-n')
+    return call[:-1] + ['-y', '-truncate', '0', call[-1]]
+
+
+def trim(output):
+    '''
+    Free allocation left past the end of a finished
+    output by extending it one byte and truncating back
+    '''
+    try:
+        size = os.path.getsize(output)
+        with open(output, 'r+b') as data:
+            data.truncate(size + 1)
+            data.truncate(size)
+    except OSError:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def reserved(source, output, job_type, ffmpeg_call=None, timeout=None, db_path=None):
+    '''
+    Predict and reserve output space for the with block. Yields
+    dictionary of reservation (None if the output won't fit),
+    figures for the log and the FFmpeg call to run, preallocated
+    where enabled. Set 'complete' to record the size in history
+    '''
+    prediction = predict_size(source, job_type, db_path)
+    timeout = HOLD_TIMEOUT if timeout is None else timeout
+    reservation, figures = wait_reserve(output, prediction['bytes'], timeout, db_path)
+    space = {'reservation': reservation, 'figures': figures, 'prediction': prediction,
+             'call': ffmpeg_call, 'preallocated': False, 'complete': False}
+    if reservation is None:
+        yield space
+        return
+    if PREALLOCATE and ffmpeg_call and preallocate(output, prediction['bytes']):
+        space['preallocated'] = True
+        space['call'] = write_in_place(ffmpeg_call)
+    try:
+        yield space
+    finally:
+        if space['preallocated']:
+            trim(output)
+        release(reservation, prediction if space['complete'] else None, db_path)
+
+
+def main():
+    '''
+    Print prediction for a source, or live
+    reservations and recent history
+    '''
+    if len(sys.argv) < 2 or sys.argv[1] not in ('predict', 'show'):
+        sys.exit("Usage: space_preflight.py predict <job_type> <source> | show")
+    if sys.argv[1] == 'predict':
+        if len(sys.argv) < 4:
+            sys.exit("Usage: space_preflight.py predict <job_type> <source>")
+        print(json.dumps(predict_size(sys.argv[3], sys.argv[2]), indent=4))
+        return
+    conn = get_connection()
+    try:
+        reservations = conn.execute('SELECT created, host, pid, bytes, output FROM reservations ORDER BY id').fetchall()
+        history = conn.execute('SELECT job_type, COUNT(*), AVG(actual * 1.0 / estimate) FROM history GROUP BY job_type').fetchall()
+    finally:
+        conn.close()
+    for created, host, pid, size, output in reservations:
+        print(f"{created}\t{host}\t{pid}\t{round(size / 1024 ** 3, 1)}GB\t{output}")
+    for job_type, count, ratio in history:
+        print(f"{job_type}: {count} jobs, mean actual/estimate {round(ratio, 3)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, STAGE PIPELINED EXECUTOR **
+Runs the per file steps of a transcode script as stages of a small DAG,
+so that one file can be encoding while another is being hashed or moved.
+Previously each file held a GNU parallel slot through probe, encode,
+framemd5, diff, mediaconch, checksum and move in turn, so a slot waiting
+on a NAS move blocked a CPU that could be encoding.
+
+Actions of run_pipeline():
+1. Each stage is a dictionary of name, func, pool and after (the names of
+   stages that must complete first for the same file). Stages sharing no
+   dependency run at the same time, ie, the source framemd5 can run
+   alongside the encode.
+2. Each pool ('cpu', 'decode', 'io') is a separately sized worker pool, so
+   encodes, decode passes and NAS reads/writes each have their own limit.
+3. Each stage admits at most pool size + queue_size files at once, further
+   files wait in that stage's queue. No more than the total of all pool
+   sizes + queue_size files are in the pipeline at once, so new files are
+   held back rather than work piling up between stages.
+4. func(context) receives a dictionary for the file and returns True to
+   continue to the next stages or False to stop that file (ie, a framemd5
+   mismatch handled by the stage itself). An exception stops the file and
+   is stored in context['error'].
+5. on_complete(context) is called once per file when it has finished or
+   stopped, from the worker thread, and all contexts are returned in
+   input order.
+6. Where a journal name is given, each stage with a 'journal' key has its
+   completion written to job_journal.py with the paths from its
+   'artefacts' function and the context keys listed in 'keep'. Stages the
+   journal shows already complete (ie, an encode finished before a
+   restart) are not run again, their kept keys are restored to the
+   context and their names listed in context['resumed']. Stages marked
+   'always' (ie, probe, which takes the file lease) run every time.
+   A file that completes every stage is marked finished in the journal.
+7. Where allowed(stage name) is given it is checked before each stage
+   runs (ie, throughput_windows.stage_allowed for the workflow). A stage
+   it refuses stops the file with its name in context['held'], and with
+   a journal the file resumes from that stage on its next run.
+
+2026
+Python 3.7+
+'''
+
+import threading
+import traceback
+import collections
+import concurrent.futures
+
+# Local import
+import job_journal
+
+POOL_SIZES = {
+    'cpu': 2,
+    'decode': 4,
+    'io': 4
+}
+QUEUE_SIZE = 2
+
+
+def run_pipeline(items, stages, pool_sizes=None, queue_size=QUEUE_SIZE, on_complete=None, journal=None, allowed=None):
+    '''
+    Run every item through the stage DAG
+    Returns list of context dictionaries
+    '''
+    sizes = dict(POOL_SIZES)
+    if pool_sizes:
+        sizes.update(pool_sizes)
+    by_name = {stage['name']: stage for stage in stages}
+    for stage in stages:
+        missing = [x for x in stage.get('after', []) if x not in by_name]
+        if missing:
+            raise ValueError(f"Stage {stage['name']} depends on unknown stage(s): {missing}")
+
+    pools = {name: concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+             for name, size in sizes.items()}
+    capacity = {stage['name']: sizes[stage['pool']] + queue_size for stage in stages}
+    active = {stage['name']: 0 for stage in stages}
+    waiting = {stage['name']: collections.deque() for stage in stages}
+    max_files = sum(sizes.values()) + queue_size
+    lock = threading.Lock()
+    finished = threading.Condition(lock)
+    contexts = []
+    remaining = [0]
+
+    def ready_stages(ctx):
+        return [x for x in stages if x['name'] not in ctx['_submitted']
+                and all(dep in ctx['_done'] for dep in x.get('after', []))]
+
+    def submit(stage, ctx):
+        # Called with lock held, queues file at stage if stage is full
+        ctx['_submitted'].add(stage['name'])
+        ctx['_inflight'] += 1
+        if active[stage['name']] < capacity[stage['name']]:
+            active[stage['name']] += 1
+            pools[stage['pool']].submit(run_stage, stage, ctx)
+        else:
+            waiting[stage['name']].append(ctx)
+
+    def release(stage):
+        # Called with lock held, admits next waiting file to stage
+        active[stage['name']] -= 1
+        if waiting[stage['name']]:
+            active[stage['name']] += 1
+            pools[stage['pool']].submit(run_stage, stage, waiting[stage['name']].popleft())
+
+    def run_stage(stage, ctx):
+        try:
+            if stage['name'] in ctx['_resume']:
+                ctx.update(ctx['_resume'][stage['name']])
+                ctx['resumed'].append(stage['name'])
+                result = True
+            elif allowed and not allowed(stage['name']):
+                ctx['held'] = stage['name']
+                result = False
+            else:
+                result = stage['func'](ctx)
+                if journal and stage.get('journal') and result is not False:
+                    artefacts = stage['artefacts'](ctx) if stage.get('artefacts') else []
+                    data = {x: ctx[x] for x in stage.get('keep', []) if x in ctx}
+                    job_journal.record(journal, ctx['item'], stage['journal'], artefacts, data)
+        except Exception as err:
+            ctx['error'] = f"{stage['name']}: {err}\n{traceback.format_exc()}"
+            result = False
+
+        with lock:
+            release(stage)
+            ctx['_inflight'] -= 1
+            if result is False:
+                ctx['stopped'] = stage['name']
+            elif not ctx['stopped']:
+                ctx['_done'].add(stage['name'])
+                for item in ready_stages(ctx):
+                    submit(item, ctx)
+            done = ctx['_inflight'] == 0
+        if done:
+            complete(ctx)
+
+    def complete(ctx):
+        if journal and not ctx['stopped'] and len(ctx['_done']) == len(stages):
+            try:
+                job_journal.finish(journal, ctx['item'])
+            except Exception:
+                traceback.print_exc()
+        if on_complete:
+            try:
+                on_complete(ctx)
+            except Exception:
+                traceback.print_exc()
+        with finished:
+            remaining[0] -= 1
+            finished.notify_all()
+
+    try:
+        for item in items:
+            ctx = {'item': item, 'stopped': None, 'error': None, 'resumed': [], 'held': None,
+                   '_done': set(), '_submitted': set(), '_inflight': 0, '_resume': {}}
+            if journal:
+                try:
+                    ctx['_resume'] = job_journal.resume_plan(journal, item, stages)
+                except Exception:
+                    traceback.print_exc()
+            contexts.append(ctx)
+            with finished:
+                while remaining[0] >= max_files:
+                    finished.wait()
+                remaining[0] += 1
+                first = ready_stages(ctx)
+                for stage in first:
+                    submit(stage, ctx)
+            if not first:
+                complete(ctx)
+
+        with finished:
+            while remaining[0] > 0:
+                finished.wait()
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+
+    return contexts
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, REMUX ONLY BLUEFISH TBC FIX **
+The BlueFish TBC fix decoded and re-encoded every FFV1 frame (setfield
+and fps filters, -c:v ffv1) only to replace a 1/1000 timebase with a
+constant frame rate, then decoded both files again to verify. Where a
+file's timestamps are already regular, the same fix is made as a
+stream copy, so no frame is decoded or encoded.
+
+Actions:
+1. regular_timestamps() reads the video packet timestamps with ffprobe
+   (demux only) and checks each lies within TOLERANCE seconds of a
+   constant frame rate grid from the first. Files with gaps, repeats
+   or drift are re-encoded with the fps filter as before.
+2. remux_call() builds an FFmpeg stream copy that rewrites the video
+   timestamps to the exact frame grid (setts bitstream filter) and
+   sets the frame rate, which the Matroska muxer writes as the track's
+   DefaultDuration. Audio and other streams are copied untouched.
+3. set_header() sets the field order (FlagInterlaced and FieldOrder)
+   in the new file's track header with mkvpropedit, and the script sets
+   DAR as for its source.
+4. packet_framemd5() hashes every packet of a file without decoding,
+   and packets_match() compares size and hash of every packet, stream
+   by stream, of the source and new file, ignoring the rewritten
+   timestamps. The new file's frame rate must read back as requested.
+   A remux failing verification has its packet framemd5s renamed
+   'failed_' by the script, which then re-encodes the file next run.
+
+Set TBC_REMUX=0 to re-encode every file.
+
+Use in a script:
+    regular, note = tbc_remux.regular_timestamps(fullpath, fps)
+    if regular:
+        ffmpeg_call = tbc_remux.remux_call(fullpath, outpath, fps)
+
+2026
+Python 3.7+
+'''
+
+import os
+import fractions
+import subprocess
+
+# Local import
+import io_governor
+import process_supervisor
+import segment_encode
+
+ENABLED = os.environ.get('TBC_REMUX', '1') != '0'
+TOLERANCE = 0.0015
+FIELD_ORDER = {
+    'tff': ('1', '1'),
+    'bff': ('1', '6'),
+    'prog': ('2', '0')
+}
+
+
+def frame_rate(fps):
+    '''
+    Return fps string from mediainfo as Fraction, or None
+    '''
+    try:
+        rate = fractions.Fraction(str(fps).strip()).limit_denominator(1001)
+    except (ValueError, ZeroDivisionError):
+        return None
+    return rate if rate > 0 else None
+
+
+def regular_timestamps(fpath, fps):
+    '''
+    Check video packet timestamps fall on a constant
+    fps grid. Returns True or False and note for log
+    '''
+    rate = frame_rate(fps)
+    if not rate:
+        return False, f"Frame rate '{fps}' not recognised, re-encoding"
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time',
+        '-of', 'csv=p=0', fpath
+    ]
+    try:
+        with io_governor.mount_streams(fpath):
+            output = process_supervisor.check_output(cmd, label=fpath).decode('utf-8')
+    except subprocess.TimeoutExpired:
+        raise
+    except subprocess.CalledProcessError:
+        return False, "Packet timestamps could not be read, re-encoding"
+    times = [x.strip().rstrip(',') for x in output.splitlines() if x.strip()]
+    if not times:
+        return False, "No video packets found, re-encoding"
+    try:
+        times = [float(x) for x in times]
+    except ValueError:
+        return False, "Video packets without timestamps, re-encoding"
+    for index, pts in enumerate(times):
+        expected = times[0] + float(index / rate)
+        if abs(pts - expected) > TOLERANCE:
+            return False, f"Irregular timestamps from packet {index} ({pts}s, {round(expected, 3)}s expected at {rate} fps), re-encoding"
+    return True, f"Timestamps of {len(times)} video packets regular at {rate} fps, remuxing without re-encode"
+
+
+def remux_call(fullpath, outpath, fps):
+    '''
+    FFmpeg stream copy rewriting video timestamps
+    to a constant frame rate, with DefaultDuration
+    '''
+    rate = frame_rate(fps)
+    return [
+        'ffmpeg',
+        '-i', fullpath,
+        '-nostdin',
+        '-map', '0',
+        '-c', 'copy',
+        '-bsf:v', f"setts=ts=STARTPTS+N*{rate.denominator}/({rate.numerator}*TB)",
+        '-r', str(rate),
+        '-n', outpath
+    ]
+
+
+def set_header(fpath, setfield):
+    '''
+    Set field order of video track with
+    mkvpropedit. Returns True if written
+    '''
+    if setfield not in FIELD_ORDER:
+        return False
+    interlaced, order = FIELD_ORDER[setfield]
+    cmd = [
+        'mkvpropedit', fpath,
+        '--edit', 'track:v1',
+        '--set', f'flag-interlaced={interlaced}',
+        '--set', f'field-order={order}'
+    ]
+    try:
+        confirmed = process_supervisor.check_output(cmd, label=fpath).decode('utf-8')
+    except subprocess.TimeoutExpired:
+        raise
+    except subprocess.CalledProcessError:
+        return False
+    return 'The changes are written to the file.' in confirmed
+
+
+def packet_framemd5(fpath, output_md5):
+    '''
+    Hash every packet of file without decoding
+    '''
+    cmd = [
+        'ffmpeg', '-nostdin', '-y',
+        '-i', fpath,
+        '-map', '0', '-c', 'copy',
+        '-f', 'framemd5', output_md5
+    ]
+    with io_governor.mount_streams(fpath, output_md5):
+        process_supervisor.call(cmd, label=fpath)
+    return output_md5
+
+
+def read_packets(md5_path):
+    '''
+    Return size and hash of each packet in
+    framemd5 by stream, without timestamps
+    '''
+    streams = {}
+    with open(md5_path, 'r') as data:
+        for line in data:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = [x.strip() for x in line.split(',')]
+            streams.setdefault(fields[0], []).append((fields[-2], fields[-1]))
+    return streams
+
+
+def packets_match(md5_source, md5_output):
+    '''
+    True if every packet of every stream matches in
+    size and hash, in order. Streams are compared apart
+    as new timestamps may interleave them differently
+    '''
+    try:
+        source = read_packets(md5_source)
+        output = read_packets(md5_output)
+    except (OSError, IndexError):
+        return False
+    return bool(source) and source == output
+
+
+def rate_matches(fpath, fps):
+    '''
+    True if file's frame rate reads back as fps
+    '''
+    return segment_encode.probe(fpath)[1] == frame_rate(fps)
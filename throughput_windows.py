@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, CALENDAR THROUGHPUT WINDOWS **
+The NAS and network are shared with backups and ingest at predictable
+times, and the only lever was turning rna_transcode/ofcom_transcode off
+in downtime_control.json. Windows set how hard each workflow may run at
+each time of the week.
+
+Windows are read from WINDOWS_JSON (throughput_windows.json beside the
+script logs), eg:
+    {"windows": [
+        {"name": "daytime", "days": "mon-fri", "start": "07:00", "end": "19:00",
+         "workflows": {"h22_ffv1_v210": {"jobs": 4, "stages": ["verify", "move"], "target": 6},
+                       "all": {"jobs": 2}},
+         "mounts": {"qnap_08": {"streams": 2, "bandwidth": 150}}},
+        {"name": "overnight", "days": "*", "start": "19:00", "end": "07:00",
+         "workflows": {"h22_ffv1_v210": {"jobs": 16, "target": 20}}}
+    ]}
+The first window matching the current day and time applies. A window
+ending before it starts runs overnight, with days giving the day it
+starts. Outside all windows there are no limits.
+
+Actions:
+1. workflow_settings() returns the current window's job limit, allowed
+   stages and target files per hour for a workflow (its own entry, else
+   "all"). transcode_scheduler.py launches no more jobs than the limit.
+2. stage_allowed() checks a stage pipeline stage against the window's
+   allowed stages, by stage name or group in STAGE_GROUPS (encode,
+   verify, move). Probe always runs. When encode isn't allowed the
+   scheduler only launches files whose job journal shows a completed
+   encode, so verification carries on during the day.
+3. mount_caps() returns the window's stream and bandwidth (MB/s) caps
+   per mount, applied by io_governor.py on top of its own limits.
+
+Command line use:
+    python3 throughput_windows.py show [<workflow>]
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import datetime
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+WINDOWS_JSON = os.environ.get('THROUGHPUT_WINDOWS', os.path.join(LOG, 'throughput_windows.json'))
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+STAGE_GROUPS = {
+    'encode': ['encode'],
+    'verify': ['framemd5_mkv', 'framemd5_mov', 'diff', 'checksum', 'conformance', 'deliver'],
+    'move': ['clean_up']
+}
+ALWAYS = ('probe',)
+
+_cache = {'key': None, 'windows': []}
+
+
+def load_windows(path=None):
+    '''
+    Return list of windows, re-read only
+    when the file changes
+    '''
+    path = path or WINDOWS_JSON
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return []
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if _cache['key'] != key:
+        try:
+            with open(path, 'r') as data:
+                windows = json.load(data).get('windows', [])
+        except (OSError, ValueError, AttributeError):
+            windows = []
+        _cache['key'] = key
+        _cache['windows'] = windows
+    return _cache['windows']
+
+
+def parse_days(days):
+    '''
+    Return set of weekday numbers from '*',
+    'mon-fri' or 'sat,sun' style text
+    '''
+    if not days or days == '*':
+        return set(range(7))
+    found = set()
+    for part in days.lower().split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = (DAYS.index(x.strip()[:3]) for x in part.split('-', 1))
+            index = first
+            while True:
+                found.add(index)
+                if index == last:
+                    break
+                index = (index + 1) % 7
+        elif part[:3] in DAYS:
+            found.add(DAYS.index(part[:3]))
+    return found
+
+
+def in_window(window, now):
+    '''
+    True if now falls within window
+    '''
+    days = parse_days(window.get('days', '*'))
+    start = datetime.time.fromisoformat(window.get('start', '00:00'))
+    end = datetime.time.fromisoformat(window.get('end', '00:00'))
+    time_now = now.time()
+    if start < end:
+        return now.weekday() in days and start <= time_now < end
+    # Runs overnight (or all day where start equals end)
+    if time_now >= start:
+        return now.weekday() in days
+    return time_now < end and (now.weekday() - 1) % 7 in days
+
+
+def current_window(now=None, path=None):
+    '''
+    Return first window containing now, or None
+    '''
+    now = now or datetime.datetime.now()
+    for window in load_windows(path):
+        try:
+            if in_window(window, now):
+                return window
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+def workflow_settings(workflow, now=None, path=None):
+    '''
+    Return window name, job limit, allowed stages and
+    target files per hour for workflow (None if unset)
+    '''
+    window = current_window(now, path)
+    if not window:
+        return {'window': None, 'jobs': None, 'stages': None, 'target': None}
+    entries = window.get('workflows', {})
+    entry = entries.get(workflow, entries.get('all', {}))
+    return {
+        'window': window.get('name', f"{window.get('start')}-{window.get('end')}"),
+        'jobs': entry.get('jobs'),
+        'stages': entry.get('stages'),
+        'target': entry.get('target')
+    }
+
+
+def allows(stages, stage):
+    '''
+    True if stage is named in a window's stages
+    list, directly or by group (None allows all)
+    '''
+    if stages is None or stage in ALWAYS:
+        return True
+    for allowed in stages:
+        if stage == allowed or stage in STAGE_GROUPS.get(allowed, []):
+            return True
+    return False
+
+
+def stage_allowed(workflow, stage, now=None, path=None):
+    '''
+    True if the current window lets workflow
+    run the named stage pipeline stage
+    '''
+    return allows(workflow_settings(workflow, now, path)['stages'], stage)
+
+
+def mount_caps(now=None, path=None):
+    '''
+    Return mount: {'streams': n, 'bandwidth': MB/s}
+    for the current window. A number alone is bandwidth
+    '''
+    window = current_window(now, path)
+    caps = {}
+    for mount, cap in (window or {}).get('mounts', {}).items():
+        if isinstance(cap, dict):
+            caps[mount.lower()] = cap
+        else:
+            caps[mount.lower()] = {'bandwidth': cap}
+    return caps
+
+
+def main():
+    '''
+    Print current window and a workflow's settings
+    '''
+    if len(sys.argv) < 2 or sys.argv[1] != 'show':
+        sys.exit("Usage: throughput_windows.py show [<workflow>]")
+    window = current_window()
+    print(f"Current window: {window.get('name') if window else 'none (no limits)'}")
+    if len(sys.argv) > 2:
+        print(json.dumps(workflow_settings(sys.argv[2]), indent=4))
+    print(json.dumps(mount_caps(), indent=4))
+
+
+if __name__ == '__main__':
+    main()
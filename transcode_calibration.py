@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+'''
+Offline calibration of concurrent jobs, FFmpeg threads and FFV1 slices
+for each transcode workflow, replacing the hard coded '--jobs 16',
+'--jobs 3' and '-slices 24' that have never been measured on our servers.
+
+Actions of 'run':
+1. Uses the sample files given, or makes a synthetic sample with FFmpeg
+   lavfi test sources in the workflow's source format (ie, PAL FFV1 mkv
+   for the V210 workflows, HD ProRes mov for the MP4 workflow).
+2. For every combination of CALIBRATE_JOBS, CALIBRATE_THREADS and (for
+   FFV1 encodes only) CALIBRATE_SLICES, runs that many copies of the
+   workflow's real encode command followed by its verification command
+   (framemd5 or full decode) at the same time.
+3. Reports aggregate frames per second across all jobs and mean per
+   file latency for each combination.
+4. Recommends the combination giving the lowest latency among those
+   within 5% of the best frames per second, and writes it to the
+   workflow's entry in PROFILES (transcode_profiles.json) along with
+   all results.
+
+transcode_scheduler.py, the stage pipeline scripts and the start scripts
+load the profile at start up with get_profile(), falling back to their
+previous fixed values when a workflow has not been calibrated. Each
+workflow's FFmpeg call takes the profile's threads for decode and
+encode, as measured, so the recommended jobs don't each use every core.
+
+Usage:
+    python3 transcode_calibration.py run <workflow> [<sample file> ...]
+    python3 transcode_calibration.py profile <workflow> <key> [<default>]
+
+Grid and sample settings can be changed with environment variables
+CALIBRATE_JOBS, CALIBRATE_THREADS, CALIBRATE_SLICES (comma separated),
+CALIBRATE_SECONDS and CALIBRATE_DIR (put on the workflow's NAS so the
+results include its I/O).
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import tempfile
+import datetime
+import subprocess
+import concurrent.futures
+
+LOG = os.environ.get('SCRIPT_LOG', '')
+PROFILES = os.environ.get('TRANSCODE_PROFILES', os.path.join(LOG, 'transcode_profiles.json'))
+JOBS = [int(x) for x in os.environ.get('CALIBRATE_JOBS', '1,2,4,8,16').split(',')]
+THREADS = [int(x) for x in os.environ.get('CALIBRATE_THREADS', '0,1,2,4').split(',')]
+SLICES = [int(x) for x in os.environ.get('CALIBRATE_SLICES', '4,16,24').split(',')]
+SECONDS = int(os.environ.get('CALIBRATE_SECONDS', 20))
+TOLERANCE = 0.95
+
+LUTYUV = "lutyuv=y=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):u=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val)):v=if(gt(val\,1019)\,1019\,if(lt(val\,4)\,4\,val))"
+
+# Source format, synthetic sample size, and output extension
+# of each workflow's encode (None where workflow only verifies)
+WORKFLOWS = {
+    'h22_ffv1_v210': {'source': 'ffv1', 'size': '720x576', 'output': '.mov'},
+    'ofcom_ffv1_v210': {'source': 'ffv1', 'size': '720x576', 'output': '.mov'},
+    'bluefish_tbc': {'source': 'ffv1', 'size': '720x576', 'output': '.mkv'},
+    'v210_prores': {'source': 'v210', 'size': '720x576', 'output': '.mov'},
+    'prores_mp4': {'source': 'prores', 'size': '1920x1080', 'output': '.mp4'},
+    'd3_memnon': {'source': 'ffv1', 'size': '720x608', 'output': None}
+}
+
+SOURCE_FORMATS = {
+    'ffv1': (['-c:v', 'ffv1', '-level', '3', '-g', '1', '-slicecrc', '1', '-slices', '24', '-pix_fmt', 'yuv422p10le'], '.mkv'),
+    'v210': (['-c:v', 'v210', '-pix_fmt', 'yuv422p10le'], '.mov'),
+    'prores': (['-c:v', 'prores_ks', '-profile:v', '3', '-pix_fmt', 'yuv422p10le'], '.mov')
+}
+
+
+def get_profile(workflow):
+    '''
+    Return calibrated profile for workflow,
+    or empty dictionary if not calibrated
+    '''
+    try:
+        with open(PROFILES, 'r') as data:
+            return json.load(data).get(workflow, {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_profile(workflow, profile):
+    '''
+    Write workflow profile into PROFILES,
+    keeping other workflows' profiles
+    '''
+    try:
+        with open(PROFILES, 'r') as data:
+            profiles = json.load(data)
+    except (OSError, ValueError):
+        profiles = {}
+    profiles[workflow] = profile
+    tmp = f"{PROFILES}.partial"
+    with open(tmp, 'w') as data:
+        json.dump(profiles, data, indent=4)
+    os.replace(tmp, PROFILES)
+
+
+def make_sample(source, size, folder):
+    '''
+    Make synthetic sample with moving test pattern
+    and tone in the workflow's source format
+    '''
+    codec_settings, ext = SOURCE_FORMATS[source]
+    sample = os.path.join(folder, f"calibrate_sample_{source}_{size}{ext}")
+    cmd = [
+        'ffmpeg', '-nostdin', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=25',
+        '-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=48000',
+        '-t', str(SECONDS)
+    ] + codec_settings + [
+        '-c:a', 'pcm_s24le',
+        sample
+    ]
+    subprocess.run(cmd, check=True)
+    return sample
+
+
+def frame_count(fpath):
+    '''
+    Count video frames with ffprobe
+    '''
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-count_packets',
+        '-show_entries', 'stream=nb_read_packets',
+        '-of', 'csv=p=0',
+        fpath
+    ]
+    return int(subprocess.check_output(cmd).decode('utf-8').strip().split(',')[0])
+
+
+def encode_command(workflow, src, out, threads, slices):
+    '''
+    Encode command matching the workflow script
+    '''
+    thread_opts = ['-threads', str(threads)]
+    cmd = ['ffmpeg', '-nostdin', '-y', '-v', 'error'] + thread_opts + ['-i', src] + thread_opts
+    if workflow in ('h22_ffv1_v210', 'ofcom_ffv1_v210'):
+        cmd += ['-map', '0', '-dn', '-c:v', 'v210', '-c:a', 'copy', '-f', 'mov']
+    elif workflow == 'bluefish_tbc':
+        cmd += ['-map', '0', '-c:v', 'ffv1', '-level', '3', '-g', '1', '-slicecrc', '1', '-slices', str(slices), '-c:a', 'copy']
+    elif workflow == 'v210_prores':
+        cmd += ['-map', '0', '-c:v', 'prores_ks', '-profile:v', '3', '-pix_fmt', 'yuv422p10le', '-vendor', 'ap10',
+                '-flags', '+ildct', '-c:a', 'pcm_s24le']
+    elif workflow == 'prores_mp4':
+        cmd += ['-c:v', 'libx264', '-preset', 'slow', '-pix_fmt', 'yuv420p', '-crf', '28', '-c:a', 'aac']
+    return cmd + [out]
+
+
+def verify_command(workflow, src, out, threads):
+    '''
+    Verification command matching the workflow script,
+    framemd5 for V210 outputs otherwise a full decode
+    '''
+    target = out or src
+    cmd = ['ffmpeg', '-nostdin', '-v', 'error', '-threads', str(threads), '-i', target]
+    if workflow in ('h22_ffv1_v210', 'ofcom_ffv1_v210'):
+        return cmd + ['-an', '-vf', LUTYUV, '-f', 'framemd5', '-']
+    return cmd + ['-f', 'null', '-']
+
+
+def run_point(workflow, samples, frames, folder, jobs, threads, slices):
+    '''
+    Run jobs copies of encode and verify at once
+    Returns result dictionary for the combination
+    '''
+    output = WORKFLOWS[workflow]['output']
+
+    def one(index):
+        src = samples[index % len(samples)]
+        out = os.path.join(folder, f"calibrate_out_{index}{output}") if output else None
+        tic = time.perf_counter()
+        try:
+            if out:
+                subprocess.run(encode_command(workflow, src, out, threads, slices), check=True)
+            subprocess.run(verify_command(workflow, src, out, threads),
+                           stdout=subprocess.DEVNULL, check=True)
+        finally:
+            if out and os.path.exists(out):
+                os.remove(out)
+        return time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        latencies = list(pool.map(one, range(jobs)))
+    wall = time.perf_counter() - tic
+    total_frames = sum(frames[samples[x % len(samples)]] for x in range(jobs))
+    return {
+        'jobs': jobs,
+        'threads': threads,
+        'slices': slices,
+        'fps': round(total_frames / wall, 1),
+        'latency': round(sum(latencies) / len(latencies), 1)
+    }
+
+
+def recommend(results):
+    '''
+    Lowest latency combination within
+    TOLERANCE of the best frames per second
+    '''
+    best_fps = max(x['fps'] for x in results)
+    close = [x for x in results if x['fps'] >= best_fps * TOLERANCE]
+    return min(close, key=lambda x: (x['latency'], x['jobs']))
+
+
+def calibrate(workflow, samples=None):
+    '''
+    Run calibration grid for workflow, save and
+    return recommended profile
+    '''
+    config = WORKFLOWS[workflow]
+    folder = tempfile.mkdtemp(prefix='calibrate_', dir=os.environ.get('CALIBRATE_DIR'))
+    made = []
+    try:
+        if not samples:
+            made = [make_sample(config['source'], config['size'], folder)]
+            samples = made
+        frames = {x: frame_count(x) for x in samples}
+        slices = SLICES if workflow == 'bluefish_tbc' else [None]
+
+        results = []
+        print(f"{'jobs':>5} {'threads':>8} {'slices':>7} {'fps':>9} {'latency':>9}")
+        for jobs in JOBS:
+            for threads in THREADS:
+                for slice_count in slices:
+                    result = run_point(workflow, samples, frames, folder, jobs, threads, slice_count)
+                    results.append(result)
+                    print(f"{jobs:>5} {threads:>8} {str(slice_count or '-'):>7} {result['fps']:>9} {result['latency']:>9}")
+    finally:
+        for sample in made:
+            os.remove(sample)
+        os.rmdir(folder)
+
+    best = recommend(results)
+    profile = {
+        'jobs': best['jobs'],
+        'threads': best['threads'],
+        'fps': best['fps'],
+        'latency': best['latency'],
+        'calibrated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'samples': [os.path.basename(x) for x in samples] if not made else ['synthetic'],
+        'results': results
+    }
+    if best['slices']:
+        profile['slices'] = best['slices']
+    save_profile(workflow, profile)
+    return profile
+
+
+def main():
+    '''
+    Command line calibration run or profile lookup
+    '''
+    if len(sys.argv) < 3 or sys.argv[1] not in ('run', 'profile') or sys.argv[2] not in WORKFLOWS:
+        sys.exit(f"Usage: transcode_calibration.py run <workflow> [<sample> ...] | profile <workflow> <key> [<default>]\n"
+                 f"Workflows: {', '.join(WORKFLOWS)}")
+
+    workflow = sys.argv[2]
+    if sys.argv[1] == 'profile':
+        if len(sys.argv) < 4:
+            sys.exit("Usage: transcode_calibration.py profile <workflow> <key> [<default>]")
+        default = sys.argv[4] if len(sys.argv) > 4 else ''
+        print(get_profile(workflow).get(sys.argv[3], default))
+        return
+
+    profile = calibrate(workflow, sys.argv[3:])
+    slices = f", {profile['slices']} slices" if 'slices' in profile else ''
+    print(f"Recommended for {workflow}: {profile['jobs']} jobs, {profile['threads']} threads{slices} "
+          f"({profile['fps']} fps, {profile['latency']}s per file). Written to {PROFILES}")
+
+
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,11 @@ function control {
 
 # Script start
 if [ "$EVENT" = "created" ]; then
+    # Ignore lease files written beside media by file_lease.py
+    case "$(basename "$INPUT")" in
+        .*.lease*) exit 0 ;;
+    esac
+
     log "Start"
 
     # Control check
@@ -86,6 +91,14 @@ if [ "$EVENT" = "created" ]; then
         exit 0
     fi
 
+    # Lease source for this script's PID so no other run or
+    # host can start on it, released automatically on exit
+    if ! python3 "${GIT_TRANSCODE}file_lease.py" claim "$INPUT" $$ > /dev/null; then
+        log "Source leased by another run or host: $(python3 "${GIT_TRANSCODE}file_lease.py" show "$INPUT")"
+        log "End"
+        exit 0
+    fi
+
     # Check that destination file does not already exist
     if [ -e "$DST" ]; then
         # A fixity-checked transcode already exists, quit
@@ -0,0 +1,852 @@
+#!/usr/bin/env python3
+
+'''
+Long running scheduler replacing the cron + find + GNU parallel launchers
+for the batch transcode workflows.
+
+Each *_start.sh script rebuilds a dump_text.txt list, passes it to a fixed
+'parallel --jobs' run and then waits for the slowest file before cron starts
+the next batch. This service keeps a live queue per workflow instead:
+1. The source paths of each workflow are watched by watch_folder.py
+   (inotify on local disks, size/mtime polling on NFS mounts) and each
+   file is queued as soon as it is complete, rather than after the
+   'find -mmin +30' wait of the launchers. Memnon MKVs are queued once
+   the paired XML has also arrived. Files already queued or running
+   are ignored.
+   A file left in place by a finished job (ie, for a repeat encoding
+   attempt) is not queued again until RETRY_DELAY seconds have passed.
+2. A dispatcher per workflow launches the workflow Python script for each
+   queued file as an asyncio subprocess, up to the workflow job limit.
+   The script runs the FFmpeg encode and checks exactly as when launched
+   by GNU parallel. Where a workflow has been calibrated by
+   transcode_calibration.py its recommended job count replaces the
+   default in WORKFLOWS.
+3. Before each launch admission_control.py compares live CPU idle, iowait
+   and available memory with the expected cost of the file (job type,
+   codec and resolution from ffprobe). If the host is saturated the file
+   is held and retried after ADMIT_RETRY seconds, so fewer HD jobs and
+   more SD jobs run at once. Admit and hold decisions are logged.
+4. The next file is picked from the queue by collection (SASE, NEFA, YFA,
+   NWFA from the path). Collections with a due date within DUE_SOON days
+   go first, otherwise the collection furthest below its weighted share
+   of expected run time, and within a collection the shortest file (by
+   ffprobe duration) first. Any file waiting over MAX_WAIT goes next.
+   Weights and due dates are read from collection_priorities.json, ie
+   {"NEFA": {"weight": 2, "due": "2026-12-01"}}. Wait times per
+   collection are logged with each launch and every REPORT_INTERVAL.
+5. When any job exits its slot is refilled straight away from the queue.
+   Exit code and run time for each file are logged. Where a job's
+   FFmpeg, mediainfo or other command was stopped after stalling (see
+   process_supervisor.py) the file is requeued straight away, up to
+   STALL_REQUEUES times. Progress of running jobs' commands (percent,
+   fps, speed and ETA) is logged every REPORT_INTERVAL.
+6. downtime_control.json is read before every launch. A workflow whose
+   control key (or power_off_all) is false stops launching new jobs but
+   leaves running jobs to complete. The JSON is also watched by
+   control_plane.py and changes are applied within seconds: each workflow
+   can be set to hold (no new launches), pause (running jobs and their
+   FFmpeg children are sent SIGSTOP, then SIGCONT when set back to run),
+   or drain (no new launches, unstarted work queue claims handed back,
+   logged when the last job ends), and its job limit can be lowered, which
+   stops the newest running jobs over the limit until slots free up.
+   Each job runs in its own process group so signals reach FFmpeg.
+   Stopped jobs' file leases are renewed every CONTROL_INTERVAL.
+7. Calendar windows in throughput_windows.json are checked every
+   CONTROL_INTERVAL. The current window can lower each workflow's job
+   limit (running jobs finish, fewer are launched) and restrict its
+   stages: when encodes aren't allowed only files whose job journal
+   shows a finished encode are launched, and the pipelined scripts stop
+   each file at the first stage the window refuses. Files completed and
+   GB processed per window are logged against the window's target files
+   per hour every REPORT_INTERVAL and when the window changes.
+8. SIGTERM / SIGINT stop new launches, continue any paused jobs, and the
+   service exits once all running jobs have finished.
+9. Where WORK_QUEUE names a folder on shared storage, the scheduler runs
+   as one node of several (see work_queue.py). Complete files are probed
+   and submitted to the shared queue instead of the local queue, and each
+   workflow claims jobs from the shared queue every QUEUE_POLL seconds
+   while it has free slots, only taking jobs whose mounts and cores this
+   host has. Claimed jobs then go through steps 3-5 as above, claims are
+   refreshed every CONTROL_INTERVAL, claims left by a crashed host are
+   requeued, and each job's exit code and run time are written to the
+   queue's results. Claims not yet started are returned on shutdown.
+
+Launch (one instance per server, via systemd or flock as per crontab):
+    python3 transcode_scheduler.py [workflow_name ...]
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+import datetime
+
+# Local import
+import watch_folder
+import admission_control
+import work_queue
+import control_plane
+import throughput_windows
+import job_journal
+import finalise_queue
+import file_lease
+import process_supervisor
+from transcode_calibration import get_profile
+
+# Global paths from server environmental variables
+LOG = os.environ.get('SCRIPT_LOG', '')
+CONTROL_JSON = os.path.join(LOG, 'downtime_control.json')
+CODE_PATH = os.path.dirname(os.path.abspath(__file__))
+PYTHON = os.environ.get('PY3_ENV', sys.executable)
+CONTROL_INTERVAL = 60
+RETRY_DELAY = 3600
+ADMIT_RETRY = 15
+PRIORITY_JSON = os.path.join(LOG, 'collection_priorities.json')
+COLLECTIONS = ('SASE', 'NEFA', 'YFA', 'NWFA')
+DEFAULT_DURATION = 3600
+DUE_SOON = 7
+MAX_WAIT = 86400
+PROBES = 4
+REPORT_INTERVAL = 3600
+QUEUE_POLL = 10
+STALL_REQUEUES = 2
+
+WORKFLOWS = {
+    'h22_ffv1_v210': {
+        'script': 'batch_transcode_h22_ffv1_v210.py',
+        'paths': [os.path.join(os.environ.get('H22_PATH_Q10', ''), 'lto/v210/NWFA/source')],
+        'extensions': ('.mkv',),
+        'recursive': False,
+        'jobs': 16,
+        'job_type': 'ffv1_v210',
+        'control': 'rna_transcode',
+        'journal': 'h22_ffv1_v210'
+    },
+    'ofcom_ffv1_v210': {
+        'script': 'batch_transcode_ofcom_ffv1_v210.py',
+        'paths': [os.environ.get('QNAP08_AUTOMATION', '')],
+        'extensions': ('.mkv',),
+        'recursive': False,
+        'jobs': 3,
+        'job_type': 'ffv1_v210',
+        'control': 'ofcom_transcode',
+        'journal': 'ofcom_ffv1_v210'
+    },
+    'bluefish_tbc': {
+        'script': 'f47_bluefish_ffv1_tbc_fix.py',
+        'paths': [os.environ.get('BLUEFISH_MKV', '')],
+        'extensions': ('.mkv',),
+        'recursive': False,
+        'jobs': 3,
+        'job_type': 'ffv1_ffv1',
+        'control': 'ofcom_transcode'
+    },
+    'prores_mp4': {
+        'script': 'batch_transcode_proresHD_mp4.py',
+        'paths': [os.environ.get('H22_FILM_PATH1', ''), os.environ.get('H22_FILM_PATH2', ''), os.environ.get('H22_FILM_PATH3', '')],
+        'extensions': ('.mov',),
+        'recursive': True,
+        'jobs': 2,
+        'job_type': 'prores_h264',
+        'control': 'ofcom_transcode'
+    },
+    'v210_prores': {
+        'script': 'batch_transcode_h22_v210_prores.py',
+        'paths': [os.path.join(os.environ.get('QNAP04_H22', ''), 'lto/prores/YFA/success/')],
+        'extensions': ('.mov',),
+        'recursive': False,
+        'jobs': 15,
+        'job_type': 'v210_prores',
+        'control': 'rna_transcode'
+    },
+    'd3_memnon': {
+        'script': 'd3_memnon_validation.py',
+        'paths': [os.path.join(os.environ.get('QNAP_08', ''), 'memnon_validation')],
+        'extensions': ('.mkv', '.MKV'),
+        'pair': '.xml',
+        'recursive': False,
+        'jobs': 2,
+        'job_type': 'ffv1_check',
+        'control': 'power_off_all'
+    }
+}
+
+# Setup logging
+logger = logging.getLogger('transcode_scheduler')
+hdlr = logging.FileHandler(os.path.join(LOG, 'transcode_scheduler.log'))
+formatter = logging.Formatter('%(asctime)s\t%(levelname)s\t%(message)s')
+hdlr.setFormatter(formatter)
+logger.addHandler(hdlr)
+logger.setLevel(logging.INFO)
+
+
+def check_control(control_key):
+    '''
+    Check control json for downtime requests
+    Returns True if workflow may launch jobs
+    '''
+    try:
+        with open(CONTROL_JSON) as control:
+            j = json.load(control)
+    except (OSError, ValueError) as err:
+        logger.warning("Unable to read %s, launches paused: %s", CONTROL_JSON, err)
+        return False
+    if not j.get('power_off_all', True):
+        return False
+    return bool(j.get(control_key, False))
+
+
+def new_state(name):
+    '''
+    Live queue state for one workflow
+    '''
+    return {
+        'name': name,
+        'pending': [],
+        'running': {},
+        'finished': {},
+        'jobs': get_profile(name).get('jobs', WORKFLOWS[name]['jobs']),
+        'costs': {},
+        'queued': {},
+        'served': {},
+        'active': set(),
+        'waits': {},
+        'probes': asyncio.Semaphore(PROBES),
+        'claims': {},
+        'submitted': {},
+        'procs': {},
+        'stopped': [],
+        'mode': 'run',
+        'limit': None,
+        'window': throughput_windows.workflow_settings(name),
+        'window_stats': {'started': time.time(), 'files': 0, 'bytes': 0},
+        'sizes': {},
+        'stalls': {},
+        'holding': None,
+        'wake': asyncio.Event()
+    }
+
+
+def get_collection(fpath):
+    '''
+    Collection of file from its path, as
+    routed by the scripts' change_path()
+    '''
+    for collection in COLLECTIONS:
+        if f"/{collection}/" in fpath:
+            return collection
+    return 'other'
+
+
+def load_priorities():
+    '''
+    Read collection weights and due dates from
+    PRIORITY_JSON, ie {"NEFA": {"weight": 2, "due": "2026-12-01"}}
+    Returns collection: (weight, due date or None)
+    '''
+    try:
+        with open(PRIORITY_JSON) as priorities:
+            data = json.load(priorities)
+    except (OSError, ValueError):
+        return {}
+
+    priorities = {}
+    for collection, conf in data.items():
+        try:
+            weight = max(float(conf.get('weight', 1)), 0.01)
+            due = datetime.date.fromisoformat(conf['due']) if conf.get('due') else None
+        except (AttributeError, TypeError, ValueError):
+            logger.warning("Invalid priority for %s in %s: %s", collection, PRIORITY_JSON, conf)
+            continue
+        priorities[collection] = (weight, due)
+    return priorities
+
+
+def expected_duration(state, fpath):
+    '''
+    Probed duration of file, or None
+    '''
+    return state['costs'].get(fpath, {}).get('duration')
+
+
+def pick_next(state, pending=None):
+    '''
+    Choose next pending file. A file waiting over MAX_WAIT goes first,
+    then collections with a due date within DUE_SOON days (soonest first),
+    then the collection furthest below its weighted share of expected
+    run time. Within a collection the shortest expected file goes first
+    '''
+    now = time.time()
+    pending = pending or state['pending']
+    oldest = min(pending, key=lambda x: state['queued'].get(x, now))
+    if now - state['queued'].get(oldest, now) > MAX_WAIT:
+        return oldest
+
+    priorities = load_priorities()
+    today = datetime.date.today()
+    by_collection = {}
+    for fpath in pending:
+        by_collection.setdefault(get_collection(fpath), []).append(fpath)
+
+    def weight(collection):
+        return priorities.get(collection, (1, None))[0]
+
+    # Collections returning to the queue start level with the others
+    # rather than claiming every slot to make up for time away
+    shares = {x: state['served'].get(x, 0) / weight(x) for x in by_collection}
+    staying = [shares[x] for x in by_collection if x in state['active']]
+    if staying:
+        for collection in by_collection:
+            if collection not in state['active'] and shares[collection] < min(staying):
+                shares[collection] = min(staying)
+                state['served'][collection] = shares[collection] * weight(collection)
+    state['active'] = set(by_collection)
+
+    def collection_key(collection):
+        due = priorities.get(collection, (1, None))[1]
+        if due and (due - today).days <= DUE_SOON:
+            return (0, due, shares[collection])
+        return (1, datetime.date.max, shares[collection])
+
+    collection = min(by_collection, key=collection_key)
+    return min(by_collection[collection], key=lambda x: (
+        expected_duration(state, x) is None,
+        expected_duration(state, x) or 0,
+        state['queued'].get(x, now)
+    ))
+
+
+def record_dispatch(state, fpath):
+    '''
+    Count file against its collection's share and
+    record its queue wait. Returns (collection, wait)
+    '''
+    collection = get_collection(fpath)
+    wait = time.time() - state['queued'].pop(fpath, time.time())
+    duration = expected_duration(state, fpath) or DEFAULT_DURATION
+    state['served'][collection] = state['served'].get(collection, 0) + duration
+    waits = state['waits'].setdefault(collection, {'started': 0, 'total': 0, 'max': 0})
+    waits['started'] += 1
+    waits['total'] += wait
+    waits['max'] = max(waits['max'], wait)
+    return collection, round(wait)
+
+
+def report_waits(state):
+    '''
+    Log started count, mean and max wait and
+    pending count per collection for workflow
+    '''
+    now = time.time()
+    pending = {}
+    for fpath in state['pending']:
+        pending.setdefault(get_collection(fpath), []).append(now - state['queued'].get(fpath, now))
+    for collection in sorted(set(state['waits']) | set(pending)):
+        waits = state['waits'].get(collection, {'started': 0, 'total': 0, 'max': 0})
+        mean = round(waits['total'] / waits['started']) if waits['started'] else 0
+        waiting = pending.get(collection, [])
+        logger.info("%s: %s started %s, mean wait %ss, max wait %ss, %s pending (oldest %ss)",
+                    state['name'], collection, waits['started'], mean, round(waits['max']),
+                    len(waiting), round(max(waiting, default=0)))
+
+
+def enqueue(state, fpath):
+    '''
+    Add file to workflow queue if not already
+    queued or running. Returns True if added
+    '''
+    if fpath in state['running'] or fpath in state['pending']:
+        return False
+    if time.time() - state['finished'].get(fpath, 0) < RETRY_DELAY:
+        return False
+    state['pending'].append(fpath)
+    state['queued'][fpath] = time.time()
+    state['wake'].set()
+    return True
+
+
+async def probe_file(state, fpath):
+    '''
+    Probe queued file for duration and cost so
+    the dispatcher can order the queue
+    '''
+    async with state['probes']:
+        if fpath in state['pending'] and fpath not in state['costs']:
+            state['costs'][fpath] = await admission_control.job_cost(fpath, WORKFLOWS[state['name']]['job_type'])
+            state['wake'].set()
+
+
+def slots(state):
+    '''
+    Job limit for workflow, lowered by control
+    plane and current throughput window
+    '''
+    jobs = state['jobs']
+    if state['limit'] is not None:
+        jobs = min(jobs, state['limit'])
+    if state['window']['jobs'] is not None:
+        jobs = min(jobs, int(state['window']['jobs']))
+    return jobs
+
+
+def window_ready(state, fpath):
+    '''
+    True if the throughput window allows an encode, or
+    the job journal shows the file's encode is complete
+    so only its checks and moves would run
+    '''
+    name = state['name']
+    stages = state['window']['stages']
+    if throughput_windows.allows(stages, 'encode'):
+        return True
+    journal = WORKFLOWS[name].get('journal')
+    if not journal or not throughput_windows.allows(stages, 'verify'):
+        return False
+    try:
+        return 'encoded' in job_journal.load(journal, fpath)
+    except Exception as err:
+        logger.warning("%s: Unable to read job journal for %s\n%s", name, fpath, err)
+        return False
+
+
+def report_window(state):
+    '''
+    Log files completed in the current throughput
+    window against its target files per hour
+    '''
+    stats = state['window_stats']
+    hours = max(time.time() - stats['started'], 1) / 3600
+    rate = stats['files'] / hours
+    target = state['window']['target']
+    progress = f", target {target}/hour ({round(100 * rate / float(target))}%)" if target else ''
+    logger.info("%s: window %s, %s files (%s GB) in %s hours, %s files/hour%s", state['name'],
+                state['window']['window'] or 'none', stats['files'], round(stats['bytes'] / 1024 ** 3, 1),
+                round(hours, 2), round(rate, 1), progress)
+
+
+def window_tick(states):
+    '''
+    Apply throughput window changes, reporting
+    each workflow's throughput for the window ended
+    '''
+    for name, state in states.items():
+        settings = throughput_windows.workflow_settings(name)
+        if settings == state['window']:
+            continue
+        if settings['window'] != state['window']['window']:
+            report_window(state)
+            state['window_stats'] = {'started': time.time(), 'files': 0, 'bytes': 0}
+        logger.info("%s: throughput window %s, job limit %s, stages %s, target %s files/hour", name,
+                    settings['window'] or 'none', settings['jobs'], settings['stages'] or 'all', settings['target'])
+        state['window'] = settings
+        state['wake'].set()
+
+
+def rebalance(state):
+    '''
+    Stop newest running jobs over the control plane limit
+    (all of them when paused) and continue stopped jobs
+    as room allows
+    '''
+    name = state['name']
+    if state['mode'] == 'pause':
+        allowed = 0
+    elif state['limit'] is not None:
+        allowed = state['limit']
+    else:
+        allowed = len(state['procs'])
+    active = [x for x in state['procs'] if x not in state['stopped']]
+    while len(active) > allowed:
+        fpath = active.pop()
+        if control_plane.stop_job(state['procs'][fpath].pid):
+            state['stopped'].append(fpath)
+            logger.info("%s: PAUSED pid %s %s (%s mode, limit %s)", name, state['procs'][fpath].pid, fpath, state['mode'], state['limit'])
+    while state['stopped'] and len(active) < allowed:
+        fpath = state['stopped'].pop()
+        active.append(fpath)
+        if fpath in state['procs'] and control_plane.continue_job(state['procs'][fpath].pid):
+            logger.info("%s: CONTINUED pid %s %s", name, state['procs'][fpath].pid, fpath)
+
+
+def renew_stopped(state):
+    '''
+    Renew file leases of stopped jobs, whose own
+    heartbeat threads are stopped with them, so
+    other runs don't break them as stale
+    '''
+    for fpath in state['stopped']:
+        if fpath in state['procs']:
+            file_lease.renew_paused(fpath, state['procs'][fpath].pid)
+
+
+def apply_control(states, data):
+    '''
+    Apply changed control plane modes and
+    job limits to each workflow's running jobs
+    '''
+    for name, state in states.items():
+        mode, limit = control_plane.workflow_control(data, name)
+        if (mode, limit) == (state['mode'], state['limit']):
+            continue
+        logger.info("%s: control plane mode %s, job limit %s (was %s, %s), %s running",
+                    name, mode, limit, state['mode'], state['limit'], len(state['running']))
+        state['mode'], state['limit'] = mode, limit
+        if mode == 'drain':
+            for fpath in list(state['pending']):
+                if fpath in state['claims']:
+                    work_queue.release(state['claims'].pop(fpath))
+                    state['pending'].remove(fpath)
+                    state['queued'].pop(fpath, None)
+            if not state['running']:
+                logger.info("%s: DRAINED, no jobs running", name)
+        rebalance(state)
+        state['wake'].set()
+
+
+async def submit_file(state, fpath):
+    '''
+    Probe complete file and submit it to
+    the shared work queue for any host
+    '''
+    now = time.time()
+    if now - state['submitted'].get(fpath, 0) < RETRY_DELAY:
+        return
+    state['submitted'][fpath] = now
+    async with state['probes']:
+        cost = await admission_control.job_cost(fpath, WORKFLOWS[state['name']]['job_type'])
+    try:
+        job = work_queue.submit(state['name'], fpath, cost, RETRY_DELAY)
+    except OSError as err:
+        state['submitted'].pop(fpath, None)
+        logger.warning("%s: Unable to submit %s to work queue %s\n%s", state['name'], fpath, work_queue.QUEUE_DIR, err)
+        return
+    if job:
+        logger.info("%s: submitted %s to work queue as job %s (needs %s cores, mounts %s)",
+                    state['name'], fpath, job['id'], job['cores'], ', '.join(job['mounts']))
+
+
+async def pull_queue(state, caps, stopping):
+    '''
+    Claim jobs from the shared work queue while
+    this workflow has free slots on this host
+    '''
+    name = state['name']
+    while not stopping.is_set():
+        free = slots(state) - len(state['running']) - len(state['pending'])
+        encoding = throughput_windows.allows(state['window']['stages'], 'encode')
+        if free > 0 and encoding and state['mode'] == 'run' and check_control(WORKFLOWS[name]['control']):
+            try:
+                jobs = work_queue.claim(caps, name, free)
+            except OSError as err:
+                logger.warning("%s: Unable to claim from work queue %s\n%s", name, work_queue.QUEUE_DIR, err)
+                jobs = []
+            for job in jobs:
+                fpath = job['path']
+                if not os.path.isfile(fpath) or not enqueue(state, fpath):
+                    logger.info("%s: releasing job %s, %s not readable or recently run here", name, job['id'], fpath)
+                    work_queue.release(job, exclude=True)
+                    continue
+                state['claims'][fpath] = job
+                state['queued'][fpath] = job['submitted']
+                if job.get('cost'):
+                    state['costs'][fpath] = job['cost']
+                logger.info("%s: claimed job %s %s from work queue", name, job['id'], fpath)
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=QUEUE_POLL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def queue_tick(states, caps):
+    '''
+    Refresh this host's claims and record, and
+    requeue claims left by hosts that stopped
+    '''
+    for state in states.values():
+        for fpath, job in list(state['claims'].items()):
+            if not work_queue.heartbeat(job):
+                logger.warning("%s: claim on job %s %s lost to another host", state['name'], job['id'], fpath)
+    work_queue.register_host(caps, {name: len(state['running']) for name, state in states.items()})
+    for job, action in work_queue.reap():
+        logger.warning("Work queue job %s %s %s after claim by %s expired", job['id'], job['path'], action, job.get('host'))
+
+
+async def watch_workflow(state, stopping):
+    '''
+    Watch workflow source paths, queueing
+    each file once it is complete
+    '''
+    workflow = WORKFLOWS[state['name']]
+
+    def complete(fpath):
+        if work_queue.enabled():
+            asyncio.ensure_future(submit_file(state, fpath))
+        elif enqueue(state, fpath):
+            logger.info("%s: queued %s (%s), %s pending, %s running",
+                        state['name'], fpath, get_collection(fpath), len(state['pending']), len(state['running']))
+            asyncio.ensure_future(probe_file(state, fpath))
+
+    await watch_folder.watch_paths(
+        workflow['paths'], workflow['extensions'], complete, stopping,
+        recursive=workflow['recursive'], pair=workflow.get('pair')
+    )
+
+
+def stalled_requeue(state, proc, fpath):
+    '''
+    Log commands of a finished job that process_supervisor
+    stopped after stalling. Returns True if the file should
+    be requeued straight away (up to STALL_REQUEUES times)
+    '''
+    if proc is None:
+        return False
+    stalled = process_supervisor.clear_stalled(proc.pid)
+    if not stalled:
+        state['stalls'].pop(fpath, None)
+        return False
+    count = state['stalls'][fpath] = state['stalls'].get(fpath, 0) + 1
+    for record in stalled:
+        logger.warning("%s: STALLED %s", state['name'], process_supervisor.describe(record))
+    if count > STALL_REQUEUES:
+        logger.warning("%s: %s stalled %s times, leaving for RETRY_DELAY", state['name'], fpath, count)
+        state['stalls'].pop(fpath, None)
+        return False
+    logger.info("%s: REQUEUE %s after stalled command was stopped", state['name'], fpath)
+    return True
+
+
+def report_progress(state):
+    '''
+    Log progress of each running job's supervised
+    commands (FFmpeg percent, fps, speed and ETA)
+    '''
+    for fpath, proc in state['procs'].items():
+        for record in process_supervisor.read_records(proc.pid):
+            logger.info("%s: PROGRESS %s", state['name'], process_supervisor.describe(record))
+
+
+async def run_job(state, host, fpath):
+    '''
+    Launch workflow script for one file as asyncio
+    subprocess and wait for it to exit
+    '''
+    name = state['name']
+    script = os.path.join(CODE_PATH, WORKFLOWS[name]['script'])
+    tic = time.perf_counter()
+    returncode = None
+    proc = None
+    try:
+        state['sizes'][fpath] = os.path.getsize(fpath)
+        proc = await asyncio.create_subprocess_exec(
+            PYTHON, script, fpath,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True
+        )
+        state['procs'][fpath] = proc
+        logger.info("%s: START pid %s %s", name, proc.pid, fpath)
+        returncode = await proc.wait()
+        toc = time.perf_counter()
+        logger.info("%s: END exit code %s after %s seconds %s", name, returncode, round(toc - tic), fpath)
+    except Exception as err:
+        logger.warning("%s: Job launch failed for %s\n%s", name, fpath, err)
+    finally:
+        state['running'].pop(fpath, None)
+        state['procs'].pop(fpath, None)
+        if fpath in state['stopped']:
+            state['stopped'].remove(fpath)
+        rebalance(state)
+        if state['mode'] == 'drain' and not state['running']:
+            logger.info("%s: DRAINED, last running job has finished", name)
+        state['finished'][fpath] = time.time()
+        size = state['sizes'].pop(fpath, 0)
+        requeue = stalled_requeue(state, proc, fpath)
+        if returncode == 0 and not requeue:
+            state['window_stats']['files'] += 1
+            state['window_stats']['bytes'] += size
+        admission_control.record_end(host, fpath)
+        job = state['claims'].pop(fpath, None)
+        if job:
+            try:
+                if requeue:
+                    work_queue.release(job)
+                else:
+                    work_queue.ack(job, returncode, time.perf_counter() - tic)
+            except OSError as err:
+                logger.warning("%s: Unable to write work queue result for %s\n%s", name, fpath, err)
+        elif requeue:
+            state['finished'].pop(fpath, None)
+            enqueue(state, fpath)
+        state['wake'].set()
+
+
+async def dispatch(state, host, stopping):
+    '''
+    Launch queued files whenever a slot is free,
+    downtime control allows and host load admits
+    '''
+    name = state['name']
+    control_key = WORKFLOWS[name]['control']
+    job_type = WORKFLOWS[name]['job_type']
+    loop = asyncio.get_running_loop()
+    while not stopping.is_set():
+        await state['wake'].wait()
+        state['wake'].clear()
+        if stopping.is_set():
+            break
+        if state['pending'] and (state['mode'] != 'run' or not check_control(control_key)):
+            continue
+        while state['pending'] and len(state['running']) < slots(state):
+            ready = [x for x in state['pending'] if window_ready(state, x)]
+            if not ready:
+                if state['holding'] != 'window':
+                    state['holding'] = 'window'
+                    logger.info("%s: HOLD %s pending, throughput window %s allows no encodes",
+                                name, len(state['pending']), state['window']['window'])
+                break
+            fpath = pick_next(state, ready)
+            if not os.path.isfile(fpath):
+                state['pending'].remove(fpath)
+                state['queued'].pop(fpath, None)
+                state['costs'].pop(fpath, None)
+                if fpath in state['claims']:
+                    work_queue.ack(state['claims'].pop(fpath), None, 0, 'source no longer present')
+                continue
+            if fpath not in state['costs']:
+                state['costs'][fpath] = await admission_control.job_cost(fpath, job_type)
+            cost = state['costs'][fpath]
+            allowed, reason = admission_control.admit(host, cost, len(state['running']))
+            if not allowed:
+                # Log each hold once until the reason changes
+                if state['holding'] != reason.split(':')[0]:
+                    state['holding'] = reason.split(':')[0]
+                    logger.info("%s: HOLD %s with %s running, %s", name, fpath, len(state['running']), reason)
+                loop.call_later(ADMIT_RETRY, state['wake'].set)
+                break
+            state['holding'] = None
+            if fpath in state['pending']:
+                state['pending'].remove(fpath)
+            collection, wait = record_dispatch(state, fpath)
+            state['costs'].pop(fpath, None)
+            admission_control.record_start(host, fpath, cost)
+            logger.info("%s: ADMIT %s (%s, waited %ss, expected %ss) with %s running, %s", name, fpath, collection,
+                        wait, round(cost.get('duration') or 0), len(state['running']), reason)
+            state['running'][fpath] = asyncio.create_task(run_job(state, host, fpath))
+
+
+async def control_tick(states, stopping, caps=None):
+    '''
+    Wake dispatchers periodically so jobs paused
+    by downtime control resume when it is lifted,
+    renew leases of stopped jobs, apply
+    throughput window changes, refresh work
+    queue claims if in use and log per collection
+    waits, window throughput and running job progress
+    every REPORT_INTERVAL
+    '''
+    last_report = time.time()
+    while not stopping.is_set():
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=CONTROL_INTERVAL)
+        except asyncio.TimeoutError:
+            window_tick(states)
+            for state in states.values():
+                renew_stopped(state)
+                if state['pending']:
+                    state['wake'].set()
+            if caps:
+                try:
+                    queue_tick(states, caps)
+                except OSError as err:
+                    logger.warning("Unable to update work queue %s\n%s", work_queue.QUEUE_DIR, err)
+            if time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                for state in states.values():
+                    report_waits(state)
+                    report_window(state)
+                    report_progress(state)
+
+
+async def run_scheduler(names):
+    '''
+    Start watch, dispatch, control and host load loops and
+    wait for running jobs once asked to stop
+    '''
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    states = {name: new_state(name) for name in names}
+    host = admission_control.new_host()
+    # Carry out any moves and deletes left queued before a restart
+    finalise_queue.start_worker()
+    process_supervisor.prune()
+    caps = None
+    if work_queue.enabled():
+        caps = work_queue.host_capabilities()
+        work_queue.register_host(caps, {name: 0 for name in names})
+        logger.info("Work queue node %s: %s cores, mounts %s", caps['host'], caps['cores'], ', '.join(caps['mounts']))
+    tasks = [asyncio.create_task(control_tick(states, stopping, caps))]
+    tasks.append(asyncio.create_task(admission_control.monitor_host(host, stopping)))
+    tasks.append(asyncio.create_task(control_plane.watch_control(
+        lambda data: apply_control(states, data), stopping, CONTROL_JSON)))
+    tasks.extend(asyncio.create_task(watch_workflow(state, stopping)) for state in states.values())
+    if caps:
+        tasks.extend(asyncio.create_task(pull_queue(state, caps, stopping)) for state in states.values())
+    tasks.extend(asyncio.create_task(dispatch(state, host, stopping)) for state in states.values())
+
+    await stopping.wait()
+    logger.info("Stop requested, no new jobs will launch. Waiting for running jobs to complete")
+    for state in states.values():
+        state['wake'].set()
+        # Paused jobs must continue to be able to finish
+        for fpath in state['stopped']:
+            if fpath in state['procs']:
+                control_plane.continue_job(state['procs'][fpath].pid)
+                logger.info("%s: CONTINUED pid %s %s for shutdown", state['name'], state['procs'][fpath].pid, fpath)
+        state['stopped'] = []
+        state['mode'], state['limit'] = 'run', None
+    await asyncio.gather(*tasks, return_exceptions=True)
+    running = [task for state in states.values() for task in state['running'].values()]
+    if running:
+        await asyncio.gather(*running, return_exceptions=True)
+    for state in states.values():
+        for fpath in list(state['pending']):
+            if fpath in state['claims']:
+                work_queue.release(state['claims'].pop(fpath))
+        report_waits(state)
+        report_window(state)
+    if caps:
+        work_queue.register_host(caps, {name: 0 for name in names})
+
+
+def main():
+    '''
+    Run scheduler for workflows named in sys.argv,
+    or all workflows if none supplied
+    '''
+    names = sys.argv[1:] or list(WORKFLOWS)
+    unknown = [x for x in names if x not in WORKFLOWS]
+    if unknown:
+        sys.exit(f"Unknown workflow(s): {', '.join(unknown)}. Choose from {', '.join(WORKFLOWS)}")
+
+    logger.info("================== START transcode scheduler START ==================")
+    logger.info("Workflows: %s", ', '.join(f"{x} (up to {WORKFLOWS[x]['jobs']} jobs)" for x in names))
+    for name in names:
+        profile = get_profile(name)
+        if profile:
+            logger.info("%s: calibrated profile of %s jobs from %s", name, profile.get('jobs'), profile.get('calibrated'))
+    asyncio.run(run_scheduler(names))
+    logger.info("================== END transcode scheduler END ==================")
+
+
+if __name__ == '__main__':
+    main()
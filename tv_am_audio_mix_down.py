@@ -14,6 +14,8 @@ import shutil
 import logging
 import subprocess
 
+import watch_folder
+
 STORAGE = os.environ.get("BP_NAS_VID")
 TARGET = os.path.join(STORAGE, "automation/tvam_audio_fix")
 LOG_PATH = os.environ.get("LOG_PATH")
@@ -60,6 +62,9 @@ def main():
     """
 
     files = [ x for x in os.listdir(TARGET) if os.path.isfile(os.path.join(TARGET, x)) ]
+    # Skip any file still being written
+    stable = watch_folder.stable_files([os.path.join(TARGET, x) for x in files])
+    files = [ os.path.basename(x) for x in stable ]
     if not files:
         sys.exit("No files found for transcoding.")
     
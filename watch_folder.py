@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, WATCH FOLDER INGEST WITH FILE STABILITY CHECKS **
+Replaces 'find -mmin +30' searches (half an hour of latency for every file)
+and bare os.listdir() calls (no check the file has finished arriving).
+
+Actions of watch_paths():
+1. Paths on local filesystems are watched with Linux inotify. A file is
+   complete when it receives IN_CLOSE_WRITE (writer has closed it) or
+   IN_MOVED_TO (rsync style rename into place). New sub folders are
+   watched where recursive.
+2. Paths on network mounts (NFS, CIFS), where inotify does not see writes
+   made by other hosts, are polled every POLL_INTERVAL seconds. A file is
+   complete when size and mtime are unchanged between two polls and the
+   mtime is at least SETTLE seconds old. Local paths are also polled, more
+   slowly, to pick up files present at start up or missed by inotify.
+3. Where a pair extension is given (ie, '.xml' for Memnon deliveries) a
+   complete file is held until a complete file with the same name and
+   the pair extension is also present.
+4. Complete files are passed to callback(fpath). A file left in place can
+   be passed again on later polls, so callers must ignore repeats.
+
+stable_files() gives the same size/mtime check for scripts that list a
+folder on each run.
+
+Command line use, running a command for each complete file:
+    python3 watch_folder.py <folder> <.ext> <command> [<pair .ext>]
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import time
+import ctypes
+import struct
+import asyncio
+import logging
+import subprocess
+import ctypes.util
+
+POLL_INTERVAL = 30
+LOCAL_POLL_INTERVAL = 600
+SETTLE = 60
+NETWORK_FS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs')
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+logger = logging.getLogger('watch_folder')
+
+
+def get_mount_type(path):
+    '''
+    Return filesystem type of the mount
+    holding path, from /proc/mounts
+    '''
+    path = os.path.realpath(path)
+    best = ('', '')
+    try:
+        with open('/proc/mounts', 'r') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best[0]):
+                    best = (mount_point, fields[2])
+    except OSError:
+        return ''
+    return best[1]
+
+
+def is_network_mount(path):
+    '''
+    True where inotify cannot see remote writes
+    '''
+    return get_mount_type(path) in NETWORK_FS
+
+
+def stable_files(paths, wait=5, settle=SETTLE):
+    '''
+    Return paths whose size and mtime do not change
+    over wait seconds and whose mtime is settle seconds old
+    '''
+    def snapshot():
+        stats = {}
+        for fpath in paths:
+            try:
+                stat = os.stat(fpath)
+                stats[fpath] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                continue
+        return stats
+
+    first = snapshot()
+    if not first:
+        return []
+    time.sleep(wait)
+    second = snapshot()
+    cutoff = time.time() - settle
+    return [x for x in paths if x in second and first.get(x) == second[x] and second[x][1] < cutoff]
+
+
+def list_folders(path, recursive):
+    '''
+    Return path and, where recursive, all sub folders
+    '''
+    if not recursive:
+        return [path]
+    return [root for root, _, _ in os.walk(path)]
+
+
+def make_ready_handler(extensions, callback, pair=None):
+    '''
+    Return handler receiving every complete file,
+    which passes on matching files once any pair is present
+    '''
+    waiting = {}
+    pairs_done = set()
+
+    def ready(fpath):
+        stem, ext = os.path.splitext(fpath)
+        if pair and ext.lower() == pair.lower():
+            pairs_done.add(stem)
+            if stem in waiting:
+                callback(waiting.pop(stem))
+            return
+        if not fpath.endswith(extensions):
+            return
+        if pair and stem not in pairs_done:
+            waiting[stem] = fpath
+            return
+        callback(fpath)
+
+    def prune():
+        for stem in list(pairs_done):
+            if not os.path.exists(f"{stem}{pair}"):
+                pairs_done.discard(stem)
+        for stem, fpath in list(waiting.items()):
+            if not os.path.exists(fpath):
+                waiting.pop(stem)
+
+    ready.prune = prune
+    return ready
+
+
+def inotify_start(folders, recursive, ready):
+    '''
+    Start inotify watches on folders, reading events
+    from the asyncio loop. Returns fd, or None if unavailable
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError) as err:
+        logger.warning("inotify unavailable, polling only: %s", err)
+        return None
+    if fd < 0:
+        logger.warning("inotify_init1 failed, polling only: errno %s", ctypes.get_errno())
+        return None
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    watches = {}
+
+    def add_watch(folder):
+        wd = libc.inotify_add_watch(fd, os.fsencode(folder), mask)
+        if wd < 0:
+            logger.warning("Unable to watch %s: errno %s", folder, ctypes.get_errno())
+        else:
+            watches[wd] = folder
+
+    def on_readable():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, event_mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if event_mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflow, relying on polling until next pass")
+                continue
+            folder = watches.get(wd)
+            if not folder or not name:
+                continue
+            fpath = os.path.join(folder, os.fsdecode(name))
+            if event_mask & IN_ISDIR:
+                if event_mask & (IN_CREATE | IN_MOVED_TO) and recursive:
+                    for sub in list_folders(fpath, True):
+                        add_watch(sub)
+                continue
+            if event_mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                ready(fpath)
+
+    for folder in folders:
+        add_watch(folder)
+    asyncio.get_running_loop().add_reader(fd, on_readable)
+    return fd
+
+
+async def poll_loop(paths, recursive, ready, interval, stopping):
+    '''
+    Poll folders, passing files with unchanged size and
+    mtime between two polls and mtime settled to ready
+    '''
+    previous = {}
+    loop = asyncio.get_running_loop()
+
+    def scan():
+        current = {}
+        for path in paths:
+            if not os.path.isdir(path):
+                continue
+            for folder in list_folders(path, recursive):
+                try:
+                    names = os.listdir(folder)
+                except OSError:
+                    continue
+                for name in names:
+                    fpath = os.path.join(folder, name)
+                    try:
+                        stat = os.stat(fpath)
+                    except OSError:
+                        continue
+                    if os.path.isfile(fpath):
+                        current[fpath] = (stat.st_size, stat.st_mtime)
+        return current
+
+    while not stopping.is_set():
+        current = await loop.run_in_executor(None, scan)
+        cutoff = time.time() - SETTLE
+        for fpath, stat in sorted(current.items()):
+            if previous.get(fpath) == stat and stat[1] < cutoff:
+                ready(fpath)
+        wait = interval if previous else min(interval, POLL_INTERVAL)
+        previous = current
+        if hasattr(ready, 'prune'):
+            ready.prune()
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def watch_paths(paths, extensions, callback, stopping, recursive=False, pair=None):
+    '''
+    Watch paths until stopping is set, passing each
+    complete file with matching extension to callback
+    '''
+    paths = [x for x in paths if x and os.path.isdir(x)]
+    ready = make_ready_handler(tuple(extensions), callback, pair)
+    local = [x for x in paths if not is_network_mount(x)]
+    network = [x for x in paths if x not in local]
+
+    fd = None
+    if local:
+        folders = [sub for path in local for sub in list_folders(path, recursive)]
+        fd = inotify_start(folders, recursive, ready)
+        if fd is None:
+            network.extend(local)
+            local = []
+    logger.info("Watching with inotify: %s / polling: %s", local, network)
+
+    tasks = []
+    if network:
+        tasks.append(asyncio.create_task(poll_loop(network, recursive, ready, POLL_INTERVAL, stopping)))
+    if local:
+        tasks.append(asyncio.create_task(poll_loop(local, recursive, ready, LOCAL_POLL_INTERVAL, stopping)))
+    try:
+        await asyncio.gather(*tasks)
+        await stopping.wait()
+    finally:
+        if fd is not None:
+            asyncio.get_running_loop().remove_reader(fd)
+            os.close(fd)
+
+
+def main():
+    '''
+    Run command with each complete file path appended
+    '''
+    if len(sys.argv) < 4:
+        sys.exit("Usage: watch_folder.py <folder> <.ext> <command> [<pair .ext>]")
+    folder, ext, command = sys.argv[1:4]
+    pair = sys.argv[4] if len(sys.argv) > 4 else None
+    logging.basicConfig(format='%(asctime)s\t%(levelname)s\t%(message)s', level=logging.INFO)
+    done = set()
+
+    def launch(fpath):
+        if fpath in done:
+            return
+        done.add(fpath)
+        logger.info("Complete file: %s", fpath)
+        subprocess.call(command.split() + [fpath])
+
+    async def run():
+        await watch_paths([folder], (ext,), launch, asyncio.Event(), pair=pair)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+'''
+** MODULE FOR ALL SCRIPTS, MULTI HOST WORK QUEUE ON SHARED STORAGE **
+Lets transcode_scheduler.py on several servers share the workflows'
+files, so throughput grows by adding transcode hosts that mount the
+same NAS paths rather than by making one server bigger.
+
+The queue is a folder on storage all hosts mount (WORK_QUEUE), holding:
+    pending/   one JSON job per file waiting for a host
+    claimed/   jobs being run, with the claiming host and PID
+    results/   one JSON result per finished job, from every host
+    hosts/     each host's capabilities and running jobs
+
+Actions:
+1. submit() writes a job for a workflow and file, with the mounts the
+   file needs and its expected cores, duration and cost. The job ID comes
+   from workflow and path, and the job is hard linked into pending/, so
+   a file found by several hosts' watchers is queued once. Files with a
+   result newer than retry_delay are not queued again.
+2. claim() renames the oldest jobs a host can run from pending/ to
+   claimed/. Rename is atomic on NFS, so only one host gets each job.
+   A host can run a job if all of its mounts are present on the host,
+   it has the job's cores (or is as large as any live host, so large
+   jobs go to large hosts without waiting forever), and the host hasn't
+   already released it as unreadable.
+3. heartbeat() updates a claim's modification time while the job is
+   queued or running on the claiming host. reap() returns claims with
+   no heartbeat for CLAIM_TTL seconds (ie, the host crashed) to pending/,
+   up to MAX_ATTEMPTS times.
+4. ack() writes the job's exit code, run time and host to results/ and
+   removes the claim. release() returns a claim to pending/ unrun.
+5. register_host() writes capabilities (cores and mounts present) and
+   running counts, read by status() and the command line.
+
+File paths must be the same on every host (same mount points).
+
+Command line use:
+    python3 work_queue.py status
+    python3 work_queue.py results [<YYYY-MM-DD>]
+    python3 work_queue.py submit <workflow> <filepath>
+
+2026
+Python 3.7+
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import hashlib
+import datetime
+
+# Local import
+from checksum_maker import get_mount, get_mount_limits
+
+QUEUE_DIR = os.environ.get('WORK_QUEUE', '')
+CLAIM_TTL = 600
+MAX_ATTEMPTS = 3
+HOST = socket.gethostname()
+FOLDERS = ('pending', 'claimed', 'results', 'hosts', 'tmp')
+
+
+def enabled():
+    '''
+    True if a shared work queue is configured
+    '''
+    return bool(QUEUE_DIR)
+
+
+def folder(name):
+    '''
+    Path of queue sub folder, created if needed
+    '''
+    path = os.path.join(QUEUE_DIR, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def job_id(workflow, fpath):
+    '''
+    Stable ID for a workflow and file
+    '''
+    return hashlib.sha1(f"{workflow}:{os.path.abspath(fpath)}".encode('utf-8')).hexdigest()[:20]
+
+
+def read_job(path):
+    '''
+    Return job dictionary from JSON file, or None
+    '''
+    try:
+        with open(path, 'r') as data:
+            return json.load(data)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    '''
+    Write JSON to path by way of a unique temporary file
+    '''
+    tmp = os.path.join(folder('tmp'), f"{os.path.basename(path)}.{uuid.uuid4().hex}")
+    with open(tmp, 'w') as out:
+        json.dump(data, out, indent=4)
+    os.replace(tmp, path)
+
+
+def file_mounts(fpath):
+    '''
+    Mount names a file needs, named as for io_governor
+    '''
+    return [get_mount(fpath, get_mount_limits())]
+
+
+def host_capabilities():
+    '''
+    Return this host's cores and the mounts present,
+    from /proc/mounts named as for file_mounts()
+    '''
+    limits = get_mount_limits()
+    mounts = set()
+    try:
+        with open('/proc/mounts', 'r') as data:
+            for line in data:
+                mounts.add(get_mount(line.split()[1], limits))
+    except (OSError, IndexError):
+        pass
+    return {'host': HOST, 'cores': os.cpu_count() or 1, 'mounts': sorted(mounts)}
+
+
+def last_result(jid):
+    '''
+    Time of job's most recent result, or 0
+    '''
+    prefix = f"{jid}."
+    times = [os.path.getmtime(os.path.join(folder('results'), x))
+             for x in os.listdir(folder('results')) if x.startswith(prefix)]
+    return max(times, default=0)
+
+
+def submit(workflow, fpath, cost=None, retry_delay=0):
+    '''
+    Queue file for workflow once across all hosts
+    Returns job dictionary, or None if already
+    queued, claimed or recently finished
+    '''
+    jid = job_id(workflow, fpath)
+    pending = os.path.join(folder('pending'), f"{jid}.json")
+    if os.path.exists(os.path.join(folder('claimed'), f"{jid}.json")):
+        return None
+    if retry_delay and time.time() - last_result(jid) < retry_delay:
+        return None
+    cost = cost or {}
+    job = {
+        'id': jid,
+        'workflow': workflow,
+        'path': os.path.abspath(fpath),
+        'mounts': file_mounts(fpath),
+        'cores': cost.get('cores', 1),
+        'cost': cost,
+        'submitted': time.time(),
+        'submitted_by': HOST,
+        'attempts': 0,
+        'excluded': []
+    }
+    tmp = os.path.join(folder('tmp'), f"{jid}.{uuid.uuid4().hex}")
+    with open(tmp, 'w') as out:
+        json.dump(job, out, indent=4)
+    try:
+        os.link(tmp, pending)
+    except FileExistsError:
+        return None
+    finally:
+        os.remove(tmp)
+    return job
+
+
+def largest_host():
+    '''
+    Most cores of any host updated within CLAIM_TTL
+    '''
+    cores = [0]
+    for fname in os.listdir(folder('hosts')):
+        host = read_job(os.path.join(folder('hosts'), fname))
+        if host and time.time() - host.get('updated', 0) < CLAIM_TTL:
+            cores.append(host.get('cores', 0))
+    return max(cores)
+
+
+def can_run(job, caps, is_largest=False):
+    '''
+    Host capabilities meet job's needs
+    '''
+    if caps['host'] in job.get('excluded', []):
+        return False
+    if job.get('cores', 1) > caps['cores'] and not is_largest:
+        return False
+    return all(x in caps['mounts'] for x in job.get('mounts', []))
+
+
+def claim(caps, workflow, limit=1):
+    '''
+    Claim up to limit of the oldest pending jobs for
+    workflow this host can run. Returns claimed jobs
+    '''
+    pending_dir = folder('pending')
+    # Jobs larger than every live host are run by the largest
+    is_largest = largest_host() <= caps['cores']
+    jobs = []
+    for fname in os.listdir(pending_dir):
+        job = read_job(os.path.join(pending_dir, fname))
+        if job and job['workflow'] == workflow and can_run(job, caps, is_largest):
+            jobs.append(job)
+
+    claimed = []
+    for job in sorted(jobs, key=lambda x: x['submitted']):
+        if len(claimed) >= limit:
+            break
+        path = os.path.join(folder('claimed'), f"{job['id']}.json")
+        try:
+            os.rename(os.path.join(pending_dir, f"{job['id']}.json"), path)
+        except FileNotFoundError:
+            # Claimed by another host first
+            continue
+        job = read_job(path) or job
+        job.update({'host': HOST, 'pid': os.getpid(), 'claimed': time.time()})
+        write_json(path, job)
+        claimed.append(job)
+    return claimed
+
+
+def heartbeat(job):
+    '''
+    Refresh claim while job is queued or running here
+    Returns False if the claim has been lost
+    '''
+    path = os.path.join(folder('claimed'), f"{job['id']}.json")
+    current = read_job(path)
+    if not current or current.get('host') != HOST or current.get('pid') != job.get('pid'):
+        return False
+    os.utime(path, None)
+    return True
+
+
+def release(job, exclude=False):
+    '''
+    Return claimed job to pending unrun. With exclude
+    this host won't claim it again (ie, path not readable)
+    '''
+    path = os.path.join(folder('claimed'), f"{job['id']}.json")
+    if exclude and HOST not in job.get('excluded', []):
+        job.setdefault('excluded', []).append(HOST)
+    for key in ('host', 'pid', 'claimed'):
+        job.pop(key, None)
+    write_json(path, job)
+    try:
+        os.rename(path, os.path.join(folder('pending'), f"{job['id']}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def ack(job, returncode, seconds, note=''):
+    '''
+    Write job result to results/ and remove claim
+    '''
+    result = dict(job)
+    result.update({
+        'host': HOST,
+        'returncode': returncode,
+        'seconds': round(seconds),
+        'finished': time.time(),
+        'note': note
+    })
+    write_json(os.path.join(folder('results'), f"{job['id']}.{int(time.time())}.json"), result)
+    try:
+        os.remove(os.path.join(folder('claimed'), f"{job['id']}.json"))
+    except FileNotFoundError:
+        pass
+    return result
+
+
+def reap(ttl=CLAIM_TTL):
+    '''
+    Return claims with no heartbeat for ttl seconds to
+    pending, or fail them after MAX_ATTEMPTS. Returns
+    list of (job, action) for the caller to log
+    '''
+    claimed_dir = folder('claimed')
+    reaped = []
+    for fname in os.listdir(claimed_dir):
+        path = os.path.join(claimed_dir, fname)
+        try:
+            if time.time() - os.path.getmtime(path) < ttl:
+                continue
+            # Rename aside first so only one host reaps the claim
+            aside = os.path.join(folder('tmp'), f"{fname}.reap.{uuid.uuid4().hex}")
+            os.rename(path, aside)
+        except FileNotFoundError:
+            continue
+        job = read_job(aside)
+        os.remove(aside)
+        if not job:
+            continue
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] >= MAX_ATTEMPTS:
+            ack(job, None, 0, f"claim by {job.get('host')} expired {job['attempts']} times")
+            reaped.append((job, 'failed'))
+            continue
+        lost_host = job.get('host')
+        for key in ('host', 'pid', 'claimed'):
+            job.pop(key, None)
+        write_json(os.path.join(folder('pending'), fname), job)
+        reaped.append((dict(job, host=lost_host), 'requeued'))
+    return reaped
+
+
+def register_host(caps, running):
+    '''
+    Record host capabilities and running job
+    counts per workflow for status reports
+    '''
+    write_json(os.path.join(folder('hosts'), f"{caps['host']}.json"),
+               dict(caps, running=running, updated=time.time()))
+
+
+def status():
+    '''
+    Return pending and claimed counts per workflow
+    and each host's record
+    '''
+    counts = {}
+    for state in ('pending', 'claimed'):
+        for fname in os.listdir(folder(state)):
+            job = read_job(os.path.join(folder(state), fname))
+            if job:
+                counts.setdefault(job['workflow'], {'pending': 0, 'claimed': 0})[state] += 1
+    hosts = [read_job(os.path.join(folder('hosts'), x)) for x in sorted(os.listdir(folder('hosts')))]
+    return counts, [x for x in hosts if x]
+
+
+def results(date=None):
+    '''
+    Return results, optionally only
+    those finished on date (YYYY-MM-DD)
+    '''
+    found = []
+    for fname in os.listdir(folder('results')):
+        result = read_job(os.path.join(folder('results'), fname))
+        if not result:
+            continue
+        finished = datetime.datetime.fromtimestamp(result['finished']).strftime('%Y-%m-%d')
+        if date is None or finished == date:
+            found.append(result)
+    return sorted(found, key=lambda x: x['finished'])
+
+
+def main():
+    '''
+    Command line queue status, results and submission
+    '''
+    if not enabled():
+        sys.exit("WORK_QUEUE environment variable is not set")
+    if len(sys.argv) < 2 or sys.argv[1] not in ('status', 'results', 'submit'):
+        sys.exit("Usage: work_queue.py status | results [<YYYY-MM-DD>] | submit <workflow> <filepath>")
+
+    if sys.argv[1] == 'status':
+        counts, hosts = status()
+        for workflow, count in sorted(counts.items()):
+            print(f"{workflow}: {count['pending']} pending, {count['claimed']} claimed")
+        for host in hosts:
+            age = round(time.time() - host['updated'])
+            print(f"{host['host']}: {host['cores']} cores, mounts {', '.join(host['mounts'])}, "
+                  f"running {host['running']}, updated {age}s ago")
+    elif sys.argv[1] == 'results':
+        summary = {}
+        for result in results(sys.argv[2] if len(sys.argv) > 2 else None):
+            key = (result['workflow'], result['host'])
+            item = summary.setdefault(key, {'jobs': 0, 'ok': 0, 'seconds': 0})
+            item['jobs'] += 1
+            item['ok'] += 1 if result['returncode'] == 0 else 0
+            item['seconds'] += result['seconds']
+        for (workflow, host), item in sorted(summary.items()):
+            print(f"{workflow} on {host}: {item['jobs']} jobs, {item['ok']} exit 0, "
+                  f"mean {round(item['seconds'] / item['jobs'])}s")
+    else:
+        if len(sys.argv) < 4:
+            sys.exit("Usage: work_queue.py submit <workflow> <filepath>")
+        job = submit(sys.argv[2], sys.argv[3])
+        print(f"Queued job {job['id']}" if job else "Already queued, claimed or recently finished")
+
+
+if __name__ == '__main__':
+    main()